@@ -0,0 +1,757 @@
+#!/usr/bin/env python3
+"""Benchmarks for the data APIs in project_lib.
+
+Measures the per-call latency of the mocked activity APIs against synthetic
+activity calendars of increasing size, to check that queries stay flat as the
+calendar grows.
+
+The --suite mode runs a reproducible microbenchmark suite of the hot paths
+(the mocked APIs, rendering, ChatAgent history and the deterministic evals)
+against calendars of 10^2, 10^4 and 10^6 events. Results can be saved as
+JSON and compared against a stored baseline, failing on regressions.
+
+The report runs against calendars of up to 10^5 events; --large adds the
+multi-million event columnar and SQLite runs.
+
+Usage:
+    python benchmark_project_lib.py [--sizes 100 1000 10000 100000] [--number 2000] [--large]
+    python benchmark_project_lib.py --suite --json baseline.json
+    python benchmark_project_lib.py --suite --compare baseline.json [--threshold 0.25]
+"""
+
+from __future__ import annotations
+
+import argparse
+import ast
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import project_lib
+from fake_openai import FakeOpenAIClient, LatencyModel
+from project_lib import (
+    ActivityRecord,
+    ActivityStore,
+    BackgroundSink,
+    COMPACT_PLAN_RESPONSE_FORMAT,
+    BufferedFileSink,
+    ChatAgent,
+    ChatMetrics,
+    ColumnarActivityCalendar,
+    Interest,
+    InMemoryDataSource,
+    JsonlDataSource,
+    JsonlSink,
+    NullSink,
+    PromptTemplate,
+    SnapshotDataSource,
+    SQLiteDataSource,
+    TerminalSink,
+    TokenBudgetPolicy,
+    call_activities_api_mocked,
+    call_activity_by_id_api_mocked,
+    call_weather_api_mocked,
+    encode_candidates_compact,
+    estimate_message_tokens,
+    estimate_tokens,
+    import_calendar_to_sqlite,
+    print_in_box,
+    solve_itinerary,
+    score_interest_coverage,
+    write_calendar_snapshot,
+    write_jsonl,
+)
+
+DEFAULT_SIZES = [100, 1_000, 10_000, 100_000]
+EVENTS_PER_DAY = 4
+QUERY_DATE = "2025-06-12"
+SUITE_SIZES = [100, 10_000, 1_000_000]
+COLUMNAR_SIZES = [10_000, 100_000]
+COLUMNAR_LARGE_SIZES = [10_000, 1_000_000, 4_000_000]
+SQLITE_SIZES = [10_000, 100_000]
+SQLITE_LARGE_SIZES = [10_000, 1_000_000]
+DEFAULT_THRESHOLD = 0.25
+EVALS_NOTEBOOK = os.path.join(os.path.dirname(os.path.abspath(__file__)), "project_starter_on_revision_structured_output.ipynb")
+# The notebooks' sample trip
+SAMPLE_VACATION_INFO = {
+    "travelers": [
+        {"name": "Yuri", "age": 30, "interests": ["tennis", "cooking", "comedy", "technology"]},
+        {"name": "Hiro", "age": 25, "interests": ["reading", "music", "theatre", "art"]},
+    ],
+    "destination": "AgentsVille",
+    "date_of_arrival": "2025-06-10",
+    "date_of_departure": "2025-06-12",
+    "budget": 130,
+}
+DETERMINISTIC_EVALS = [
+    "eval_start_end_dates_match",
+    "eval_total_cost_is_accurate",
+    "eval_total_cost_is_within_budget",
+    "eval_itinerary_events_match_actual_events",
+    "eval_itinerary_satisfies_interests",
+]
+
+
+def make_synthetic_calendar(
+    n_events: int,
+    events_per_day: int = EVENTS_PER_DAY,
+    first_day: datetime.date = datetime.date(2025, 6, 10),
+) -> List[Dict[str, Any]]:
+    """Build a synthetic activity calendar shaped like ACTIVITY_CALENDAR.
+
+    Args:
+        n_events: The number of events to generate.
+        events_per_day: The number of events scheduled on each day.
+        first_day: The date of the first generated event.
+
+    Returns:
+        A list of activity events, events_per_day per consecutive day.
+    """
+    interests = [interest.value for interest in Interest]
+    events = []
+    for i in range(n_events):
+        day = first_day + datetime.timedelta(days=i // events_per_day)
+        slot = i % events_per_day
+        events.append(
+            {
+                "activity_id": f"event-{day.isoformat()}-{slot}",
+                "name": f"Synthetic Event {i}",
+                "start_time": f"{day.isoformat()} {9 + 3 * slot:02d}:00",
+                "end_time": f"{day.isoformat()} {11 + 3 * slot:02d}:00",
+                "location": f"Venue {i % 97}, AgentsVille",
+                "description": "A synthetic event used for benchmarking. " * 5,
+                "price": 10 + i % 20,
+                "related_interests": [interests[i % len(interests)], interests[(i * 7) % len(interests)]],
+            }
+        )
+    return events
+
+
+def _linear_scan_baseline(date: str, events: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Reproduce the original rebuild-then-filter implementation for comparison."""
+    activities = [
+        {
+            "activity_id": str(event["activity_id"]),
+            "name": str(event["name"]),
+            "start_time": str(event["start_time"]),
+            "end_time": str(event["end_time"]),
+            "location": str(event["location"]),
+            "description": str(event["description"]),
+            "price": int(event["price"]),
+            "related_interests": [str(interest) for interest in event["related_interests"]],
+        }
+        for event in events
+    ]
+    return [event for event in activities if str(event["start_time"]).startswith(date)]
+
+
+def _per_call_us(fn: Callable[[], Any], number: int) -> float:
+    """Return the best-of-three mean latency of fn in microseconds."""
+    return min(timeit.repeat(fn, number=number, repeat=3)) / number * 1e6
+
+
+def bench_call_activities_api_mocked(sizes: List[int], number: int) -> None:
+    """Print per-call latency of call_activities_api_mocked for each calendar size."""
+    print(f"{'events':>10} {'indexed (us)':>14} {'linear scan (us)':>18}")
+    original_store = project_lib.ACTIVITY_STORE
+    try:
+        for size in sizes:
+            events = make_synthetic_calendar(size)
+            project_lib.ACTIVITY_STORE = ActivityStore(events)
+            indexed = _per_call_us(
+                lambda: call_activities_api_mocked(date=QUERY_DATE, city="AgentsVille"), number
+            )
+            # The baseline is O(calendar), so scale down its repetitions.
+            scan_number = max(1, number * 100 // size)
+            scan = _per_call_us(lambda: _linear_scan_baseline(QUERY_DATE, events), scan_number)
+            print(f"{size:>10} {indexed:>14.2f} {scan:>18.2f}")
+    finally:
+        project_lib.ACTIVITY_STORE = original_store
+
+
+def _set_based_interest_hits(
+    travelers: List[Dict[str, Any]], activities: List[Dict[str, Any]]
+) -> Dict[str, int]:
+    """Reproduce the set-intersection interest check of the notebook for comparison."""
+    hits = {}
+    for traveler in travelers:
+        hits[traveler["name"]] = sum(
+            1 for activity in activities
+            if set(traveler["interests"]) & set(activity["related_interests"])
+        )
+    return hits
+
+
+def bench_score_interest_coverage(traveler_counts: List[int], n_activities: int, number: int) -> None:
+    """Print the latency of score_interest_coverage against the set-based check."""
+    interests = [interest.value for interest in Interest]
+    activities = make_synthetic_calendar(n_activities)
+    print(f"{'travelers':>10} {'bitmask (us)':>14} {'sets (us)':>18}")
+    for n_travelers in traveler_counts:
+        travelers = [
+            {"name": f"Traveler {i}", "interests": [interests[i % len(interests)], interests[(i * 3) % len(interests)]]}
+            for i in range(n_travelers)
+        ]
+        bitmask = _per_call_us(lambda: score_interest_coverage(travelers, activities), max(1, number // 10))
+        sets = _per_call_us(lambda: _set_based_interest_hits(travelers, activities), max(1, number // 10))
+        print(f"{n_travelers:>10} {bitmask:>14.2f} {sets:>18.2f}")
+
+
+def make_synthetic_columnar_calendar(n_events: int, seed: int = 0) -> ColumnarActivityCalendar:
+    """Build a synthetic columnar calendar directly from random columns.
+
+    Rows are materialized lazily from the same generator as
+    make_synthetic_calendar, so multi-million event calendars fit in memory.
+    """
+    import numpy as np
+
+    class _LazyEvents:
+        def __len__(self) -> int:
+            return n_events
+
+        def __getitem__(self, row: int) -> ActivityRecord:
+            return ActivityRecord.from_event(_lazy_event(row))
+
+    def _lazy_event(row: int) -> Dict[str, Any]:
+        day = datetime.date(2025, 6, 10) + datetime.timedelta(days=row // EVENTS_PER_DAY)
+        slot = row % EVENTS_PER_DAY
+        return {
+            "activity_id": f"event-{day.isoformat()}-{slot}",
+            "name": f"Synthetic Event {row}",
+            "start_time": f"{day.isoformat()} {9 + 3 * slot:02d}:00",
+            "end_time": f"{day.isoformat()} {11 + 3 * slot:02d}:00",
+            "location": f"Venue {row % 97}, AgentsVille",
+            "description": "A synthetic event used for benchmarking.",
+            "price": 10 + row % 20,
+            "related_interests": [list(Interest)[row % len(Interest)].value],
+        }
+
+    rng = np.random.default_rng(seed)
+    rows = np.arange(n_events)
+    first_epoch = (datetime.date(2025, 6, 10) - datetime.date(1970, 1, 1)).days * 86400
+    start_epoch = first_epoch + (rows // EVENTS_PER_DAY) * 86400 + (9 + 3 * (rows % EVENTS_PER_DAY)) * 3600
+    return ColumnarActivityCalendar(
+        price=rng.integers(5, 60, n_events),
+        start_epoch=start_epoch,
+        end_epoch=start_epoch + 7200,
+        city_code=rng.integers(0, 4, n_events),
+        interest_mask=rng.integers(1, 1 << len(Interest), n_events),
+        setting_code=rng.integers(0, 4, n_events),
+        cities=["AgentsVille", "BotBurg", "Cogton", "Dataport"],
+        records=_LazyEvents(),
+    )
+
+
+def bench_columnar_query(sizes: List[int], number: int) -> None:
+    """Print the latency of a typical ColumnarActivityCalendar.query per calendar size."""
+    print(f"{'events':>10} {'window (ms)':>12} {'full scan (ms)':>15} {'matches':>10}")
+    for size in sizes:
+        calendar = make_synthetic_columnar_calendar(size)
+        query = dict(max_price=25, interests=["hiking", "music"], city="AgentsVille", exclude_outdoor=True)
+        window = _per_call_us(
+            lambda: calendar.query(start_date="2025-07-01", end_date="2025-07-31", **query), number
+        ) / 1000
+        full = _per_call_us(lambda: calendar.query(**query), max(1, number // 10)) / 1000
+        matches = len(calendar.query(start_date="2025-07-01", end_date="2025-07-31", **query))
+        print(f"{size:>10} {window:>12.3f} {full:>15.3f} {matches:>10}")
+
+
+def bench_data_sources(sizes: List[int]) -> None:
+    """Print the time to load the activity store from each data source."""
+    print(f"{'events':>10} {'in-memory (s)':>14} {'jsonl (s)':>10} {'snapshot (s)':>13}")
+    for size in sizes:
+        events = make_synthetic_calendar(size)
+        with tempfile.TemporaryDirectory() as tmp:
+            jsonl_path = os.path.join(tmp, "activities.jsonl")
+            snapshot_path = os.path.join(tmp, "snapshot")
+            write_jsonl(jsonl_path, events)
+            sources = [InMemoryDataSource(events), JsonlDataSource(jsonl_path)]
+            # Snapshots are NumPy arrays
+            if project_lib.NUMPY_AVAILABLE:
+                write_calendar_snapshot(snapshot_path, events)
+                sources.append(SnapshotDataSource(snapshot_path))
+
+            timings = []
+            for source in sources:
+                started = time.perf_counter()
+                source.load_activities()
+                timings.append(time.perf_counter() - started)
+        snapshot = f"{timings[2]:>13.3f}" if len(timings) > 2 else f"{'-':>13}"
+        print(f"{size:>10} {timings[0]:>14.3f} {timings[1]:>10.3f} {snapshot}")
+
+
+def bench_sqlite_backend(sizes: List[int], number: int) -> None:
+    """Print per-call API latency with the in-memory and SQLite backends."""
+    print(
+        f"{'events':>10} {'import (s)':>11} {'memory date (us)':>17} {'sqlite date (us)':>17} "
+        f"{'memory id (us)':>15} {'sqlite id (us)':>15}"
+    )
+    original_stores = project_lib.ACTIVITY_STORE, project_lib.WEATHER_STORE, project_lib.WEATHER_VERDICTS
+    try:
+        for size in sizes:
+            events = make_synthetic_calendar(size)
+            activity_id = events[size // 2]["activity_id"]
+            with tempfile.TemporaryDirectory() as tmp:
+                db_path = os.path.join(tmp, "calendar.db")
+                started = time.perf_counter()
+                import_calendar_to_sqlite(db_path, events)
+                imported = time.perf_counter() - started
+
+                timings = []
+                sqlite_source = SQLiteDataSource(db_path)
+                for source in (InMemoryDataSource(events), sqlite_source):
+                    project_lib.use_data_source(source)
+                    timings.append(
+                        _per_call_us(lambda: call_activities_api_mocked(date=QUERY_DATE, city="AgentsVille"), number)
+                    )
+                    timings.append(_per_call_us(lambda: call_activity_by_id_api_mocked(activity_id), number))
+                sqlite_source.pool.close_all()
+            print(
+                f"{size:>10} {imported:>11.3f} {timings[0]:>17.2f} {timings[2]:>17.2f} "
+                f"{timings[1]:>15.2f} {timings[3]:>15.2f}"
+            )
+    finally:
+        project_lib.ACTIVITY_STORE, project_lib.WEATHER_STORE, project_lib.WEATHER_VERDICTS = original_stores
+
+
+def make_recorded_react_session(steps: int) -> List[Dict[str, str]]:
+    """Build a ReAct revision session shaped like the notebook's run_react_cycle.
+
+    The session alternates THOUGHT/ACTION responses with OBSERVATIONs: full
+    activity lists for a date, then evaluation results, and revised plans
+    sent to run_evals_tool every third step.
+    """
+    days = []
+    for date in ("2025-06-10", "2025-06-11", "2025-06-12"):
+        forecast = project_lib.WEATHER_STORE.get(date, "AgentsVille").to_dict()
+        activities = [record.to_dict() for record in project_lib.ACTIVITY_STORE.query(date=date)[:2]]
+        days.append({
+            "date": date,
+            "weather": {key: forecast[key] for key in ("temperature", "temperature_unit", "condition")},
+            "activity_recommendations": [
+                {"activity": activity, "reasons_for_recommendation": ["Matches the travelers' interests."]}
+                for activity in activities
+            ],
+        })
+    plan = {"city": "AgentsVille", "start_date": "2025-06-10", "end_date": "2025-06-12", "total_cost": 0, "itinerary_days": days}
+    plan_json = json.dumps(plan)
+
+    messages = [
+        {"role": "system", "content": "You are a ReAct-style AI travel assistant. " * 150},
+        {"role": "user", "content": f"Here is the itinerary for revision:\n{plan_json}"},
+    ]
+    for step in range(steps):
+        date = days[step % len(days)]["date"]
+        if step % 3 == 2:
+            action = {"tool_name": "run_evals_tool", "arguments": {"travel_plan": plan}}
+            observation = json.dumps({"success": False, "failures": ["Activities that may be ruined by inclement weather: ..." * 4]})
+        else:
+            action = {"tool_name": "get_activities_by_date_tool", "arguments": {"date": date, "city": "AgentsVille"}}
+            observation = str(call_activities_api_mocked(date=date, city="AgentsVille"))
+        messages.append({"role": "assistant", "content": f"THOUGHT: Step {step}.\nACTION: {json.dumps(action)}"})
+        messages.append({"role": "user", "content": f"OBSERVATION: Tool {action['tool_name']} called successfully with response: {observation}"})
+    return messages
+
+
+def bench_history_compaction(steps: int, max_tokens: int) -> None:
+    """Print the estimated prompt tokens per ReAct step with and without a TokenBudgetPolicy."""
+    messages = make_recorded_react_session(steps)
+    policy = TokenBudgetPolicy(max_tokens=max_tokens)
+    print(f"{'step':>6} {'full (tokens)':>14} {'compacted (tokens)':>19}")
+    full_total = compacted_total = 0
+    for step in range(steps):
+        # The prompt of step n holds the system prompt, the plan and n earlier steps
+        context = messages[: 2 + 2 * step]
+        full = estimate_message_tokens(context)
+        compacted = estimate_message_tokens(policy.apply(context))
+        full_total += full
+        compacted_total += compacted
+        print(f"{step:>6} {full:>14} {compacted:>19}")
+    print(f"{'total':>6} {full_total:>14} {compacted_total:>19}")
+
+
+def bench_transcript_sinks(number: int) -> None:
+    """Print the latency of ChatAgent.add_message with a ReAct-sized message per transcript sink."""
+    observation = f"OBSERVATION: Tool run_evals_tool called successfully with response: {make_synthetic_calendar(8)}"
+    print(f"message size: {len(observation)} chars")
+    print(f"{'sink':>28} {'add_message (us)':>17}")
+    with tempfile.TemporaryDirectory() as tmp:
+        sinks = {
+            "TerminalSink": TerminalSink(),
+            "BufferedFileSink": BufferedFileSink(os.path.join(tmp, "transcript.txt")),
+            "BackgroundSink(FileSink)": BackgroundSink(BufferedFileSink(os.path.join(tmp, "background.txt"))),
+            "JsonlSink": JsonlSink(os.path.join(tmp, "transcript.jsonl")),
+            "NullSink": NullSink(),
+        }
+        for name, sink in sinks.items():
+            # Terminal output goes to a buffer, so this measures rendering, not the terminal
+            with contextlib.redirect_stdout(io.StringIO()):
+                agent = ChatAgent(name="Bench", transcript=sink)
+                latency = _per_call_us(lambda: agent.add_message("user", observation), number)
+            agent.messages = []
+            sink.close()
+            print(f"{name:>28} {latency:>17.2f}")
+
+
+def bench_prompt_encoding(number: int) -> None:
+    """Print the prompt tokens of the sample trip's candidates, as indented JSON and compactly encoded."""
+    namespace = load_notebook_evals()
+    info = SAMPLE_VACATION_INFO
+    dates = [(datetime.date(2025, 6, 10) + datetime.timedelta(days=i)).isoformat() for i in range(3)]
+
+    def encode_json() -> str:
+        activities = [a for date in dates for a in call_activities_api_mocked(date=date, city=info["destination"])]
+        weather = [call_weather_api_mocked(date=date, city=info["destination"]) for date in dates]
+        return json.dumps(activities, indent=2) + json.dumps(weather, indent=2)
+
+    encodings = {
+        "json (indent=2) + TravelPlan schema": (
+            encode_json,
+            json.dumps(namespace["TravelPlan"].model_json_schema(), indent=2),
+        ),
+        "compact + compact plan schema": (
+            lambda: encode_candidates_compact(info).text,
+            json.dumps(COMPACT_PLAN_RESPONSE_FORMAT["json_schema"]["schema"]),
+        ),
+    }
+    print(f"{'encoding':>36} {'data (tokens)':>14} {'schema (tokens)':>16} {'total':>7} {'encode (us)':>12}")
+    totals = []
+    for name, (encode, schema) in encodings.items():
+        data_tokens, schema_tokens = estimate_tokens(encode()), estimate_tokens(schema)
+        totals.append(data_tokens + schema_tokens)
+        latency = _per_call_us(encode, max(1, number // 10))
+        print(f"{name:>36} {data_tokens:>14} {schema_tokens:>16} {totals[-1]:>7} {latency:>12.2f}")
+    print(f"prompt token reduction: {1 - totals[1] / totals[0]:.1%}")
+
+    # The answer shrinks too: short IDs and reasons instead of full activity copies
+    plan = solve_itinerary(info)
+    compact = encode_candidates_compact(info)
+    short_ids = {record.activity_id: short_id for short_id, record in compact.activities.items()}
+    compact_answer = {"days": [
+        {
+            "date": day["date"],
+            "activities": [
+                {"id": short_ids[rec["activity"]["activity_id"]], "reasons": rec["reasons_for_recommendation"]}
+                for rec in day["activity_recommendations"]
+            ],
+        }
+        for day in plan["itinerary_days"]
+    ]}
+    full_tokens, compact_tokens = estimate_tokens(json.dumps(plan)), estimate_tokens(json.dumps(compact_answer))
+    print(f"answer tokens for the solved plan: TravelPlan {full_tokens}, compact {compact_tokens} "
+          f"({1 - compact_tokens / full_tokens:.1%} fewer)")
+
+
+def bench_prompt_caching(trips: int) -> None:
+    """Print provider prompt-cache hits and latency across trips, per system prompt layout.
+
+    Runs against the fake OpenAI backend, which simulates prefix caching and
+    charges first-token latency per uncached prompt token.
+    """
+    namespace = load_notebook_evals()
+    role = "You are an expert travel agent who plans day-by-day itineraries within budget."
+    task = "\n".join(
+        f"STEP {step}: Check the itinerary against the travelers' interests, the weather and the budget."
+        for step in range(1, 41)
+    )
+    schema = json.dumps(namespace["TravelPlan"].model_json_schema(), indent=2)
+    template = PromptTemplate(
+        static_sections=[("ROLE", role), ("TASK", task), ("TRAVELPLAN SCHEMA", schema)],
+        dynamic_sections=[("VACATION INFO", "${vacation_info}"), ("WEATHER", "${weather}")],
+    )
+
+    def trip(i: int) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+        info = dict(SAMPLE_VACATION_INFO, budget=100 + i)
+        dates = [f"2025-06-{10 + day}" for day in range(i % 3 + 1)]
+        return info, [call_weather_api_mocked(date=date, city="AgentsVille") for date in dates]
+
+    layouts = {
+        # Like the notebooks: trip data in the middle of the instructions
+        "interleaved": lambda info, weather: (
+            f"[ROLE]\n{role}\n\n[VACATION INFO]\n{json.dumps(info)}\n\n[WEATHER]\n{json.dumps(weather)}"
+            f"\n\n[TASK]\n{task}\n\n[TRAVELPLAN SCHEMA]\n{schema}"
+        ),
+        "PromptTemplate": lambda info, weather: template.render(vacation_info=info, weather=weather),
+    }
+    print(f"static prefix: {template.prefix_tokens} tokens, cacheable: {template.cacheable}")
+    print(f"{'layout':>16} {'prefix hits':>12} {'cached tokens':>14} {'p50 latency (ms)':>17}")
+    for name, render in layouts.items():
+        client = FakeOpenAIClient(latency=LatencyModel(median=0.02, per_prompt_token=10e-6))
+        metrics = ChatMetrics()
+        for i in range(trips):
+            info, weather = trip(i)
+            agent = ChatAgent(
+                system_prompt=render(info, weather), client=client, model="gpt-4.1", metrics=metrics, transcript=NullSink()
+            )
+            agent.chat("Plan the trip.")
+        report = metrics.prompt_cache_report(by="model")["gpt-4.1"]
+        latencies = sorted(call.latency for call in metrics.records)
+        print(
+            f"{name:>16} {report['prefix_hit_ratio']:>12.0%} {report['cached_token_ratio']:>14.0%} "
+            f"{latencies[(len(latencies) - 1) // 2] * 1000:>17.1f}"
+        )
+
+
+def make_synthetic_forecasts(n_days: int, first_day: datetime.date = datetime.date(2025, 6, 10)) -> List[Dict[str, Any]]:
+    """Build a synthetic forecast per day, shaped like WEATHER_FORECAST."""
+    conditions = ["clear", "cloudy", "rainy", "thunderstorm", "partly cloudy"]
+    return [
+        {
+            "date": (first_day + datetime.timedelta(days=i)).isoformat(),
+            "city": "AgentsVille",
+            "temperature": 20 + i % 15,
+            "temperature_unit": "celsius",
+            "condition": conditions[i % len(conditions)],
+            "description": "A synthetic forecast used for benchmarking.",
+        }
+        for i in range(n_days)
+    ]
+
+
+def load_notebook_evals(path: str = EVALS_NOTEBOOK) -> Dict[str, Any]:
+    """Load the imports, classes and functions defined in a notebook's code cells.
+
+    Only definitions are executed, so the cells' calls to the API and the
+    evals themselves do not run. Definitions that fail (e.g. they need a
+    client) are skipped.
+
+    Returns:
+        The namespace the definitions were executed in.
+    """
+    with open(path, encoding="utf-8") as f:
+        notebook = json.load(f)
+
+    namespace: Dict[str, Any] = {"__name__": "notebook_evals"}
+    for cell in notebook["cells"]:
+        if cell["cell_type"] != "code":
+            continue
+        source = "".join(cell["source"])
+        # Drop IPython magics and shell escapes
+        source = "\n".join(line for line in source.splitlines() if not line.lstrip().startswith(("%", "!")))
+        try:
+            tree = ast.parse(source)
+        except SyntaxError:
+            continue
+        for node in tree.body:
+            if isinstance(node, (ast.Import, ast.ImportFrom, ast.ClassDef, ast.FunctionDef)):
+                try:
+                    exec(compile(ast.Module(body=[node], type_ignores=[]), path, "exec", dont_inherit=True), namespace)
+                except Exception:
+                    continue
+    return namespace
+
+
+def make_synthetic_travel_plan(
+    namespace: Dict[str, Any], events: List[Dict[str, Any]], n_days: int = 3, per_day: int = 2
+) -> Tuple[Any, Any]:
+    """Build a VacationInfo and a TravelPlan passing the deterministic evals from the notebook's models."""
+    start = datetime.date.fromisoformat(events[0]["start_time"][:10])
+    days = []
+    for day in range(n_days):
+        date = start + datetime.timedelta(days=day)
+        activities = [event for event in events[day * EVENTS_PER_DAY : (day + 1) * EVENTS_PER_DAY]][:per_day]
+        days.append({
+            "date": date.isoformat(),
+            "weather": {"temperature": 25, "temperature_unit": "celsius", "condition": "clear"},
+            "activity_recommendations": [
+                {"activity": activity, "reasons_for_recommendation": ["Matches the travelers' interests."]}
+                for activity in activities
+            ],
+        })
+    total_cost = sum(rec["activity"]["price"] for day in days for rec in day["activity_recommendations"])
+    interests = sorted({interest for day in days for rec in day["activity_recommendations"] for interest in rec["activity"]["related_interests"]})
+    vacation_info = namespace["VacationInfo"].model_validate({
+        "travelers": [{"name": "Yuri", "age": 30, "interests": interests[:1]}, {"name": "Hiro", "age": 30, "interests": interests[-1:]}],
+        "destination": "AgentsVille",
+        "date_of_arrival": start.isoformat(),
+        "date_of_departure": days[-1]["date"],
+        "budget": total_cost + 100,
+    })
+    travel_plan = namespace["TravelPlan"].model_validate({
+        "city": "AgentsVille",
+        "start_date": start.isoformat(),
+        "end_date": days[-1]["date"],
+        "total_cost": total_cost,
+        "itinerary_days": days,
+    })
+    return vacation_info, travel_plan
+
+
+def run_suite(sizes: List[int], number: int) -> List[Dict[str, Any]]:
+    """Run the microbenchmark suite against synthetic calendars of each size.
+
+    Returns:
+        One result per benchmark and size, with its best-of-three mean
+        per-call latency in microseconds.
+    """
+    namespace = load_notebook_evals()
+    evals = {name: fn for name, fn in namespace.items() if name in DETERMINISTIC_EVALS}
+    missing = set(DETERMINISTIC_EVALS) - set(evals)
+    if missing:
+        print(f"warning: evals not found in {EVALS_NOTEBOOK}: {sorted(missing)}")
+
+    results = []
+
+    def measure(name: str, size: Optional[int], fn: Callable[[], Any], calls: int) -> None:
+        calls = max(1, calls)
+        # Rendering benchmarks print; measure the work, not the terminal
+        with contextlib.redirect_stdout(io.StringIO()):
+            latency = _per_call_us(fn, calls)
+        results.append({"name": name, "size": size, "per_call_us": round(latency, 3), "number": calls})
+        print(f"{name:>48} {size if size is not None else '-':>10} {latency:>14.2f}")
+
+    print(f"{'benchmark':>48} {'events':>10} {'per call (us)':>14}")
+    original_stores = project_lib.ACTIVITY_STORE, project_lib.WEATHER_STORE, project_lib.WEATHER_VERDICTS
+    try:
+        for size in sizes:
+            events = make_synthetic_calendar(size)
+            forecasts = make_synthetic_forecasts(max(1, -(-size // EVENTS_PER_DAY)))
+            project_lib.use_data_source(InMemoryDataSource(events, forecasts))
+            middle = events[size // 2]
+            date = middle["start_time"][:10]
+
+            measure("call_activities_api_mocked", size, lambda: call_activities_api_mocked(date=date, city="AgentsVille"), number)
+            measure("call_activity_by_id_api_mocked", size, lambda: call_activity_by_id_api_mocked(middle["activity_id"]), number)
+            measure("call_weather_api_mocked", size, lambda: call_weather_api_mocked(date=date, city="AgentsVille"), number)
+
+            if len(events) >= EVENTS_PER_DAY * 3:
+                vacation_info, travel_plan = make_synthetic_travel_plan(namespace, events)
+                for name, eval_fn in sorted(evals.items()):
+                    measure(name, size, lambda: eval_fn(vacation_info, travel_plan), number // 10)
+
+        # Rendering does not depend on the calendar size
+        observation = f"OBSERVATION: {make_synthetic_calendar(8)}"
+        measure("print_in_box", None, lambda: print_in_box(observation, "Bench"), number // 10)
+        with contextlib.redirect_stdout(io.StringIO()):
+            agent = ChatAgent(name="Bench", system_prompt="You are a benchmark. " * 50, transcript=TerminalSink())
+
+        def add_message() -> None:
+            agent.add_message("user", observation)
+            del agent.messages[1:]
+
+        measure("ChatAgent.add_message", None, add_message, number // 10)
+        measure("ChatAgent.reset", None, agent.reset, number // 10)
+    finally:
+        project_lib.ACTIVITY_STORE, project_lib.WEATHER_STORE, project_lib.WEATHER_VERDICTS = original_stores
+    return results
+
+
+def _environment() -> Dict[str, Any]:
+    """Describe the machine and code the suite ran on."""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "commit": commit,
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+    }
+
+
+def _result_key(result: Dict[str, Any]) -> str:
+    return result["name"] if result["size"] is None else f"{result['name']}[{result['size']}]"
+
+
+def compare_results(
+    results: List[Dict[str, Any]], baseline: List[Dict[str, Any]], threshold: float
+) -> List[str]:
+    """Print each benchmark's change against a baseline and return the regressions.
+
+    A benchmark regresses when its latency exceeds the baseline's by more
+    than threshold (a fraction, e.g. 0.25 for 25%).
+    """
+    baseline_by_key = {_result_key(result): result for result in baseline}
+    regressions = []
+    print(f"{'benchmark':>56} {'baseline (us)':>14} {'current (us)':>13} {'change':>8}")
+    for result in results:
+        key = _result_key(result)
+        reference = baseline_by_key.get(key)
+        if reference is None:
+            print(f"{key:>56} {'-':>14} {result['per_call_us']:>13.2f} {'new':>8}")
+            continue
+        change = result["per_call_us"] / max(reference["per_call_us"], 1e-9) - 1
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressions.append(key)
+        elif change < -threshold:
+            flag = "  improved"
+        print(f"{key:>56} {reference['per_call_us']:>14.2f} {result['per_call_us']:>13.2f} {change:>+8.1%}{flag}")
+    return regressions
+
+
+def main() -> None:
+    """Run the benchmarks from the command line."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--number", type=int, default=2000)
+    parser.add_argument("--large", action="store_true", help="add the multi-million event calendars to the report")
+    parser.add_argument("--suite", action="store_true", help="run the microbenchmark suite instead of the report")
+    parser.add_argument("--suite-sizes", type=int, nargs="+", default=SUITE_SIZES)
+    parser.add_argument("--json", metavar="PATH", help="write the suite results to PATH")
+    parser.add_argument("--compare", metavar="BASELINE", help="compare the suite results with a saved run")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="slowdown flagged as a regression")
+    args = parser.parse_args()
+
+    if args.suite or args.json or args.compare:
+        results = run_suite(args.suite_sizes, args.number)
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump({"environment": _environment(), "results": results}, f, indent=2)
+        if args.compare:
+            with open(args.compare, encoding="utf-8") as f:
+                baseline = json.load(f)["results"]
+            print(f"\nCompared with {args.compare} (threshold {args.threshold:.0%})")
+            regressions = compare_results(results, baseline, args.threshold)
+            if regressions:
+                print(f"\n{len(regressions)} regression(s): {', '.join(regressions)}")
+                sys.exit(1)
+        return
+
+    print("call_activities_api_mocked(date=..., city=...)")
+    bench_call_activities_api_mocked(args.sizes, args.number)
+
+    print("\nscore_interest_coverage(travelers, 100 activities)")
+    bench_score_interest_coverage([2, 12, 48], 100, args.number)
+
+    print("\nColumnarActivityCalendar.query(date window, price, interests, city, not outdoors)")
+    if project_lib.NUMPY_AVAILABLE:
+        bench_columnar_query(COLUMNAR_LARGE_SIZES if args.large else COLUMNAR_SIZES, 20)
+    else:
+        print("skipped: NumPy is not installed")
+
+    print("\nActivityStore load time per data source")
+    bench_data_sources([10_000, 100_000])
+
+    print("\nIn-memory vs SQLite backend per API call")
+    bench_sqlite_backend(SQLITE_LARGE_SIZES if args.large else SQLITE_SIZES, args.number)
+
+    print("\nEstimated prompt tokens per ReAct step, full history vs TokenBudgetPolicy(max_tokens=6000)")
+    bench_history_compaction(12, 6000)
+
+    print("\nChatAgent.add_message per transcript sink")
+    bench_transcript_sinks(max(1, args.number // 4))
+
+    print("\nItineraryAgent prompt data for the sample trip, JSON vs compact encoding")
+    bench_prompt_encoding(args.number)
+
+    print("\nProvider prompt caching across 20 trips, interleaved prompt vs PromptTemplate (fake API)")
+    bench_prompt_caching(20)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,872 @@
+#!/usr/bin/env python3
+"""A local stand-in for the OpenAI API, for offline benchmarks and load tests.
+
+Implements the subset of the API the planner uses: chat completions (plain,
+streamed and the beta parse path for structured outputs) and text-to-speech.
+Responses are scripted or rule-based. Latency follows a configurable
+distribution, errors can be injected, and token usage is accounted for the
+same way as project_lib estimates it, including prompt caching.
+
+Use the fake clients in-process:
+
+    >>> from project_lib import ChatAgent, set_default_transcript_sink, NullSink
+    >>> set_default_transcript_sink(NullSink())
+    >>> client = FakeOpenAIClient(responder=ScriptedResponder(["Hello!"]))
+    >>> ChatAgent(client=client, model="gpt-4.1-mini").chat("Hi")
+    'Hello!'
+
+or run the HTTP server and point a real OpenAI client at it:
+
+    python fake_openai.py --port 8000 --latency-median 0.5 --rate-limit-rate 0.05
+
+    client = OpenAI(base_url="http://127.0.0.1:8000/v1", api_key="fake")
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import hashlib
+import io
+import itertools
+import json
+import math
+import random
+import re
+import threading
+import time
+import wave
+from collections import OrderedDict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+from project_lib import CHARS_PER_TOKEN, PROMPT_CACHE_MIN_TOKENS, RateLimits, estimate_message_tokens, estimate_tokens
+
+try:
+    import httpx
+    import openai
+
+    OPENAI_AVAILABLE = True
+except ImportError:
+    OPENAI_AVAILABLE = False
+
+# A date inside the AgentsVille calendar, for date fields of structured outputs
+FAKE_DATE = "2025-06-10"
+# Cached prompt prefixes are counted in increments of 128 tokens
+PROMPT_CACHE_INCREMENT = 128
+PROMPT_CACHE_MAX_ENTRIES = 100_000
+SPEECH_SAMPLE_RATE = 8_000
+SPEECH_WORDS_PER_SECOND = 2.5
+
+Responder = Callable[[str, List[Dict[str, str]], Dict[str, Any]], str]
+
+
+class LatencyModel(NamedTuple):
+    """The latency of a fake completion.
+
+    The time to the first token is log-normally distributed around a median
+    (fixed if sigma is 0), plus a delay per prompt token not served from the
+    prompt cache. Each output token then adds a fixed delay.
+    """
+
+    median: float = 0.0
+    sigma: float = 0.0
+    per_output_token: float = 0.0
+    per_prompt_token: float = 0.0
+
+    def time_to_first_token(self, rng: random.Random, uncached_prompt_tokens: int = 0) -> float:
+        """Sample the delay before the first token, in seconds."""
+        prefill = self.per_prompt_token * uncached_prompt_tokens
+        if self.median <= 0:
+            return prefill
+        if self.sigma <= 0:
+            return self.median + prefill
+        return rng.lognormvariate(math.log(self.median), self.sigma) + prefill
+
+
+class FaultInjection(NamedTuple):
+    """The errors a fake backend injects.
+
+    Attributes:
+        rate_limit_rate: The probability of a 429 response.
+        server_error_rate: The probability of a 500 response.
+        retry_after: The retry-after of injected 429s, in seconds, or None to
+            omit the header.
+        fail_first: The number of initial requests answered with a 429,
+            before any random errors.
+    """
+
+    rate_limit_rate: float = 0.0
+    server_error_rate: float = 0.0
+    retry_after: Optional[float] = 1.0
+    fail_first: int = 0
+
+
+class FakeError(NamedTuple):
+    """An error response decided by the backend."""
+
+    status_code: int
+    message: str
+    retry_after: Optional[float] = None
+
+
+class FakeCompletion(NamedTuple):
+    """A completion decided by the backend, before latency is applied."""
+
+    id: str
+    model: str
+    content: str
+    parsed: Any
+    prompt_tokens: int
+    completion_tokens: int
+    cached_tokens: int
+    time_to_first_token: float
+    per_output_token: float
+
+    def pieces(self) -> List[str]:
+        """Split the content into the deltas of a stream, about a word each."""
+        return re.findall(r"\s*\S+\s*|\s+", self.content) or [""]
+
+    def usage(self) -> Dict[str, Any]:
+        """Return the usage of the completion, as the API reports it."""
+        return {
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "total_tokens": self.prompt_tokens + self.completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": self.cached_tokens},
+        }
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Return the completion as a chat.completion API object."""
+        return {
+            "id": self.id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": self.model,
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": self.content, "refusal": None},
+                    "finish_reason": "stop",
+                    "logprobs": None,
+                }
+            ],
+            "usage": self.usage(),
+        }
+
+    def chunk_dicts(self, include_usage: bool = False) -> Iterator[Dict[str, Any]]:
+        """Yield the completion as chat.completion.chunk API objects."""
+        base = {"id": self.id, "object": "chat.completion.chunk", "created": int(time.time()), "model": self.model}
+        for i, piece in enumerate(self.pieces()):
+            delta = {"role": "assistant", "content": piece} if i == 0 else {"content": piece}
+            yield {**base, "choices": [{"index": 0, "delta": delta, "finish_reason": None}], "usage": None}
+        yield {**base, "choices": [{"index": 0, "delta": {"content": None}, "finish_reason": "stop"}], "usage": None}
+        if include_usage:
+            yield {**base, "choices": [], "usage": self.usage()}
+
+
+def example_from_schema(schema: Dict[str, Any], root: Optional[Dict[str, Any]] = None) -> Any:
+    """Build a minimal value valid against a JSON schema.
+
+    Supports the subset pydantic and strict structured outputs produce:
+    $ref/$defs, anyOf/oneOf/allOf, enum, const, defaults, objects, arrays and
+    the scalar types, with dates for the date and date-time formats.
+    """
+    root = schema if root is None else root
+    if "$ref" in schema:
+        target: Any = root
+        for part in schema["$ref"].lstrip("#/").split("/"):
+            target = target[part]
+        return example_from_schema(target, root)
+    if "const" in schema:
+        return schema["const"]
+    if "enum" in schema:
+        return schema["enum"][0]
+    if "default" in schema:
+        return schema["default"]
+    for key in ("anyOf", "oneOf"):
+        if key in schema:
+            options = [option for option in schema[key] if option.get("type") != "null"] or schema[key]
+            return example_from_schema(options[0], root)
+    if "allOf" in schema:
+        return example_from_schema(schema["allOf"][0], root)
+
+    schema_type = schema.get("type", "object")
+    if isinstance(schema_type, list):
+        schema_type = next((t for t in schema_type if t != "null"), "null")
+    if schema_type == "object":
+        return {name: example_from_schema(prop, root) for name, prop in schema.get("properties", {}).items()}
+    if schema_type == "array":
+        item = example_from_schema(schema.get("items", {}), root)
+        return [item] * max(1, schema.get("minItems", 1))
+    if schema_type == "string":
+        if schema.get("format") == "date":
+            return FAKE_DATE
+        if schema.get("format") == "date-time":
+            return f"{FAKE_DATE}T09:00:00"
+        return "example".ljust(schema.get("minLength", 0), "x")
+    if schema_type == "integer":
+        return int(schema.get("minimum", 0))
+    if schema_type == "number":
+        return float(schema.get("minimum", 0.0))
+    if schema_type == "boolean":
+        return True
+    return None
+
+
+def _response_schema(response_format: Any) -> Optional[Dict[str, Any]]:
+    """Return the JSON schema of a response_format (a pydantic class or a dict), if any."""
+    if isinstance(response_format, type) and hasattr(response_format, "model_json_schema"):
+        return response_format.model_json_schema()
+    if isinstance(response_format, dict):
+        if response_format.get("type") == "json_schema":
+            return response_format.get("json_schema", {}).get("schema", {})
+        if response_format.get("type") == "json_object":
+            return {"type": "object", "properties": {}}
+    return None
+
+
+def default_responder(model: str, messages: List[Dict[str, str]], kwargs: Dict[str, Any]) -> str:
+    """Answer structured requests with a schema-valid example and others with an echo."""
+    schema = _response_schema(kwargs.get("response_format"))
+    if schema is not None:
+        return json.dumps(example_from_schema(schema))
+    last = messages[-1]["content"] if messages else ""
+    return f"This is a fake response to: {' '.join(str(last).split())[:200]}"
+
+
+class ScriptedResponder:
+    """Answer requests with scripted responses, in order.
+
+    Thread-safe, so concurrent sessions share one script.
+    """
+
+    def __init__(self, responses: Sequence[str], cycle: bool = True) -> None:
+        """Initialize the ScriptedResponder.
+
+        Args:
+            responses: The responses, in order.
+            cycle: Whether to start over after the last response. Otherwise
+                the last response is repeated.
+        """
+        if not responses:
+            raise ValueError("At least one response is required.")
+        self.responses = list(responses)
+        self.cycle = cycle
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, model: str, messages: List[Dict[str, str]], kwargs: Dict[str, Any]) -> str:
+        with self._lock:
+            index = self._next
+            self._next += 1
+        if self.cycle:
+            return self.responses[index % len(self.responses)]
+        return self.responses[min(index, len(self.responses) - 1)]
+
+
+class RuleResponder:
+    """Answer requests by the first rule whose pattern matches the last message."""
+
+    def __init__(
+        self,
+        rules: Sequence[Tuple[str, Union[str, Responder]]],
+        default: Responder = default_responder,
+    ) -> None:
+        """Initialize the RuleResponder.
+
+        Args:
+            rules: (regex, response) pairs. A response is a string or a
+                responder called with the request.
+            default: The responder for requests no rule matches.
+        """
+        self.rules = [(re.compile(pattern, re.DOTALL), response) for pattern, response in rules]
+        self.default = default
+
+    def __call__(self, model: str, messages: List[Dict[str, str]], kwargs: Dict[str, Any]) -> str:
+        last = str(messages[-1]["content"]) if messages else ""
+        for pattern, response in self.rules:
+            if pattern.search(last):
+                return response if isinstance(response, str) else response(model, messages, kwargs)
+        return self.default(model, messages, kwargs)
+
+
+class FakeOpenAIBackend:
+    """The shared core of the fake clients and server.
+
+    Decides each request's outcome: an injected or rate-limit error, or a
+    completion with its token usage and latency. Prompt caching is simulated:
+    the longest prompt prefix seen before counts as cached, from 1024 tokens
+    in increments of 128.
+
+    Attributes:
+        stats (Dict[str, int]): Counts of requests, errors by kind and tokens.
+    """
+
+    def __init__(
+        self,
+        responder: Optional[Responder] = None,
+        latency: LatencyModel = LatencyModel(),
+        faults: FaultInjection = FaultInjection(),
+        rate_limits: Optional[RateLimits] = None,
+        seed: Optional[int] = None,
+    ) -> None:
+        """Initialize the FakeOpenAIBackend.
+
+        Args:
+            responder: Produces the content of each completion. Defaults to
+                default_responder.
+            latency: The latency distribution.
+            faults: The errors to inject.
+            rate_limits: Limits enforced like the API does, over a sliding
+                minute, answering 429 with the time until capacity frees up.
+            seed: The seed of the latency and fault sampling.
+        """
+        self.responder = responder or default_responder
+        self.latency = latency
+        self.faults = faults
+        self.rate_limits = rate_limits
+        self.stats = {
+            "requests": 0,
+            "rate_limited": 0,
+            "server_errors": 0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "cached_tokens": 0,
+            "speech_requests": 0,
+        }
+        self._rng = random.Random(seed)
+        self._ids = itertools.count(1)
+        self._window: deque = deque()
+        self._prefixes: "OrderedDict[str, None]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _cached_tokens(self, model: str, messages: List[Dict[str, str]], prompt_tokens: int) -> int:
+        """Return the cached prompt tokens of a request and cache its prefixes.
+
+        The prompt is hashed in blocks of PROMPT_CACHE_INCREMENT tokens; the
+        cached tokens are the blocks of the longest prefix seen before.
+        """
+        text = "".join(f"{message.get('role')}\n{message.get('content')}\n" for message in messages)
+        block = PROMPT_CACHE_INCREMENT * CHARS_PER_TOKEN
+        digest = hashlib.sha256(model.encode())
+        cached_blocks = 0
+        hit = True
+        for start in range(0, len(text) - block + 1, block):
+            digest.update(text[start : start + block].encode())
+            key = digest.hexdigest()
+            if hit and key in self._prefixes:
+                self._prefixes.move_to_end(key)
+                cached_blocks += 1
+            else:
+                hit = False
+                self._prefixes[key] = None
+        while len(self._prefixes) > PROMPT_CACHE_MAX_ENTRIES:
+            self._prefixes.popitem(last=False)
+
+        cached = min(cached_blocks * PROMPT_CACHE_INCREMENT, prompt_tokens)
+        return cached if cached >= PROMPT_CACHE_MIN_TOKENS else 0
+
+    def _rate_limit_wait(self, tokens: int, now: float) -> float:
+        """Admit a request under the rate limits, or return the seconds until it would be."""
+        while self._window and now - self._window[0][0] >= 60:
+            self._window.popleft()
+        used = sum(window_tokens for _, window_tokens in self._window)
+        if len(self._window) < self.rate_limits.requests_per_minute and used + tokens <= self.rate_limits.tokens_per_minute:
+            self._window.append((now, tokens))
+            return 0.0
+        return max(0.001, 60 - (now - self._window[0][0])) if self._window else 60.0
+
+    def _draw_fault(self) -> Optional[FakeError]:
+        """Decide whether to inject an error. Must be called with the lock held."""
+        if self.stats["requests"] <= self.faults.fail_first:
+            return FakeError(429, "Rate limit reached (injected).", self.faults.retry_after)
+        draw = self._rng.random()
+        if draw < self.faults.rate_limit_rate:
+            return FakeError(429, "Rate limit reached (injected).", self.faults.retry_after)
+        if draw < self.faults.rate_limit_rate + self.faults.server_error_rate:
+            return FakeError(500, "The server had an error processing your request (injected).")
+        return None
+
+    def complete(
+        self, model: str, messages: List[Dict[str, str]], kwargs: Dict[str, Any]
+    ) -> Union[FakeCompletion, FakeError]:
+        """Decide the outcome of a chat completion request."""
+        prompt_tokens = estimate_message_tokens(messages)
+        with self._lock:
+            self.stats["requests"] += 1
+            error = self._draw_fault()
+            if error is None and self.rate_limits is not None:
+                wait = self._rate_limit_wait(prompt_tokens, time.monotonic())
+                if wait > 0:
+                    error = FakeError(429, f"Rate limit reached for {model}.", round(wait, 3))
+            if error is not None:
+                self.stats["rate_limited" if error.status_code == 429 else "server_errors"] += 1
+                return error
+            cached_tokens = self._cached_tokens(model, messages, prompt_tokens)
+            time_to_first_token = self.latency.time_to_first_token(self._rng, prompt_tokens - cached_tokens)
+            completion_id = f"chatcmpl-fake-{next(self._ids)}"
+
+        content = self.responder(model, messages, kwargs)
+        parsed = None
+        response_format = kwargs.get("response_format")
+        if isinstance(response_format, type) and hasattr(response_format, "model_validate_json"):
+            parsed = response_format.model_validate_json(content)
+
+        completion_tokens = estimate_tokens(content)
+        with self._lock:
+            self.stats["prompt_tokens"] += prompt_tokens
+            self.stats["completion_tokens"] += completion_tokens
+            self.stats["cached_tokens"] += cached_tokens
+        return FakeCompletion(
+            completion_id,
+            model,
+            content,
+            parsed,
+            prompt_tokens,
+            completion_tokens,
+            cached_tokens,
+            time_to_first_token,
+            self.latency.per_output_token,
+        )
+
+    def speech(self, text: str) -> Tuple[bytes, float]:
+        """Return a silent WAV narration as long as reading text aloud, and its latency."""
+        with self._lock:
+            self.stats["speech_requests"] += 1
+            latency = self.latency.time_to_first_token(self._rng)
+        seconds = max(1, round(len(text.split()) / SPEECH_WORDS_PER_SECOND))
+        buffer = io.BytesIO()
+        with wave.open(buffer, "wb") as wav:
+            wav.setnchannels(1)
+            wav.setsampwidth(1)
+            wav.setframerate(SPEECH_SAMPLE_RATE)
+            wav.writeframes(b"\x80" * (SPEECH_SAMPLE_RATE * seconds))
+        return buffer.getvalue(), latency
+
+
+class FakeAPIError(Exception):
+    """An API error shaped like the OpenAI SDK's, used when openai is not installed."""
+
+    def __init__(self, message: str, status_code: int, headers: Dict[str, str]) -> None:
+        super().__init__(message)
+        self.status_code = status_code
+        self.response = SimpleNamespace(status_code=status_code, headers=headers)
+
+
+def _raise_api_error(error: FakeError) -> None:
+    """Raise an error the way the OpenAI SDK would."""
+    headers = {}
+    if error.retry_after is not None:
+        headers = {"retry-after": str(math.ceil(error.retry_after)), "retry-after-ms": str(int(error.retry_after * 1000))}
+    if not OPENAI_AVAILABLE:
+        raise FakeAPIError(error.message, error.status_code, headers)
+
+    request = httpx.Request("POST", "http://fake-openai/v1/chat/completions")
+    response = httpx.Response(error.status_code, headers=headers, request=request)
+    error_type = openai.RateLimitError if error.status_code == 429 else openai.InternalServerError
+    raise error_type(error.message, response=response, body={"message": error.message})
+
+
+def _namespace(value: Any) -> Any:
+    """Convert an API object dict to attribute access, like the SDK's models."""
+    if isinstance(value, dict):
+        return SimpleNamespace(**{key: _namespace(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return [_namespace(item) for item in value]
+    return value
+
+
+def _completion_object(completion: FakeCompletion) -> Any:
+    """Return a completion as an SDK-like response object, with parsed set."""
+    response = _namespace(completion.to_dict())
+    response.choices[0].message.parsed = completion.parsed
+    return response
+
+
+def _include_usage(kwargs: Dict[str, Any]) -> bool:
+    return bool((kwargs.get("stream_options") or {}).get("include_usage"))
+
+
+class FakeSpeechResponse:
+    """A text-to-speech response, usable as the SDK's binary and streamed responses."""
+
+    def __init__(self, content: bytes) -> None:
+        self.content = content
+
+    def read(self) -> bytes:
+        return self.content
+
+    def iter_bytes(self, chunk_size: int = 1 << 14) -> Iterator[bytes]:
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start : start + chunk_size]
+
+    def stream_to_file(self, file: str) -> None:
+        with open(file, "wb") as f:
+            f.write(self.content)
+
+    def write_to_file(self, file: str) -> None:
+        self.stream_to_file(file)
+
+    def __enter__(self) -> "FakeSpeechResponse":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        return None
+
+
+class FakeOpenAIClient:
+    """An in-process stand-in for openai.OpenAI.
+
+    Supports chat.completions.create (also streamed), beta.chat.completions.parse
+    and audio.speech.create / audio.speech.with_streaming_response.create.
+    Latency is slept in the calling thread. The speech endpoints return WAV
+    audio whatever the requested format.
+
+    Attributes:
+        backend (FakeOpenAIBackend): The backend deciding the responses.
+    """
+
+    def __init__(self, backend: Optional[FakeOpenAIBackend] = None, **backend_kwargs: Any) -> None:
+        """Initialize the FakeOpenAIClient.
+
+        Args:
+            backend: A backend to share with other clients or a server.
+            **backend_kwargs: Arguments for a new FakeOpenAIBackend, if no
+                backend is given.
+        """
+        self.backend = backend or FakeOpenAIBackend(**backend_kwargs)
+        completions = SimpleNamespace(create=self._create, parse=self._parse)
+        self.chat = SimpleNamespace(completions=completions)
+        self.beta = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+        self.audio = SimpleNamespace(
+            speech=SimpleNamespace(
+                create=self._speech,
+                with_streaming_response=SimpleNamespace(create=self._speech),
+            )
+        )
+
+    def _create(
+        self, model: str, messages: List[Dict[str, str]], stream: bool = False, **kwargs: Any
+    ) -> Any:
+        completion = self.backend.complete(model, messages, kwargs)
+        if isinstance(completion, FakeError):
+            _raise_api_error(completion)
+        if stream:
+            return self._stream(completion, _include_usage(kwargs))
+        time.sleep(completion.time_to_first_token + completion.per_output_token * completion.completion_tokens)
+        return _completion_object(completion)
+
+    def _stream(self, completion: FakeCompletion, include_usage: bool) -> Iterator[Any]:
+        time.sleep(completion.time_to_first_token)
+        pieces = completion.pieces()
+        per_piece = completion.per_output_token * completion.completion_tokens / len(pieces)
+        for chunk in completion.chunk_dicts(include_usage):
+            yield _namespace(chunk)
+            if chunk["choices"] and chunk["choices"][0]["finish_reason"] is None:
+                time.sleep(per_piece)
+
+    def _parse(self, model: str, messages: List[Dict[str, str]], **kwargs: Any) -> Any:
+        return self._create(model, messages, **kwargs)
+
+    def _speech(self, model: str, voice: str, input: str, **kwargs: Any) -> FakeSpeechResponse:
+        content, latency = self.backend.speech(input)
+        time.sleep(latency)
+        return FakeSpeechResponse(content)
+
+
+class AsyncFakeSpeechResponse(FakeSpeechResponse):
+    """A text-to-speech response, usable as the async SDK's responses."""
+
+    async def read(self) -> bytes:  # type: ignore[override]
+        return self.content
+
+    async def iter_bytes(self, chunk_size: int = 1 << 14) -> AsyncIterator[bytes]:  # type: ignore[override]
+        for chunk in FakeSpeechResponse.iter_bytes(self, chunk_size):
+            yield chunk
+
+    async def stream_to_file(self, file: str) -> None:  # type: ignore[override]
+        FakeSpeechResponse.stream_to_file(self, file)
+
+    async def __aenter__(self) -> "AsyncFakeSpeechResponse":
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        return None
+
+
+class _AsyncSpeechRequest:
+    """An awaitable and async context manager, like the async SDK's speech calls."""
+
+    def __init__(self, client: "AsyncFakeOpenAIClient", text: str) -> None:
+        self._client = client
+        self._text = text
+
+    async def _send(self) -> AsyncFakeSpeechResponse:
+        content, latency = self._client.backend.speech(self._text)
+        await asyncio.sleep(latency)
+        return AsyncFakeSpeechResponse(content)
+
+    def __await__(self):
+        return self._send().__await__()
+
+    async def __aenter__(self) -> AsyncFakeSpeechResponse:
+        return await self._send()
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        return None
+
+
+class AsyncFakeOpenAIClient:
+    """An in-process stand-in for openai.AsyncOpenAI.
+
+    The async counterpart of FakeOpenAIClient. Latency is awaited, so many
+    requests overlap on one event loop.
+
+    Attributes:
+        backend (FakeOpenAIBackend): The backend deciding the responses.
+    """
+
+    def __init__(self, backend: Optional[FakeOpenAIBackend] = None, **backend_kwargs: Any) -> None:
+        """Initialize the AsyncFakeOpenAIClient.
+
+        Args:
+            backend: A backend to share with other clients or a server.
+            **backend_kwargs: Arguments for a new FakeOpenAIBackend, if no
+                backend is given.
+        """
+        self.backend = backend or FakeOpenAIBackend(**backend_kwargs)
+        completions = SimpleNamespace(create=self._create, parse=self._parse)
+        self.chat = SimpleNamespace(completions=completions)
+        self.beta = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+        self.audio = SimpleNamespace(
+            speech=SimpleNamespace(
+                create=self._speech,
+                with_streaming_response=SimpleNamespace(create=self._speech),
+            )
+        )
+
+    async def _create(
+        self, model: str, messages: List[Dict[str, str]], stream: bool = False, **kwargs: Any
+    ) -> Any:
+        completion = self.backend.complete(model, messages, kwargs)
+        if isinstance(completion, FakeError):
+            _raise_api_error(completion)
+        if stream:
+            return self._stream(completion, _include_usage(kwargs))
+        await asyncio.sleep(completion.time_to_first_token + completion.per_output_token * completion.completion_tokens)
+        return _completion_object(completion)
+
+    async def _stream(self, completion: FakeCompletion, include_usage: bool) -> AsyncIterator[Any]:
+        await asyncio.sleep(completion.time_to_first_token)
+        pieces = completion.pieces()
+        per_piece = completion.per_output_token * completion.completion_tokens / len(pieces)
+        for chunk in completion.chunk_dicts(include_usage):
+            yield _namespace(chunk)
+            if chunk["choices"] and chunk["choices"][0]["finish_reason"] is None:
+                await asyncio.sleep(per_piece)
+
+    async def _parse(self, model: str, messages: List[Dict[str, str]], **kwargs: Any) -> Any:
+        return await self._create(model, messages, **kwargs)
+
+    def _speech(self, model: str, voice: str, input: str, **kwargs: Any) -> _AsyncSpeechRequest:
+        return _AsyncSpeechRequest(self, input)
+
+
+class _FakeOpenAIHandler(BaseHTTPRequestHandler):
+    """Serve the chat completion and speech endpoints from the server's backend."""
+
+    server: "_FakeHTTPServer"
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format: str, *args: Any) -> None:
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _send_json(self, status: int, body: Dict[str, Any], headers: Optional[Dict[str, str]] = None) -> None:
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _send_error(self, error: FakeError) -> None:
+        headers = {}
+        if error.retry_after is not None:
+            headers = {"retry-after": str(math.ceil(error.retry_after)), "retry-after-ms": str(int(error.retry_after * 1000))}
+        kind = "rate_limit_exceeded" if error.status_code == 429 else "server_error"
+        self._send_json(error.status_code, {"error": {"message": error.message, "type": kind, "code": kind}}, headers)
+
+    def do_GET(self) -> None:
+        if self.path.rstrip("/") == "/v1/models":
+            self._send_json(200, {"object": "list", "data": []})
+        else:
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+
+    def do_POST(self) -> None:
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except json.JSONDecodeError:
+            self._send_json(400, {"error": {"message": "Invalid JSON body.", "type": "invalid_request_error"}})
+            return
+
+        path = self.path.rstrip("/")
+        if path == "/v1/chat/completions":
+            self._chat_completion(body)
+        elif path == "/v1/audio/speech":
+            content, latency = self.server.backend.speech(str(body.get("input", "")))
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header("Content-Type", "audio/wav")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+        else:
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+
+    def _chat_completion(self, body: Dict[str, Any]) -> None:
+        model = body.pop("model", "fake")
+        messages = body.pop("messages", [])
+        stream = body.pop("stream", False)
+        completion = self.server.backend.complete(model, messages, body)
+        if isinstance(completion, FakeError):
+            self._send_error(completion)
+            return
+
+        if not stream:
+            time.sleep(completion.time_to_first_token + completion.per_output_token * completion.completion_tokens)
+            self._send_json(200, completion.to_dict())
+            return
+
+        # Server-sent events, without a length, so the connection closes after
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        time.sleep(completion.time_to_first_token)
+        per_piece = completion.per_output_token * completion.completion_tokens / len(completion.pieces())
+        for chunk in completion.chunk_dicts(_include_usage(body)):
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            self.wfile.flush()
+            if chunk["choices"] and chunk["choices"][0]["finish_reason"] is None:
+                time.sleep(per_piece)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+
+class _FakeHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], backend: FakeOpenAIBackend, verbose: bool) -> None:
+        super().__init__(address, _FakeOpenAIHandler)
+        self.backend = backend
+        self.verbose = verbose
+
+
+class FakeOpenAIServer:
+    """An OpenAI-compatible HTTP server backed by a FakeOpenAIBackend.
+
+    Serves POST /v1/chat/completions (with server-sent events when streamed)
+    and POST /v1/audio/speech, one thread per connection.
+
+    Examples:
+        >>> with FakeOpenAIServer(FakeOpenAIBackend()) as server:  # doctest: +SKIP
+        ...     client = openai.OpenAI(base_url=server.base_url, api_key="fake")
+    """
+
+    def __init__(
+        self,
+        backend: Optional[FakeOpenAIBackend] = None,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        verbose: bool = False,
+    ) -> None:
+        """Initialize the FakeOpenAIServer and bind its socket.
+
+        Args:
+            backend: The backend deciding the responses. Defaults to a new one.
+            host: The interface to listen on.
+            port: The port to listen on, or 0 for any free port.
+            verbose: Whether to log each request.
+        """
+        self.backend = backend or FakeOpenAIBackend()
+        self._server = _FakeHTTPServer((host, port), self.backend, verbose)
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        """The base URL to give an OpenAI client."""
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "FakeOpenAIServer":
+        """Serve requests in a background thread."""
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self) -> None:
+        """Serve requests in the calling thread."""
+        self._server.serve_forever()
+
+    def stop(self) -> None:
+        """Stop serving and close the socket."""
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._server.server_close()
+
+    def __enter__(self) -> "FakeOpenAIServer":
+        return self.start()
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.stop()
+
+
+def main() -> None:
+    """Run the fake OpenAI server."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency-median", type=float, default=0.0, help="median time to first token, in seconds")
+    parser.add_argument("--latency-sigma", type=float, default=0.0, help="log-normal sigma of the time to first token")
+    parser.add_argument("--per-output-token", type=float, default=0.0, help="seconds per output token")
+    parser.add_argument("--per-prompt-token", type=float, default=0.0, help="seconds per uncached prompt token")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="probability of an injected 429")
+    parser.add_argument("--server-error-rate", type=float, default=0.0, help="probability of an injected 500")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="retry-after of injected 429s, in seconds")
+    parser.add_argument("--rpm", type=int, default=None, help="requests per minute to enforce")
+    parser.add_argument("--tpm", type=int, default=None, help="tokens per minute to enforce")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    rate_limits = None
+    if args.rpm is not None or args.tpm is not None:
+        rate_limits = RateLimits(args.rpm or 10**9, args.tpm or 10**12)
+    backend = FakeOpenAIBackend(
+        latency=LatencyModel(args.latency_median, args.latency_sigma, args.per_output_token, args.per_prompt_token),
+        faults=FaultInjection(args.rate_limit_rate, args.server_error_rate, args.retry_after),
+        rate_limits=rate_limits,
+        seed=args.seed,
+    )
+    server = FakeOpenAIServer(backend, args.host, args.port, args.verbose)
+    print(f"Fake OpenAI API listening on {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+        print(json.dumps(backend.stats, indent=2))
+
+
+if __name__ == "__main__":
+    main()
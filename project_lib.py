@@ -6,10 +6,54 @@ activity data, weather information, and trip narration functionality.
 
 from __future__ import annotations
 
+import asyncio
+import bisect
+import contextvars
+import csv
 import datetime
+import email.utils
+import hashlib
+import heapq
+import itertools
+import json
+import logging
+import os
+import queue
+import random
+import re
+import sqlite3
+import string
 import textwrap
+import threading
+import time
+import weakref
+from collections import Counter, OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager, nullcontext, suppress
 from enum import Enum
-from typing import Any, Dict, List, Optional, Union
+from typing import (
+    AbstractSet,
+    Any,
+    Callable,
+    Dict,
+    Hashable,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
+
+# Optional NumPy import
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+    np = None
 
 # Optional IPython imports
 try:
@@ -21,12 +65,16 @@ except ImportError:
     Markdown = None
     display = None
 
+logger = logging.getLogger(__name__)
+
 # Constants
 SINGLE_TAB_LEVEL = 4
 DEFAULT_BOX_WIDTH = 120
 DEFAULT_AUDIO_FILENAME = "/tmp/my_trip_narration.mp3"
 DEFAULT_TTS_MODEL = "gpt-4o-mini-tts"
 DEFAULT_TTS_VOICE = "coral"
+DEFAULT_CITY = "AgentsVille"
+DEFAULT_ASYNC_CONCURRENCY = 32
 
 
 class Interest(str, Enum):
@@ -61,252 +109,2389 @@ class Interest(str, Enum):
         """Return the string representation of the interest."""
         return self.value
 
+    @property
+    def bit(self) -> int:
+        """Return the single-bit mask of the interest."""
+        return _INTEREST_BITS[self.value]
 
-class ChatAgent:
-    """A chat agent that interacts with OpenAI's API to facilitate conversations.
 
-    This class manages chat history, formats system prompts, and handles
-    communication with OpenAI's chat completion API. It provides methods to
-    add messages, get responses, and maintain conversation context.
+# Bit assigned to each interest value, in enum definition order
+_INTEREST_BITS: Dict[str, int] = {
+    interest.value: 1 << position for position, interest in enumerate(Interest)
+}
+
+
+def interests_to_mask(interests: Iterable[Union[str, Interest]], strict: bool = True) -> int:
+    """Encode a collection of interests as an integer bitmask.
+
+    Args:
+        interests: The interests to encode, as Interest members or values.
+        strict: Whether to reject interests that are not Interest values.
+            Otherwise they contribute no bit, and callers that must match
+            them compare the interest strings instead.
+
+    Returns:
+        The bitwise OR of the bits of all the given interests.
+
+    Raises:
+        ValueError: If strict and any of the interests is not a valid
+            Interest value.
+    """
+    mask = 0
+    for interest in interests:
+        bit = _INTEREST_BITS.get(interest)
+        if bit is not None:
+            mask |= bit
+        elif strict:
+            raise ValueError(f"Invalid interest: {interest}")
+    return mask
+
+
+def mask_to_interests(mask: int) -> List[Interest]:
+    """Decode an integer bitmask into the list of interests it contains.
+
+    Args:
+        mask: The bitmask to decode.
+
+    Returns:
+        The interests whose bits are set in the mask, in enum order.
+    """
+    return [interest for interest in Interest if mask & _INTEREST_BITS[interest.value]]
+
+
+def count_interest_hits(
+    traveler_masks: Sequence[int],
+    activity_masks: Sequence[int],
+) -> List[int]:
+    """Count, for each traveler, the activities sharing at least one interest.
+
+    Uses NumPy over arrays of masks when it is available, and plain bitwise
+    operations otherwise.
+
+    Args:
+        traveler_masks: The interest bitmask of each traveler.
+        activity_masks: The interest bitmask of each activity.
+
+    Returns:
+        The number of matching activities for each traveler, in order.
+    """
+    if NUMPY_AVAILABLE:
+        return count_interest_hits_np(traveler_masks, activity_masks).tolist()
+
+    return [
+        sum(1 for activity_mask in activity_masks if traveler_mask & activity_mask)
+        for traveler_mask in traveler_masks
+    ]
+
+
+def count_interest_hits_np(traveler_masks: Any, activity_masks: Any) -> Any:
+    """Vectorized version of `count_interest_hits` over NumPy arrays of masks.
+
+    Args:
+        traveler_masks: Array-like of traveler interest bitmasks, shape (T,).
+        activity_masks: Array-like of activity interest bitmasks, shape (A,).
+
+    Returns:
+        A NumPy integer array of shape (T,) with each traveler's hit count.
+
+    Raises:
+        ImportError: If NumPy is not installed.
+    """
+    if not NUMPY_AVAILABLE:
+        raise ImportError("NumPy is required for count_interest_hits_np.")
+
+    travelers = np.asarray(traveler_masks, dtype=np.uint64).reshape(-1, 1)
+    activities = np.asarray(activity_masks, dtype=np.uint64).reshape(1, -1)
+    return np.count_nonzero(travelers & activities, axis=1)
+
+
+def score_interest_coverage(
+    travelers: Iterable[Any],
+    activities: Iterable[Any],
+) -> Dict[str, int]:
+    """Count the activities matching each traveler's interests.
+
+    This is the bitmask-based replacement for intersecting Python sets of
+    interests for every traveler, day and activity.
+
+    Args:
+        travelers: Travelers with "name" and "interests", as objects (e.g.
+            the notebook's Traveler model) or dictionaries.
+        activities: Activities with "related_interests", as objects (e.g.
+            the notebook's Activity model) or dictionaries.
+
+    Returns:
+        A dictionary mapping each traveler name to their number of matching
+        activities.
+    """
+    travelers = list(travelers)
+    traveler_interests = [[str(interest) for interest in _field(t, "interests")] for t in travelers]
+
+    # Interests outside the enum have no bit, so compare them as strings
+    if any(interest not in _INTEREST_BITS for interests in traveler_interests for interest in interests):
+        activity_interests = [{str(interest) for interest in _field(a, "related_interests")} for a in activities]
+        return {
+            _field(t, "name"): sum(1 for related in activity_interests if related.intersection(interests))
+            for t, interests in zip(travelers, traveler_interests)
+        }
+
+    traveler_masks = [interests_to_mask(interests) for interests in traveler_interests]
+    activity_masks = [interests_to_mask(_field(a, "related_interests"), strict=False) for a in activities]
+    hit_counts = count_interest_hits(traveler_masks, activity_masks)
+    return {_field(t, "name"): hits for t, hits in zip(travelers, hit_counts)}
+
+
+def _field(obj: Any, name: str) -> Any:
+    """Return a field from a dictionary or an attribute from an object."""
+    return obj[name] if isinstance(obj, dict) else getattr(obj, name)
+
+
+def _cache_key_default(value: Any) -> Any:
+    """Convert a completion argument that JSON cannot encode into a stable value."""
+    # Pydantic model classes (e.g. response_format) are keyed on their JSON
+    # schema, instances on their content so different values never share a key
+    if isinstance(value, type) and hasattr(value, "model_json_schema"):
+        return {"name": value.__name__, "schema": value.model_json_schema()}
+    if hasattr(value, "model_dump"):
+        return value.model_dump(mode="json")
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    if isinstance(value, (set, frozenset)):
+        return sorted(value, key=repr)
+    if isinstance(value, type):
+        return f"{value.__module__}.{value.__qualname__}"
+    return repr(value)
+
+
+class ChatCompletionCache:
+    """A content-addressed cache of chat completion responses.
+
+    Responses are keyed on a SHA-256 hash of the model, the messages and the
+    completion arguments, including the response_format schema. Entries live
+    in an in-memory LRU tier and, when a path is given, in a persistent
+    SQLite tier that survives restarts and is shared between processes.
+
+    Only cache calls whose output you are happy to replay: a cached sampled
+    response is returned as-is for every identical request.
 
     Attributes:
-        name (str): The name of the chat agent.
-        system_prompt (str): The system prompt for the agent.
-        client: The OpenAI client instance.
-        model (str): The model to use for completions.
-        messages (List[Dict[str, str]]): The chat message history.
+        max_entries (int): The maximum number of entries kept in memory.
+        ttl (Optional[float]): The lifetime of an entry in seconds, or None
+            for entries that never expire.
+        path (Optional[str]): The path of the SQLite database of the disk tier.
+        max_disk_entries (Optional[int]): The maximum number of entries kept
+            on disk, or None for no limit.
+        hits (int): The number of lookups served from the cache.
+        misses (int): The number of lookups not found in the cache.
     """
 
     def __init__(
         self,
-        name: Optional[str] = None,
-        system_prompt: Optional[str] = None,
-        client: Optional[Any] = None,
-        model: Optional[str] = None,
+        max_entries: int = 1024,
+        ttl: Optional[float] = None,
+        path: Optional[str] = None,
+        max_disk_entries: Optional[int] = None,
     ) -> None:
-        """Initialize the ChatAgent.
+        """Initialize the ChatCompletionCache.
 
         Args:
-            name: The name of the chat agent. Defaults to class name.
-            system_prompt: The system prompt for the agent.
-            client: The OpenAI client instance.
-            model: The model to use for completions.
+            max_entries: The maximum number of entries kept in memory.
+            ttl: The lifetime of an entry in seconds. Defaults to no expiry.
+            path: The path of the SQLite database of the disk tier. Defaults
+                to a memory-only cache.
+            max_disk_entries: The maximum number of entries kept on disk.
+                Defaults to no limit.
+
+        Raises:
+            ValueError: If max_entries is not positive.
         """
-        self.name = name or self.__class__.__name__
-        self.system_prompt = system_prompt or "You are a helpful assistant."
-        self.client = client
-        self.model = model
-        self.messages: List[Dict[str, str]] = []
-        self.reset()
+        if max_entries <= 0:
+            raise ValueError("max_entries must be positive.")
 
-    def add_message(self, role: str, content: str) -> None:
-        """Add a message to the chat history.
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self.max_disk_entries = max_disk_entries
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.evictions = 0
+        self._memory: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._connection: Optional[sqlite3.Connection] = None
+
+        if path is not None:
+            self._connection = sqlite3.connect(path, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode = WAL")
+            with self._connection:
+                self._connection.execute(
+                    "CREATE TABLE IF NOT EXISTS chat_completions ("
+                    "key TEXT PRIMARY KEY, model TEXT, content TEXT NOT NULL, "
+                    "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+                )
+                self._connection.execute(
+                    "CREATE INDEX IF NOT EXISTS chat_completions_accessed_at "
+                    "ON chat_completions (accessed_at)"
+                )
+
+    @staticmethod
+    def make_key(model: str, messages: List[Dict[str, str]], kwargs: Dict[str, Any]) -> str:
+        """Return the cache key of a chat completion request.
 
         Args:
-            role: The role of the message ("system", "user", or "assistant").
-            content: The content of the message.
+            model: The model of the request.
+            messages: The messages of the request.
+            kwargs: The other completion arguments of the request.
 
-        Raises:
-            ValueError: If the role is not one of "system", "user", or "assistant".
+        Returns:
+            A hex SHA-256 digest, identical for identical requests.
         """
-        valid_roles = {"system", "user", "assistant"}
-        if role not in valid_roles:
-            raise ValueError(f"Invalid role: {role}. Must be one of {valid_roles}")
+        payload = json.dumps(
+            {"model": model, "messages": messages, "kwargs": kwargs},
+            sort_keys=True,
+            separators=(",", ":"),
+            default=_cache_key_default,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
 
-        self.messages.append({"role": role, "content": content})
+    def __len__(self) -> int:
+        """Return the number of entries in the memory tier."""
+        return len(self._memory)
 
-        # Display message in appropriate box
-        role_titles = {
-            "system": f"{self.name} - System Prompt",
-            "user": f"{self.name} - User Prompt",
-            "assistant": f"{self.name} - Assistant Response",
-        }
-        print_in_box(content, role_titles[role])
+    def _is_expired(self, created_at: float, now: float) -> bool:
+        """Return whether an entry created at created_at has outlived the TTL."""
+        return self.ttl is not None and now - created_at > self.ttl
 
-    def reset(self) -> None:
-        """Reset the chat history and re-initialize with the system prompt.
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached response for a key, or None on a miss.
 
-        This method clears all existing messages and adds the system prompt
-        formatted with proper indentation.
+        Args:
+            key: A key returned by make_key.
         """
-        system_prompt = textwrap.dedent(self.system_prompt).strip()
+        now = time.time()
+        with self._lock:
+            # Check the memory tier first
+            entry = self._memory.get(key)
+            if entry is not None:
+                content, created_at = entry
+                if not self._is_expired(created_at, now):
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    return content
+                del self._memory[key]
 
-        # Clear previous messages and add the system prompt
-        self.messages = []
-        self.add_message("system", system_prompt)
+            # Fall back to the disk tier and promote the entry to memory
+            if self._connection is not None:
+                row = self._connection.execute(
+                    "SELECT content, created_at FROM chat_completions WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    content, created_at = row
+                    if not self._is_expired(created_at, now):
+                        with self._connection:
+                            self._connection.execute(
+                                "UPDATE chat_completions SET accessed_at = ? WHERE key = ?", (now, key)
+                            )
+                        self._remember(key, content, created_at)
+                        self.hits += 1
+                        self.disk_hits += 1
+                        return content
+                    with self._connection:
+                        self._connection.execute("DELETE FROM chat_completions WHERE key = ?", (key,))
 
-    def get_response(
-        self,
-        add_to_messages: bool = True,
-        model: Optional[str] = None,
-        client: Optional[Any] = None,
-        **kwargs: Any,
-    ) -> str:
-        """Get a response from the OpenAI API.
+            self.misses += 1
+            return None
 
-        Args:
-            add_to_messages: Whether to add the response to the chat history.
-            model: The model to use for the completion.
-            client: The OpenAI client to use.
-            **kwargs: Additional arguments to pass to the completion API.
+    def set(self, key: str, content: str, model: Optional[str] = None) -> None:
+        """Store a response in the cache.
 
-        Returns:
-            The response from the OpenAI API.
+        Args:
+            key: A key returned by make_key.
+            content: The response content.
+            model: The model of the request, recorded in the disk tier.
         """
-        response = do_chat_completion(
-            messages=self.messages,
-            model=model or self.model,
-            client=client or self.client,
-            **kwargs,
-        )
-        if add_to_messages:
-            self.add_message("assistant", response)
-        return response
+        now = time.time()
+        with self._lock:
+            self._remember(key, content, now)
+            if self._connection is not None:
+                with self._connection:
+                    self._connection.execute(
+                        "INSERT OR REPLACE INTO chat_completions VALUES (?, ?, ?, ?, ?)",
+                        (key, model, content, now, now),
+                    )
+                    if self.max_disk_entries is not None:
+                        # Evict the least recently used entries beyond the size limit
+                        cursor = self._connection.execute(
+                            "DELETE FROM chat_completions WHERE key IN ("
+                            "SELECT key FROM chat_completions ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                            (self.max_disk_entries,),
+                        )
+                        self.evictions += max(cursor.rowcount, 0)
 
-    def chat(
-        self,
-        user_message: str,
-        add_to_messages: bool = True,
-        model: Optional[str] = None,
-        **kwargs: Any,
-    ) -> str:
-        """Send a message to the chat and get a response.
+    def _remember(self, key: str, content: str, created_at: float) -> None:
+        """Add an entry to the memory tier, evicting the least recently used ones."""
+        self._memory[key] = (content, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self.evictions += 1
 
-        Args:
-            user_message: The message to send to the chat.
-            add_to_messages: Whether to add the response to the chat history.
-            model: The model to use for the completion.
-            **kwargs: Additional arguments to pass to the completion API.
+    def clear(self) -> None:
+        """Remove all entries from both tiers and reset the counters."""
+        with self._lock:
+            self._memory.clear()
+            if self._connection is not None:
+                with self._connection:
+                    self._connection.execute("DELETE FROM chat_completions")
+            self.hits = self.misses = self.disk_hits = self.evictions = 0
 
-        Returns:
-            The response from the OpenAI API.
-        """
-        self.add_message("user", user_message)
-        return self.get_response(add_to_messages=add_to_messages, model=model, **kwargs)
+    def close(self) -> None:
+        """Close the disk tier. The memory tier stays usable."""
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
 
+    @property
+    def stats(self) -> Dict[str, Union[int, float]]:
+        """Return the hit/miss counters and the hit ratio of the cache."""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "disk_hits": self.disk_hits,
+            "evictions": self.evictions,
+            "entries": len(self._memory),
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
 
-def print_in_box(
-    text: str,
-    title: str = "",
-    cols: int = DEFAULT_BOX_WIDTH,
-    tab_level: int = 0,
-) -> None:
-    """Print the given text in a box with the specified title and dimensions.
 
-    Args:
-        text: The text to print in the box.
-        title: The title of the box.
-        cols: The width of the box.
-        tab_level: The level of indentation for the box.
-    """
-    text = str(text)
+CHARS_PER_TOKEN = 4
+MESSAGE_OVERHEAD_TOKENS = 4
 
-    # Ensure minimum width for readability
-    min_width = 4 + tab_level * SINGLE_TAB_LEVEL
-    if cols < min_width:
-        cols = min_width
 
-    tabs = " " * tab_level * SINGLE_TAB_LEVEL
-    box_width = cols - 2 - tab_level * SINGLE_TAB_LEVEL
+def estimate_tokens(text: str) -> int:
+    """Estimate the number of tokens in a text, at about four characters per token."""
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
 
-    # Create top border
-    top = tabs + "\u2554" + "\u2550" * box_width + "\u2557"
 
-    if tab_level == 0:
-        print()  # Print a newline before any box at level 0
+def estimate_message_tokens(messages: Iterable[Dict[str, str]]) -> int:
+    """Estimate the number of prompt tokens of a list of chat messages."""
+    return sum(MESSAGE_OVERHEAD_TOKENS + estimate_tokens(message["content"]) for message in messages)
 
-    # Add title if provided
-    if title:
-        title_text = f"[ {title} ]"
-        title_start = (cols - len(title_text)) // 2
-        top = top[:title_start] + title_text + top[title_start + len(title_text) :]
 
-    print(top)
+class TokenBudgetPolicy:
+    """A history policy that keeps the context a ChatAgent sends under a token budget.
 
-    # Print content lines
-    for line in text.split("\n"):
-        for wrapped_line in textwrap.wrap(line, box_width - 2):
-            print(f"{tabs}\u2551 {wrapped_line:<{box_width - 2}} \u2551")
+    When the history exceeds the budget, stale messages are elided, oldest
+    first, until it fits: first tool OBSERVATIONs, then any other message.
+    The system prompt, the most recent messages and the latest message
+    holding a travel plan are never elided. The agent's stored history is
+    left untouched; only the messages sent to the model are compacted.
 
-    # Print bottom border
-    print(f"{tabs}\u255a" + "\u2550" * box_width + "\u255d")
+    Elisions are stable (a stale message is always replaced by the same
+    text), which keeps the start of the prompt cacheable across steps.
 
+    Attributes:
+        max_tokens (int): The token budget of the context.
+        keep_recent (int): The number of most recent messages never elided.
+        plan_marker (str): Text identifying messages that hold a travel plan.
+        observation_prefix (str): The prefix of tool observation messages.
+        preview_chars (int): The number of characters of an elided message
+            kept as a preview.
+        summarizer (Optional[Callable[[str], str]]): A function summarizing
+            an elided message, used instead of the preview.
+    """
 
-def do_chat_completion(
-    messages: List[Dict[str, str]],
-    model: Optional[str] = None,
-    client: Optional[Any] = None,
-    **kwargs: Any,
-) -> str:
-    """A simple wrapper around OpenAI's chat completion API.
+    def __init__(
+        self,
+        max_tokens: int = 8000,
+        keep_recent: int = 4,
+        plan_marker: str = '"itinerary_days"',
+        observation_prefix: str = "OBSERVATION:",
+        preview_chars: int = 160,
+        summarizer: Optional[Callable[[str], str]] = None,
+    ) -> None:
+        """Initialize the TokenBudgetPolicy.
 
-    Args:
-        messages: A list of messages to send to the chat completion API.
-        model: The model to use for the completion.
-        client: The OpenAI client instance.
-        **kwargs: Additional arguments to pass to the completion API.
+        Args:
+            max_tokens: The token budget of the context.
+            keep_recent: The number of most recent messages never elided.
+            plan_marker: Text identifying messages that hold a travel plan.
+            observation_prefix: The prefix of tool observation messages.
+            preview_chars: The number of characters kept from an elided message.
+            summarizer: A function summarizing an elided message, e.g. with a
+                cheap model. Summaries are memoized per message content.
+        """
+        self.max_tokens = max_tokens
+        self.keep_recent = keep_recent
+        self.plan_marker = plan_marker
+        self.observation_prefix = observation_prefix
+        self.preview_chars = preview_chars
+        self.summarizer = summarizer
+        self._summaries: Dict[str, str] = {}
 
-    Returns:
-        The response from the chat completion API.
+    def elide(self, content: str) -> str:
+        """Return the stand-in text for an elided message."""
+        prefix = self.observation_prefix if content.startswith(self.observation_prefix) else ""
+        body = content[len(prefix):].strip()
+        if self.summarizer is not None:
+            if body not in self._summaries:
+                self._summaries[body] = self.summarizer(body)
+            summary = self._summaries[body]
+        else:
+            summary = " ".join(body[: self.preview_chars].split()) + " ..."
+        return f"{prefix} [Stale output elided ({estimate_tokens(content)} tokens): {summary}]".lstrip()
 
-    Raises:
-        ValueError: If client or model is not provided.
-        RuntimeError: If the OpenAI API returns an error.
+    def apply(self, messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
+        """Return the messages to send, compacted to fit the token budget.
 
-    Examples:
-        >>> messages = [
-        ...     {"role": "user", "content": "Hello, how are you?"},
-        ...     {"role": "assistant", "content": "I'm good, thanks!"},
-        ... ]
-        >>> from unittest.mock import patch
-        >>> with patch('openai.OpenAI') as mock_openai:
-        ...     # Setup mock response
-        ...     mock_client = mock_openai.return_value
-        ...     mock_chat = mock_client.chat
-        ...     mock_completions = mock_chat.completions
-        ...     mock_create = mock_completions.create
-        ...     mock_response = mock_create.return_value
-        ...     mock_response.choices = [type('obj', (object,), {
-        ...         'message': type('msg', (object,), {
-        ...             'content': "I'm good, thanks!"
-        ...         })()
-        ...     })]
-        ...     response = do_chat_completion(messages, model="gpt-4", client=mock_client)
-        >>> response
-        "I'm good, thanks!"
-    """
-    if client is None:
-        raise ValueError("A valid OpenAI client must be provided.")
+        Args:
+            messages: The full chat history.
 
-    if model is None:
-        raise ValueError("A valid model must be provided.")
+        Returns:
+            A new list of messages. It may still exceed the budget if the
+            protected messages alone do.
+        """
+        total = estimate_message_tokens(messages)
+        if total <= self.max_tokens:
+            return list(messages)
 
-    try:
-        if "response_format" not in kwargs:
-            response = client.chat.completions.create(
-                model=model,
-                messages=messages,
-                **kwargs,
-            )
-        else:
-            response = client.beta.chat.completions.parse(
-                model=model,
-                messages=messages,
-                **kwargs,
-            )
+        # Protect the system prompt, the recent messages and the latest plan
+        protected = {0} | set(range(max(0, len(messages) - self.keep_recent), len(messages)))
+        for i in range(len(messages) - 1, -1, -1):
+            if self.plan_marker in messages[i]["content"]:
+                protected.add(i)
+                break
 
-        if hasattr(response, "error"):
-            raise RuntimeError(f"OpenAI API returned an error: {str(response.error)}")
+        observations = [
+            i for i in range(len(messages))
+            if i not in protected and messages[i]["content"].startswith(self.observation_prefix)
+        ]
+        others = [i for i in range(len(messages)) if i not in protected and i not in observations]
 
-        content = response.choices[0].message.content
-        return content if content is not None else ""
-    except Exception as e:
-        raise RuntimeError(f"Error calling OpenAI API: {str(e)}") from e
+        compacted = list(messages)
+        for i in observations + others:
+            if total <= self.max_tokens:
+                break
+            content = messages[i]["content"]
+            elided = self.elide(content)
+            if len(elided) < len(content):
+                compacted[i] = {**messages[i], "content": elided}
+                total -= estimate_tokens(content) - estimate_tokens(elided)
+        return compacted
 
 
-ACTIVITY_CALENDAR = [
-    {
-        "activity_id": "event-2025-06-10-0",
+# Prices in USD per million (input, cached input, output) tokens
+MODEL_PRICES_PER_MILLION: Dict[str, Tuple[float, float, float]] = {
+    "gpt-4.1": (2.00, 0.50, 8.00),
+    "gpt-4.1-mini": (0.40, 0.10, 1.60),
+    "gpt-4.1-nano": (0.10, 0.025, 0.40),
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+}
+LATENCY_BUCKETS_SECONDS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_BUCKETS = (100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000)
+UNLABELED = "unlabeled"
+
+_CALL_LABEL: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("call_label", default=None)
+_CALL_AGENT: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("call_agent", default=None)
+_CALL_TRIP: contextvars.ContextVar[Optional[int]] = contextvars.ContextVar("call_trip", default=None)
+
+
+@contextmanager
+def call_label(label: str) -> Iterator[None]:
+    """Attribute the chat completions made inside the block to a label.
+
+    Examples:
+        >>> with call_label("react_step_3"):
+        ...     pass  # agent.get_response() calls are recorded under "react_step_3"
+    """
+    token = _CALL_LABEL.set(label)
+    try:
+        yield
+    finally:
+        _CALL_LABEL.reset(token)
+
+
+@contextmanager
+def _calling_agent(name: str) -> Iterator[None]:
+    """Attribute the chat completions made inside the block to an agent."""
+    token = _CALL_AGENT.set(name)
+    try:
+        yield
+    finally:
+        _CALL_AGENT.reset(token)
+
+
+@contextmanager
+def _planning_trip(index: int) -> Iterator[None]:
+    """Attribute the chat completions made inside the block to a BatchPlanner trip."""
+    token = _CALL_TRIP.set(index)
+    try:
+        yield
+    finally:
+        _CALL_TRIP.reset(token)
+
+
+class ChatCallRecord(NamedTuple):
+    """The measurements of one chat completion call.
+
+    trip is the BatchPlanner input index of the call, if any. It is kept in
+    the JSON and CSV exports but is not a Prometheus label, so the number of
+    exported series stays bounded.
+    """
+
+    timestamp: float
+    model: str
+    agent: str
+    label: str
+    prompt_tokens: int
+    completion_tokens: int
+    cached_tokens: int
+    latency: float
+    cost: float
+    cache_hit: bool = False
+    error: bool = False
+    trip: Optional[int] = None
+
+
+def _usage_counts(usage: Any) -> Tuple[int, int, int]:
+    """Return the prompt, completion and cached prompt tokens of an API usage object."""
+    if usage is None:
+        return 0, 0, 0
+    details = getattr(usage, "prompt_tokens_details", None)
+    return (
+        getattr(usage, "prompt_tokens", 0) or 0,
+        getattr(usage, "completion_tokens", 0) or 0,
+        getattr(details, "cached_tokens", 0) or 0,
+    )
+
+
+class ChatMetrics:
+    """A recorder of chat completion latency, token usage and cost.
+
+    Install one with set_default_metrics() to record every call, or pass it
+    to do_chat_completion(metrics=...) or ChatAgent(metrics=...). Calls are
+    attributed to the calling agent and to the label set with call_label().
+
+    Attributes:
+        records (List[ChatCallRecord]): The recorded calls.
+        prices (Dict[str, Tuple[float, float, float]]): USD per million
+            input, cached input and output tokens, by model.
+    """
+
+    def __init__(
+        self,
+        prices: Optional[Dict[str, Tuple[float, float, float]]] = None,
+        latency_buckets: Sequence[float] = LATENCY_BUCKETS_SECONDS,
+        token_buckets: Sequence[int] = TOKEN_BUCKETS,
+    ) -> None:
+        """Initialize the ChatMetrics.
+
+        Args:
+            prices: USD per million input, cached input and output tokens, by
+                model. Defaults to MODEL_PRICES_PER_MILLION.
+            latency_buckets: The upper bounds of the latency histogram, in seconds.
+            token_buckets: The upper bounds of the token histogram.
+        """
+        self.prices = dict(MODEL_PRICES_PER_MILLION if prices is None else prices)
+        self.latency_buckets = tuple(latency_buckets)
+        self.token_buckets = tuple(token_buckets)
+        self.records: List[ChatCallRecord] = []
+        self._lock = threading.Lock()
+
+    def cost(self, model: str, prompt_tokens: int, completion_tokens: int, cached_tokens: int = 0) -> float:
+        """Return the USD cost of a call, or 0.0 for a model without a price.
+
+        Dated model snapshots (e.g. "gpt-4.1-2025-04-14") use the price of
+        the longest matching model name.
+        """
+        names = [name for name in self.prices if model == name or model.startswith(f"{name}-")]
+        if not names:
+            return 0.0
+        input_price, cached_price, output_price = self.prices[max(names, key=len)]
+        return (
+            (prompt_tokens - cached_tokens) * input_price
+            + cached_tokens * cached_price
+            + completion_tokens * output_price
+        ) / 1_000_000
+
+    def record(
+        self,
+        model: str,
+        latency: float,
+        usage: Any = None,
+        cache_hit: bool = False,
+        error: bool = False,
+        agent: Optional[str] = None,
+        label: Optional[str] = None,
+    ) -> ChatCallRecord:
+        """Record a call.
+
+        Args:
+            model: The model of the call.
+            latency: The wall-clock latency of the call, in seconds.
+            usage: The usage object of the API response, if any.
+            cache_hit: Whether the response came from a ChatCompletionCache.
+            error: Whether the call failed.
+            agent: The calling agent. Defaults to the current ChatAgent.
+            label: The caller label. Defaults to the current call_label().
+
+        Returns:
+            The recorded call.
+        """
+        prompt_tokens, completion_tokens, cached_tokens = _usage_counts(usage)
+        call = ChatCallRecord(
+            timestamp=time.time(),
+            model=str(model),
+            agent=agent or _CALL_AGENT.get() or "",
+            label=label or _CALL_LABEL.get() or UNLABELED,
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            cached_tokens=cached_tokens,
+            latency=latency,
+            cost=self.cost(str(model), prompt_tokens, completion_tokens, cached_tokens),
+            cache_hit=cache_hit,
+            error=error,
+            trip=_CALL_TRIP.get(),
+        )
+        with self._lock:
+            self.records.append(call)
+        return call
+
+    def reset(self) -> None:
+        """Forget all recorded calls."""
+        with self._lock:
+            self.records = []
+
+    def _snapshot(self) -> List[ChatCallRecord]:
+        """Return a copy of the records, taken under the lock so concurrent calls can keep recording."""
+        with self._lock:
+            return list(self.records)
+
+    def _frozen(self) -> "ChatMetrics":
+        """Return a ChatMetrics over a snapshot of the records, for consistent multi-part exports."""
+        frozen = ChatMetrics(self.prices, self.latency_buckets, self.token_buckets)
+        frozen.records = self._snapshot()
+        return frozen
+
+    def _groups(self, by: Union[str, Sequence[str]]) -> Dict[str, List[ChatCallRecord]]:
+        """Group the records by one or more fields, joining multi-field keys with "/"."""
+        fields = [by] if isinstance(by, str) else list(by)
+        groups: Dict[str, List[ChatCallRecord]] = {}
+        for call in self._snapshot():
+            key = "/".join(str(getattr(call, field)) for field in fields)
+            groups.setdefault(key, []).append(call)
+        return groups
+
+    def summary(self, by: Union[str, Sequence[str]] = "label") -> Dict[str, Dict[str, Union[int, float]]]:
+        """Aggregate the calls by label, agent, model or a combination of them.
+
+        Args:
+            by: The field or fields to group by.
+
+        Returns:
+            Per group, the number of calls, errors and cache hits, the token
+            totals, the total cost and the total, p50 and p95 latencies.
+        """
+        summaries = {}
+        for key, calls in self._groups(by).items():
+            latencies = sorted(call.latency for call in calls)
+            summaries[key] = {
+                "calls": len(calls),
+                "errors": sum(call.error for call in calls),
+                "cache_hits": sum(call.cache_hit for call in calls),
+                "prompt_tokens": sum(call.prompt_tokens for call in calls),
+                "completion_tokens": sum(call.completion_tokens for call in calls),
+                "cached_tokens": sum(call.cached_tokens for call in calls),
+                "cost": sum(call.cost for call in calls),
+                "latency_total": sum(latencies),
+                "latency_p50": latencies[(len(latencies) - 1) // 2],
+                "latency_p95": latencies[max(0, -(-len(latencies) * 95 // 100) - 1)],
+            }
+        return summaries
+
+    def prompt_cache_report(self, by: Union[str, Sequence[str]] = "label") -> Dict[str, Dict[str, Any]]:
+        """Report how often the provider served prompts from its prefix cache.
+
+        Only calls that reached the API are counted, not response cache hits
+        or errors. Cached tokens come from the usage's
+        prompt_tokens_details.cached_tokens.
+
+        Args:
+            by: The field or fields to group by.
+
+        Returns:
+            Per group, the number of calls, the fraction with a cached
+            prefix, the fraction of prompt tokens cached, and the p50
+            latency of calls with and without a cached prefix (None if
+            there are none).
+        """
+        def p50(latencies: List[float]) -> Optional[float]:
+            return sorted(latencies)[(len(latencies) - 1) // 2] if latencies else None
+
+        report = {}
+        for key, calls in self._groups(by).items():
+            calls = [call for call in calls if not call.cache_hit and not call.error]
+            if not calls:
+                continue
+            cached = [call for call in calls if call.cached_tokens > 0]
+            prompt_tokens = sum(call.prompt_tokens for call in calls)
+            cached_tokens = sum(call.cached_tokens for call in calls)
+            report[key] = {
+                "calls": len(calls),
+                "prefix_hit_ratio": len(cached) / len(calls),
+                "cached_token_ratio": cached_tokens / prompt_tokens if prompt_tokens else 0.0,
+                "latency_p50_cached": p50([call.latency for call in cached]),
+                "latency_p50_uncached": p50([call.latency for call in calls if call.cached_tokens == 0]),
+            }
+        return report
+
+    def histograms(self, by: Union[str, Sequence[str]] = "label") -> Dict[str, Dict[str, List[Tuple[float, int]]]]:
+        """Return cumulative latency and total-token histograms per group.
+
+        Args:
+            by: The field or fields to group by.
+
+        Returns:
+            Per group, "latency_seconds" and "total_tokens" lists of
+            (upper bound, number of calls at or below it) pairs, ending with
+            an infinite bound.
+        """
+        def cumulative(values: List[float], buckets: Sequence[float]) -> List[Tuple[float, int]]:
+            values = sorted(values)
+            return [(bound, bisect.bisect_right(values, bound)) for bound in buckets] + [(float("inf"), len(values))]
+
+        return {
+            key: {
+                "latency_seconds": cumulative([call.latency for call in calls], self.latency_buckets),
+                "total_tokens": cumulative(
+                    [call.prompt_tokens + call.completion_tokens for call in calls], self.token_buckets
+                ),
+            }
+            for key, calls in self._groups(by).items()
+        }
+
+    def to_json(self, path: str, by: Union[str, Sequence[str]] = "label") -> None:
+        """Write the calls, summaries and histograms to a JSON file."""
+        frozen = self._frozen()
+        histograms = {
+            key: {name: [["+Inf" if bound == float("inf") else bound, count] for bound, count in buckets]
+                  for name, buckets in group.items()}
+            for key, group in frozen.histograms(by).items()
+        }
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "summary": frozen.summary(by),
+                    "histograms": histograms,
+                    "calls": [call._asdict() for call in frozen.records],
+                },
+                f,
+                indent=2,
+            )
+
+    def to_csv(self, path: str) -> None:
+        """Write one row per recorded call to a CSV file."""
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(ChatCallRecord._fields)
+            writer.writerows(self._snapshot())
+
+    def to_prometheus(self, path: str) -> None:
+        """Write the metrics in the Prometheus text exposition format.
+
+        Counters and the latency histogram are labeled by model, agent and
+        caller label, e.g. for a node_exporter textfile collector.
+        """
+        def escape(value: str) -> str:
+            return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+        groups: Dict[Tuple[str, str, str], List[ChatCallRecord]] = {}
+        for call in self._snapshot():
+            groups.setdefault((call.model, call.agent, call.label), []).append(call)
+
+        def total(field: str) -> Callable[[List[ChatCallRecord]], Union[int, float]]:
+            return lambda calls: sum(getattr(call, field) for call in calls)
+
+        lines = []
+        counters = [
+            ("agentsville_chat_calls_total", "Chat completion calls.", len),
+            ("agentsville_chat_errors_total", "Failed chat completion calls.", total("error")),
+            ("agentsville_chat_cache_hits_total", "Calls answered from the response cache.", total("cache_hit")),
+            ("agentsville_chat_prompt_tokens_total", "Prompt tokens.", total("prompt_tokens")),
+            ("agentsville_chat_cached_tokens_total", "Cached prompt tokens.", total("cached_tokens")),
+            ("agentsville_chat_completion_tokens_total", "Completion tokens.", total("completion_tokens")),
+            ("agentsville_chat_cost_usd_total", "Estimated cost in USD.", total("cost")),
+        ]
+        for name, help_text, value in counters:
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+            for (model, agent, label), calls in groups.items():
+                labels = f'model="{escape(model)}",agent="{escape(agent)}",label="{escape(label)}"'
+                lines.append(f"{name}{{{labels}}} {value(calls)}")
+
+        name = "agentsville_chat_latency_seconds"
+        lines += [f"# HELP {name} Chat completion wall-clock latency.", f"# TYPE {name} histogram"]
+        for (model, agent, label), calls in groups.items():
+            labels = f'model="{escape(model)}",agent="{escape(agent)}",label="{escape(label)}"'
+            latencies = sorted(call.latency for call in calls)
+            for bound in self.latency_buckets:
+                lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {bisect.bisect_right(latencies, bound)}')
+            lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {len(latencies)}')
+            lines.append(f"{name}_sum{{{labels}}} {sum(latencies)}")
+            lines.append(f"{name}_count{{{labels}}} {len(latencies)}")
+
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+
+    def export(self, path: str) -> None:
+        """Write the metrics to a .json, .csv or Prometheus text (.prom/.txt) file.
+
+        Raises:
+            ValueError: If the file extension is not supported.
+        """
+        extension = os.path.splitext(path)[1].lower()
+        if extension == ".json":
+            self.to_json(path)
+        elif extension == ".csv":
+            self.to_csv(path)
+        elif extension in (".prom", ".txt"):
+            self.to_prometheus(path)
+        else:
+            raise ValueError(f"Unsupported metrics file extension: {extension}")
+
+
+_default_metrics: Optional[ChatMetrics] = None
+
+
+def set_default_metrics(metrics: Optional[ChatMetrics]) -> None:
+    """Record every chat completion without an explicit recorder to metrics (None to stop)."""
+    global _default_metrics
+    _default_metrics = metrics
+
+
+def get_default_metrics() -> Optional[ChatMetrics]:
+    """Return the recorder installed with set_default_metrics, if any."""
+    return _default_metrics
+
+
+class RequestPriority(int, Enum):
+    """The priority class of a chat completion request. Lower values go first."""
+
+    INTERACTIVE = 0  # A user is waiting, e.g. itinerary generation and ReAct steps
+    BACKGROUND = 1  # Nobody is waiting, e.g. evals and precomputation
+
+
+class RateLimits(NamedTuple):
+    """The provider's rate limits for a model."""
+
+    requests_per_minute: int
+    tokens_per_minute: int
+
+
+_REQUEST_PRIORITY: contextvars.ContextVar[RequestPriority] = contextvars.ContextVar(
+    "request_priority", default=RequestPriority.INTERACTIVE
+)
+_RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+_RETRYABLE_ERROR_NAMES = {"APIConnectionError", "APITimeoutError", "RateLimitError", "InternalServerError"}
+
+
+@contextmanager
+def request_priority(priority: Union[int, RequestPriority]) -> Iterator[None]:
+    """Schedule the chat completions made inside the block with a priority class."""
+    token = _REQUEST_PRIORITY.set(RequestPriority(priority))
+    try:
+        yield
+    finally:
+        _REQUEST_PRIORITY.reset(token)
+
+
+def _error_status_code(error: BaseException) -> Optional[int]:
+    """Return the HTTP status code of an API error, if any."""
+    status_code = getattr(error, "status_code", None)
+    if status_code is None:
+        status_code = getattr(getattr(error, "response", None), "status_code", None)
+    return status_code if isinstance(status_code, int) else None
+
+
+def is_retryable_error(error: BaseException) -> bool:
+    """Return whether an API error is transient: rate limits, timeouts, server and connection errors."""
+    if _error_status_code(error) in _RETRYABLE_STATUS_CODES:
+        return True
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    return any(cls.__name__ in _RETRYABLE_ERROR_NAMES for cls in type(error).__mro__)
+
+
+def retry_after_seconds(error: BaseException) -> Optional[float]:
+    """Return the delay an API error asks to wait before retrying, if any.
+
+    Reads the retry-after-ms and retry-after headers of the error's response.
+    """
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms") is not None:
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if value is None:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            retry_at = email.utils.parsedate_to_datetime(value)
+            return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class _TokenBucket:
+    """A token bucket refilled continuously up to a per-minute capacity."""
+
+    def __init__(self, per_minute: int) -> None:
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def time_until(self, amount: float, now: float) -> float:
+        """Return the seconds until amount tokens are available (0.0 if they are)."""
+        self._refill(now)
+        # A request larger than the bucket only waits for a full bucket
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.tokens) / self.rate)
+
+    def take(self, amount: float) -> None:
+        """Remove tokens. The level may go negative, delaying later requests."""
+        self.tokens -= amount
+
+
+class RequestScheduler:
+    """Schedule chat completion requests under per-model rate limits, with retries.
+
+    Each model has two token buckets, for requests per minute and tokens per
+    minute. A request waits until both can cover it and no higher-priority
+    request for the same model is waiting. Prompt tokens are estimated up
+    front and corrected with the actual usage afterwards.
+
+    Transient errors (429, 5xx, timeouts, connection errors) are retried with
+    exponential backoff and full jitter, waiting at least as long as the
+    error's retry-after header asks. A 429 pauses the model for every
+    request, not just the one that hit it.
+
+    Create the OpenAI client with max_retries=0 so retries are left to the
+    scheduler.
+
+    Attributes:
+        limits (Dict[str, RateLimits]): The rate limits, by model.
+        default_limits (Optional[RateLimits]): The limits of other models, or
+            None to leave them unlimited (they are still retried).
+        stats (Dict[str, float]): Counts of requests, retries and 429s, and
+            the total time spent waiting.
+    """
+
+    def __init__(
+        self,
+        limits: Optional[Dict[str, RateLimits]] = None,
+        default_limits: Optional[RateLimits] = None,
+        max_retries: int = 5,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0,
+        completion_tokens_estimate: int = 500,
+    ) -> None:
+        """Initialize the RequestScheduler.
+
+        Args:
+            limits: The rate limits, by model. Dated model snapshots use the
+                limits of the longest matching model name.
+            default_limits: The limits of models not in limits.
+            max_retries: The maximum number of retries of a request.
+            base_delay: The backoff cap of the first retry, in seconds. It
+                doubles with every retry.
+            max_delay: The maximum backoff cap, in seconds.
+            completion_tokens_estimate: The completion tokens reserved for a
+                request without max_tokens or max_completion_tokens.
+        """
+        self.limits = dict(limits or {})
+        self.default_limits = default_limits
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.completion_tokens_estimate = completion_tokens_estimate
+        self.stats = {"requests": 0, "retries": 0, "rate_limited": 0, "wait_time": 0.0}
+        self._buckets: Dict[str, Tuple[_TokenBucket, _TokenBucket]] = {}
+        self._waiting: Dict[str, List[Tuple[int, int]]] = {}
+        self._paused_until: Dict[str, float] = {}
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._async_waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Event]] = []
+
+    def estimate_tokens(self, messages: List[Dict[str, str]], kwargs: Dict[str, Any]) -> int:
+        """Estimate the tokens a request will use, prompt and completion."""
+        completion_tokens = kwargs.get("max_completion_tokens") or kwargs.get("max_tokens")
+        return estimate_message_tokens(messages) + (completion_tokens or self.completion_tokens_estimate)
+
+    def _model_buckets(self, model: str) -> Optional[Tuple[_TokenBucket, _TokenBucket]]:
+        """Return the (requests, tokens) buckets of a model, or None if it is unlimited."""
+        if model not in self._buckets:
+            names = [name for name in self.limits if model == name or model.startswith(f"{name}-")]
+            limits = self.limits[max(names, key=len)] if names else self.default_limits
+            if limits is None:
+                return None
+            self._buckets[model] = (
+                _TokenBucket(limits.requests_per_minute),
+                _TokenBucket(limits.tokens_per_minute),
+            )
+        return self._buckets[model]
+
+    def _try_acquire(self, model: str, tokens: int, ticket: Tuple[int, int]) -> Optional[float]:
+        """Take capacity for a waiting ticket if it is its turn.
+
+        Must be called with the condition held.
+
+        Returns:
+            0.0 if the capacity was taken, None if other tickets are ahead
+            (wait for a notification), otherwise the seconds until the
+            capacity is refilled or the pause ends.
+        """
+        now = time.monotonic()
+        waiting = self._waiting[model]
+        if waiting[0] != ticket:
+            return None
+        pause = self._paused_until.get(model, 0.0) - now
+        if pause > 0:
+            return pause
+
+        buckets = self._model_buckets(model)
+        if buckets is not None:
+            requests, token_bucket = buckets
+            wait = max(requests.time_until(1, now), token_bucket.time_until(tokens, now))
+            if wait > 0:
+                return wait
+            requests.take(1)
+            token_bucket.take(tokens)
+
+        heapq.heappop(waiting)
+        self.stats["requests"] += 1
+        return 0.0
+
+    def _enqueue(self, model: str, priority: Optional[RequestPriority]) -> Tuple[int, int]:
+        """Add a waiting ticket for a request. Must be called with the condition held."""
+        priority = _REQUEST_PRIORITY.get() if priority is None else priority
+        ticket = (int(priority), next(self._sequence))
+        heapq.heappush(self._waiting.setdefault(model, []), ticket)
+        return ticket
+
+    def _dequeue(self, model: str, ticket: Tuple[int, int]) -> None:
+        """Remove an abandoned ticket. Must be called with the condition held."""
+        waiting = self._waiting[model]
+        if ticket in waiting:
+            waiting.remove(ticket)
+            heapq.heapify(waiting)
+            self._notify()
+
+    def _notify(self) -> None:
+        """Wake the sync and async waiters to recheck their turn. Must be called with the condition held."""
+        self._condition.notify_all()
+        for loop, event in self._async_waiters:
+            with suppress(RuntimeError):  # The loop is closed
+                loop.call_soon_threadsafe(event.set)
+
+    def acquire(self, model: str, tokens: int, priority: Optional[RequestPriority] = None) -> None:
+        """Block until a request may be sent.
+
+        Args:
+            model: The model of the request.
+            tokens: The estimated tokens of the request.
+            priority: The priority class. Defaults to the current
+                request_priority() (INTERACTIVE unless set).
+        """
+        started = time.monotonic()
+        with self._condition:
+            ticket = self._enqueue(model, priority)
+            try:
+                while True:
+                    wait = self._try_acquire(model, tokens, ticket)
+                    if wait == 0.0:
+                        self._notify()
+                        break
+                    self._condition.wait(wait)
+            except BaseException:
+                self._dequeue(model, ticket)
+                raise
+            self.stats["wait_time"] += time.monotonic() - started
+
+    async def aacquire(self, model: str, tokens: int, priority: Optional[RequestPriority] = None) -> None:
+        """The async counterpart of acquire, waiting without blocking the event loop."""
+        started = time.monotonic()
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self._condition:
+            ticket = self._enqueue(model, priority)
+            self._async_waiters.append(waiter)
+        try:
+            while True:
+                with self._condition:
+                    waiter[1].clear()
+                    wait = self._try_acquire(model, tokens, ticket)
+                    if wait == 0.0:
+                        self._notify()
+                        break
+                with suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(waiter[1].wait(), wait)
+        except BaseException:
+            with self._condition:
+                self._dequeue(model, ticket)
+            raise
+        finally:
+            with self._condition:
+                self._async_waiters.remove(waiter)
+        with self._condition:
+            self.stats["wait_time"] += time.monotonic() - started
+
+    def reconcile(self, model: str, estimated_tokens: int, usage: Any, tokens: Optional[int] = None) -> None:
+        """Correct a model's token bucket with the actual usage of a request.
+
+        Args:
+            model: The model of the request.
+            estimated_tokens: The tokens taken when the request was admitted.
+            usage: The usage object of the response, if any.
+            tokens: The tokens counted locally, used when the usage is
+                missing (e.g. a stream closed before its usage chunk).
+        """
+        prompt_tokens, completion_tokens, _ = _usage_counts(usage)
+        if prompt_tokens or completion_tokens:
+            tokens = prompt_tokens + completion_tokens
+        if tokens is None:
+            return
+        with self._condition:
+            buckets = self._model_buckets(model)
+            if buckets is not None:
+                buckets[1].take(tokens - estimated_tokens)
+                self._notify()
+
+    def _backoff(self, model: str, attempt: int, error: BaseException) -> float:
+        """Return the delay before a retry, pausing the model on a 429."""
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        retry_after = retry_after_seconds(error)
+        if retry_after is not None:
+            delay = max(delay, retry_after + random.uniform(0, self.base_delay / 4))
+
+        with self._condition:
+            self.stats["retries"] += 1
+            if _error_status_code(error) == 429 or type(error).__name__ == "RateLimitError":
+                self.stats["rate_limited"] += 1
+                self._paused_until[model] = max(self._paused_until.get(model, 0.0), time.monotonic() + delay)
+        return delay
+
+    def run(
+        self,
+        send: Callable[[], Any],
+        model: str,
+        tokens: int,
+        priority: Optional[RequestPriority] = None,
+    ) -> Any:
+        """Send a request when allowed, retrying transient errors.
+
+        Args:
+            send: A function sending the request and returning the response.
+            model: The model of the request.
+            tokens: The estimated tokens of the request.
+            priority: The priority class. Defaults to the current
+                request_priority().
+
+        Returns:
+            The response, with its usage reconciled against the estimate.
+
+        Raises:
+            Exception: The last error, if it is not transient or the retries
+                are exhausted.
+        """
+        for attempt in range(self.max_retries + 1):
+            self.acquire(model, tokens, priority)
+            try:
+                response = send()
+            except Exception as e:
+                if attempt == self.max_retries or not is_retryable_error(e):
+                    raise
+                time.sleep(self._backoff(model, attempt, e))
+                continue
+            self.reconcile(model, tokens, getattr(response, "usage", None))
+            return response
+
+    async def arun(
+        self,
+        send: Callable[[], Any],
+        model: str,
+        tokens: int,
+        priority: Optional[RequestPriority] = None,
+    ) -> Any:
+        """The async counterpart of run, for a send function returning an awaitable."""
+        for attempt in range(self.max_retries + 1):
+            await self.aacquire(model, tokens, priority)
+            try:
+                response = await send()
+            except Exception as e:
+                if attempt == self.max_retries or not is_retryable_error(e):
+                    raise
+                await asyncio.sleep(self._backoff(model, attempt, e))
+                continue
+            self.reconcile(model, tokens, getattr(response, "usage", None))
+            return response
+
+
+_default_scheduler: Optional[RequestScheduler] = None
+
+
+def set_default_scheduler(scheduler: Optional[RequestScheduler]) -> None:
+    """Schedule every chat completion without an explicit scheduler (None to stop)."""
+    global _default_scheduler
+    _default_scheduler = scheduler
+
+
+def get_default_scheduler() -> Optional[RequestScheduler]:
+    """Return the scheduler installed with set_default_scheduler, if any."""
+    return _default_scheduler
+
+
+# OpenAI caches prompt prefixes of at least this many tokens
+PROMPT_CACHE_MIN_TOKENS = 1024
+
+
+def _template_fields(template: string.Template) -> List[str]:
+    """Return the placeholder names of a string.Template, in order."""
+    names = []
+    for match in template.pattern.finditer(template.template):
+        name = match.group("named") or match.group("braced")
+        if name is not None and name not in names:
+            names.append(name)
+    return names
+
+
+class PromptTemplate:
+    """A system prompt laid out as a static prefix followed by per-request data.
+
+    Providers cache the longest prompt prefix they have seen recently, so
+    keeping instructions, tool descriptions and schemas ahead of anything
+    that varies (vacation info, weather, valid IDs) lets every request after
+    the first reuse the cached prefix. The prefix is rendered once, when the
+    template is built; render() only fills in the dynamic sections.
+
+    Static section bodies are used verbatim, so JSON examples need no
+    escaping. Dynamic section bodies are string.Template strings, e.g.
+    "${weather}"; values that are not strings are inserted as compact JSON.
+
+    Examples:
+        >>> template = PromptTemplate(
+        ...     static_sections=[("ROLE", "You are a travel agent.")],
+        ...     dynamic_sections=[("BUDGET", "${budget} units")],
+        ... )
+        >>> print(template.render(budget=130))
+        [ROLE]
+        You are a travel agent.
+        <BLANKLINE>
+        [BUDGET]
+        130 units
+
+    Attributes:
+        prefix (str): The rendered static prefix.
+        prefix_hash (str): A short hash of the prefix, to check it is
+            identical across processes and deployments.
+        prefix_tokens (int): The estimated tokens of the prefix.
+        fields (List[str]): The names render() expects.
+    """
+
+    def __init__(
+        self,
+        static_sections: Sequence[Tuple[str, str]],
+        dynamic_sections: Sequence[Tuple[str, str]] = (),
+    ) -> None:
+        """Initialize the PromptTemplate and render its static prefix.
+
+        Args:
+            static_sections: (title, body) pairs that are the same for every
+                request, in order.
+            dynamic_sections: (title, string.Template body) pairs filled in
+                per request, placed after all static sections.
+        """
+        self.static_sections = [(title, textwrap.dedent(body).strip()) for title, body in static_sections]
+        self.dynamic_sections = [
+            (title, string.Template(textwrap.dedent(body).strip())) for title, body in dynamic_sections
+        ]
+        # Section headers start at column 0, so ChatAgent's dedent leaves the prefix unchanged
+        self.prefix = "\n\n".join(f"[{title}]\n{body}" for title, body in self.static_sections)
+        self.prefix_hash = hashlib.sha256(self.prefix.encode("utf-8")).hexdigest()[:16]
+        self.prefix_tokens = estimate_tokens(self.prefix)
+        self.fields = [name for _, template in self.dynamic_sections for name in _template_fields(template)]
+
+    @property
+    def cacheable(self) -> bool:
+        """Whether the prefix is long enough for provider prompt caching."""
+        return self.prefix_tokens >= PROMPT_CACHE_MIN_TOKENS
+
+    def render(self, **values: Any) -> str:
+        """Return the prompt with the dynamic sections filled in.
+
+        Raises:
+            ValueError: If a value for a dynamic section is missing.
+        """
+        missing = [name for name in self.fields if name not in values]
+        if missing:
+            raise ValueError(f"Missing prompt values: {missing}")
+        text_values = {
+            name: value if isinstance(value, str) else json.dumps(value, default=_cache_key_default)
+            for name, value in values.items()
+        }
+        sections = [self.prefix] if self.prefix else []
+        sections += [f"[{title}]\n{template.substitute(text_values)}" for title, template in self.dynamic_sections]
+        return "\n\n".join(sections)
+
+
+class ChatAgent:
+    """A chat agent that interacts with OpenAI's API to facilitate conversations.
+
+    This class manages chat history, formats system prompts, and handles
+    communication with OpenAI's chat completion API. It provides methods to
+    add messages, get responses, and maintain conversation context.
+
+    Attributes:
+        name (str): The name of the chat agent.
+        system_prompt (str): The system prompt for the agent.
+        client: The OpenAI client instance.
+        model (str): The model to use for completions.
+        cache (Optional[ChatCompletionCache]): The response cache, if any.
+        history_policy (Optional[TokenBudgetPolicy]): The policy compacting
+            the history sent to the model, if any.
+        metrics (Optional[ChatMetrics]): The recorder of this agent's calls,
+            if not the default one.
+        transcript (Optional[TranscriptSink]): Where added messages are
+            shown, if not the default sink.
+        scheduler (Optional[RequestScheduler]): The rate-limit scheduler of
+            this agent's calls, if not the default one.
+        messages (List[Dict[str, str]]): The chat message history.
+    """
+
+    def __init__(
+        self,
+        name: Optional[str] = None,
+        system_prompt: Optional[str] = None,
+        client: Optional[Any] = None,
+        model: Optional[str] = None,
+        cache: Optional[ChatCompletionCache] = None,
+        history_policy: Optional[TokenBudgetPolicy] = None,
+        metrics: Optional[ChatMetrics] = None,
+        transcript: Optional[TranscriptSink] = None,
+        scheduler: Optional[RequestScheduler] = None,
+    ) -> None:
+        """Initialize the ChatAgent.
+
+        Args:
+            name: The name of the chat agent. Defaults to class name.
+            system_prompt: The system prompt for the agent.
+            client: The OpenAI client instance.
+            model: The model to use for completions.
+            cache: A response cache for this agent's completions. Defaults
+                to no caching.
+            history_policy: A policy compacting the history sent to the
+                model, e.g. TokenBudgetPolicy. Defaults to sending it all.
+            metrics: A recorder for this agent's calls. Defaults to the one
+                installed with set_default_metrics, if any.
+            transcript: Where to show added messages. Defaults to the sink set
+                with set_default_transcript_sink (the terminal unless changed).
+            scheduler: A rate-limit scheduler for this agent's calls. Defaults
+                to the one installed with set_default_scheduler, if any.
+        """
+        self.name = name or self.__class__.__name__
+        self.system_prompt = system_prompt or "You are a helpful assistant."
+        self.client = client
+        self.model = model
+        self.cache = cache
+        self.history_policy = history_policy
+        self.metrics = metrics
+        self.transcript = transcript
+        self.scheduler = scheduler
+        self.messages: List[Dict[str, str]] = []
+        self.reset()
+
+    def add_message(self, role: str, content: str) -> None:
+        """Add a message to the chat history.
+
+        Args:
+            role: The role of the message ("system", "user", or "assistant").
+            content: The content of the message.
+
+        Raises:
+            ValueError: If the role is not one of "system", "user", or "assistant".
+        """
+        valid_roles = {"system", "user", "assistant"}
+        if role not in valid_roles:
+            raise ValueError(f"Invalid role: {role}. Must be one of {valid_roles}")
+
+        self.messages.append({"role": role, "content": content})
+
+        # Display message in appropriate box
+        role_titles = {
+            "system": f"{self.name} - System Prompt",
+            "user": f"{self.name} - User Prompt",
+            "assistant": f"{self.name} - Assistant Response",
+        }
+        sink = self.transcript if self.transcript is not None else _default_transcript_sink
+        sink.write(self.name, role, content, role_titles[role])
+
+    def reset(self) -> None:
+        """Reset the chat history and re-initialize with the system prompt.
+
+        This method clears all existing messages and adds the system prompt
+        formatted with proper indentation.
+        """
+        system_prompt = textwrap.dedent(self.system_prompt).strip()
+
+        # Clear previous messages and add the system prompt
+        self.messages = []
+        self.add_message("system", system_prompt)
+
+    def context_messages(self) -> List[Dict[str, str]]:
+        """Return the messages to send to the model, compacted by the history policy."""
+        if self.history_policy is None:
+            return list(self.messages)
+        return self.history_policy.apply(self.messages)
+
+    def get_response(
+        self,
+        add_to_messages: bool = True,
+        model: Optional[str] = None,
+        client: Optional[Any] = None,
+        **kwargs: Any,
+    ) -> str:
+        """Get a response from the OpenAI API.
+
+        Args:
+            add_to_messages: Whether to add the response to the chat history.
+            model: The model to use for the completion.
+            client: The OpenAI client to use.
+            **kwargs: Additional arguments to pass to the completion API.
+                Pass cache=... to override the agent's response cache.
+
+        Returns:
+            The response from the OpenAI API.
+        """
+        kwargs.setdefault("cache", self.cache)
+        kwargs.setdefault("metrics", self.metrics)
+        kwargs.setdefault("scheduler", self.scheduler)
+        with _calling_agent(self.name):
+            response = do_chat_completion(
+                messages=self.context_messages(),
+                model=model or self.model,
+                client=client or self.client,
+                **kwargs,
+            )
+        if add_to_messages:
+            self.add_message("assistant", response)
+        return response
+
+    def chat(
+        self,
+        user_message: str,
+        add_to_messages: bool = True,
+        model: Optional[str] = None,
+        **kwargs: Any,
+    ) -> str:
+        """Send a message to the chat and get a response.
+
+        Args:
+            user_message: The message to send to the chat.
+            add_to_messages: Whether to add the response to the chat history.
+            model: The model to use for the completion.
+            **kwargs: Additional arguments to pass to the completion API.
+
+        Returns:
+            The response from the OpenAI API.
+        """
+        self.add_message("user", user_message)
+        return self.get_response(add_to_messages=add_to_messages, model=model, **kwargs)
+
+    def stream_chat(
+        self,
+        user_message: str,
+        add_to_messages: bool = True,
+        model: Optional[str] = None,
+        on_delta: Optional[Callable[[str], None]] = None,
+        **kwargs: Any,
+    ) -> Iterator[str]:
+        """Send a message to the chat and stream the response.
+
+        Like chat(), identical requests are answered from the agent's
+        response cache (as a single delta), and calls are recorded under the
+        agent's name, including failures. The assembled response is added to
+        the chat history once the stream is exhausted. To stop early, e.g.
+        once a ReActActionParser has the tool call, close the generator;
+        nothing is added to the history then.
+
+        Args:
+            user_message: The message to send to the chat.
+            add_to_messages: Whether to add the response to the chat history.
+            model: The model to use for the completion.
+            on_delta: A callback receiving each content delta.
+            **kwargs: Additional arguments to pass to the completion API.
+                Pass cache=... to override the agent's response cache.
+
+        Yields:
+            The content deltas of the response, in order.
+
+        Raises:
+            ValueError: If a response_format is given.
+            RuntimeError: If the OpenAI API returns an error.
+        """
+        self.add_message("user", user_message)
+        model = model or self.model
+        cache = kwargs.pop("cache", self.cache)
+        client = kwargs.pop("client", None) or self.client
+        recorder = self.metrics if self.metrics is not None else _default_metrics
+        scheduler = self.scheduler if self.scheduler is not None else _default_scheduler
+        messages = self.context_messages()
+        started = time.perf_counter()
+
+        def record(**fields: Any) -> None:
+            if recorder is not None:
+                with _calling_agent(self.name):
+                    recorder.record(model, time.perf_counter() - started, **fields)
+
+        # Serve identical requests from the cache, sharing entries with chat()
+        cache_key = None
+        if cache is not None:
+            cache_key = cache.make_key(model, messages, kwargs)
+            cached = cache.get(cache_key)
+            if cached is not None:
+                record(cache_hit=True)
+                if on_delta is not None:
+                    on_delta(cached)
+                yield cached
+                if add_to_messages:
+                    self.add_message("assistant", cached)
+                return
+
+        usages: List[Any] = []
+        deltas: List[str] = []
+        # Streams wait for capacity but are not retried once started
+        if scheduler is not None:
+            estimated_tokens = scheduler.estimate_tokens(messages, kwargs)
+            scheduler.acquire(model, estimated_tokens)
+        try:
+            for delta in stream_chat_completion(
+                messages=messages,
+                model=model,
+                client=client,
+                on_usage=usages.append,
+                **kwargs,
+            ):
+                deltas.append(delta)
+                if on_delta is not None:
+                    on_delta(delta)
+                yield delta
+        except GeneratorExit:
+            # Closed early by the caller: the call still took time and tokens
+            record(usage=usages[-1] if usages else None)
+            raise
+        except Exception:
+            record(error=True)
+            raise
+        finally:
+            # Correct the estimate, from the usage chunk or a local count if the stream ended early
+            if scheduler is not None:
+                scheduler.reconcile(
+                    model, estimated_tokens, usages[-1] if usages else None,
+                    tokens=estimate_message_tokens(messages) + estimate_tokens("".join(deltas)),
+                )
+
+        content = "".join(deltas)
+        record(usage=usages[-1] if usages else None)
+        if cache_key is not None:
+            cache.set(cache_key, content, model=model)
+        if add_to_messages:
+            self.add_message("assistant", content)
+
+    async def aget_response(
+        self,
+        add_to_messages: bool = True,
+        model: Optional[str] = None,
+        client: Optional[Any] = None,
+        **kwargs: Any,
+    ) -> str:
+        """Get a response from the OpenAI API without blocking the event loop.
+
+        The agent's client must be an async OpenAI client (or pass one as
+        client).
+
+        Args:
+            add_to_messages: Whether to add the response to the chat history.
+            model: The model to use for the completion.
+            client: The async OpenAI client to use.
+            **kwargs: Additional arguments to pass to ado_chat_completion.
+
+        Returns:
+            The response from the OpenAI API.
+        """
+        kwargs.setdefault("cache", self.cache)
+        kwargs.setdefault("metrics", self.metrics)
+        kwargs.setdefault("scheduler", self.scheduler)
+        with _calling_agent(self.name):
+            response = await ado_chat_completion(
+                # Snapshot the history, which may change while the request is in flight
+                messages=self.context_messages(),
+                model=model or self.model,
+                client=client or self.client,
+                **kwargs,
+            )
+        if add_to_messages:
+            self.add_message("assistant", response)
+        return response
+
+    async def achat(
+        self,
+        user_message: str,
+        add_to_messages: bool = True,
+        model: Optional[str] = None,
+        **kwargs: Any,
+    ) -> str:
+        """Send a message to the chat and await a response.
+
+        Args:
+            user_message: The message to send to the chat.
+            add_to_messages: Whether to add the response to the chat history.
+            model: The model to use for the completion.
+            **kwargs: Additional arguments to pass to ado_chat_completion.
+
+        Returns:
+            The response from the OpenAI API.
+        """
+        self.add_message("user", user_message)
+        return await self.aget_response(add_to_messages=add_to_messages, model=model, **kwargs)
+
+
+def render_box(
+    text: str,
+    title: str = "",
+    cols: int = DEFAULT_BOX_WIDTH,
+    tab_level: int = 0,
+) -> str:
+    """Render the given text in a box with the specified title and dimensions.
+
+    Args:
+        text: The text to render in the box.
+        title: The title of the box.
+        cols: The width of the box.
+        tab_level: The level of indentation for the box.
+
+    Returns:
+        The lines of the box, joined with newlines.
+    """
+    text = str(text)
+
+    # Ensure minimum width for readability
+    min_width = 4 + tab_level * SINGLE_TAB_LEVEL
+    if cols < min_width:
+        cols = min_width
+
+    tabs = " " * tab_level * SINGLE_TAB_LEVEL
+    box_width = cols - 2 - tab_level * SINGLE_TAB_LEVEL
+
+    # Create top border
+    top = tabs + "\u2554" + "\u2550" * box_width + "\u2557"
+
+    # Add title if provided
+    if title:
+        title_text = f"[ {title} ]"
+        title_start = (cols - len(title_text)) // 2
+        top = top[:title_start] + title_text + top[title_start + len(title_text) :]
+
+    lines = [top]
+
+    # Add content lines
+    for line in text.split("\n"):
+        for wrapped_line in textwrap.wrap(line, box_width - 2):
+            lines.append(f"{tabs}\u2551 {wrapped_line:<{box_width - 2}} \u2551")
+
+    # Add bottom border
+    lines.append(f"{tabs}\u255a" + "\u2550" * box_width + "\u255d")
+    return "\n".join(lines)
+
+
+def print_in_box(
+    text: str,
+    title: str = "",
+    cols: int = DEFAULT_BOX_WIDTH,
+    tab_level: int = 0,
+) -> None:
+    """Print the given text in a box with the specified title and dimensions.
+
+    Args:
+        text: The text to print in the box.
+        title: The title of the box.
+        cols: The width of the box.
+        tab_level: The level of indentation for the box.
+    """
+    if tab_level == 0:
+        print()  # Print a newline before any box at level 0
+
+    print(render_box(text, title, cols=cols, tab_level=tab_level))
+
+
+class TranscriptSink:
+    """A destination for the messages ChatAgents add to their history.
+
+    Sinks receive the raw message; only sinks meant for humans render it
+    into a box, so machine-facing and null sinks skip the formatting cost.
+    A sink may be shared by agents on several threads (e.g. under
+    BatchPlanner), so file-backed sinks serialize their writes.
+    """
+
+    def write(self, agent: str, role: str, content: str, title: str) -> None:
+        """Record a message.
+
+        Args:
+            agent: The name of the agent.
+            role: The role of the message ("system", "user", or "assistant").
+            content: The content of the message.
+            title: The display title of the message.
+        """
+        raise NotImplementedError
+
+    def flush(self) -> None:
+        """Make sure the messages written so far have reached their destination."""
+
+    def close(self) -> None:
+        """Flush and release the sink's resources."""
+        self.flush()
+
+
+class TerminalSink(TranscriptSink):
+    """Print each message in a box, as print_in_box does. The default sink."""
+
+    def __init__(self, cols: int = DEFAULT_BOX_WIDTH) -> None:
+        """Initialize the TerminalSink.
+
+        Args:
+            cols: The width of the boxes.
+        """
+        self.cols = cols
+
+    def write(self, agent: str, role: str, content: str, title: str) -> None:
+        """Print the message in a box."""
+        print_in_box(content, title, cols=self.cols)
+
+
+class NullSink(TranscriptSink):
+    """Discard every message."""
+
+    def write(self, agent: str, role: str, content: str, title: str) -> None:
+        """Discard the message."""
+
+
+class BufferedFileSink(TranscriptSink):
+    """Append boxed messages to a text file through a large write buffer."""
+
+    def __init__(self, path: str, cols: int = DEFAULT_BOX_WIDTH, buffer_size: int = 1 << 16) -> None:
+        """Initialize the BufferedFileSink.
+
+        Args:
+            path: The path of the transcript file, opened for appending.
+            cols: The width of the boxes.
+            buffer_size: The size of the write buffer in bytes.
+        """
+        self.path = path
+        self.cols = cols
+        self._file = open(path, "a", encoding="utf-8", buffering=buffer_size)
+        self._lock = threading.Lock()
+
+    def write(self, agent: str, role: str, content: str, title: str) -> None:
+        """Append the message in a box."""
+        text = f"\n{render_box(content, title, cols=self.cols)}\n"
+        with self._lock:
+            self._file.write(text)
+
+    def flush(self) -> None:
+        """Flush the write buffer to the file."""
+        with self._lock:
+            self._file.flush()
+
+    def close(self) -> None:
+        """Flush and close the file."""
+        with self._lock:
+            self._file.close()
+
+
+class JsonlSink(TranscriptSink):
+    """Append one JSON object per message to a JSONL file, without rendering."""
+
+    def __init__(self, path: str, buffer_size: int = 1 << 16) -> None:
+        """Initialize the JsonlSink.
+
+        Args:
+            path: The path of the JSONL file, opened for appending.
+            buffer_size: The size of the write buffer in bytes.
+        """
+        self.path = path
+        self._file = open(path, "a", encoding="utf-8", buffering=buffer_size)
+        self._lock = threading.Lock()
+
+    def write(self, agent: str, role: str, content: str, title: str) -> None:
+        """Append the message as a JSON line."""
+        record = {"timestamp": time.time(), "agent": agent, "role": role, "title": title, "content": content}
+        line = json.dumps(record) + "\n"
+        with self._lock:
+            self._file.write(line)
+
+    def flush(self) -> None:
+        """Flush the write buffer to the file."""
+        with self._lock:
+            self._file.flush()
+
+    def close(self) -> None:
+        """Flush and close the file."""
+        with self._lock:
+            self._file.close()
+
+
+class BackgroundSink(TranscriptSink):
+    """Hand messages to another sink on a background writer thread.
+
+    write() only enqueues the message, so rendering and I/O happen off the
+    agent's thread. Messages are written in order.
+    """
+
+    _STOP = object()
+
+    def __init__(self, sink: TranscriptSink, max_queue: int = 10_000) -> None:
+        """Initialize the BackgroundSink and start its writer thread.
+
+        Args:
+            sink: The sink to write to.
+            max_queue: The maximum number of pending messages. write() blocks
+                when the queue is full.
+        """
+        self.sink = sink
+        self._queue: "queue.Queue[Any]" = queue.Queue(maxsize=max_queue)
+        self._thread = threading.Thread(target=self._run, name="transcript-writer", daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        """Write queued messages until stopped."""
+        while True:
+            item = self._queue.get()
+            try:
+                if item is self._STOP:
+                    return
+                self.sink.write(*item)
+            except Exception:
+                logger.exception("Failed to write a transcript message to %r", self.sink)
+            finally:
+                self._queue.task_done()
+
+    def write(self, agent: str, role: str, content: str, title: str) -> None:
+        """Queue the message for the writer thread."""
+        self._queue.put((agent, role, content, title))
+
+    def flush(self) -> None:
+        """Wait until the queued messages are written, then flush the wrapped sink."""
+        self._queue.join()
+        self.sink.flush()
+
+    def close(self) -> None:
+        """Write the queued messages, stop the writer thread and close the wrapped sink."""
+        if self._thread.is_alive():
+            self._queue.put(self._STOP)
+            self._thread.join()
+        self.sink.close()
+
+
+_default_transcript_sink: TranscriptSink = TerminalSink()
+
+
+def set_default_transcript_sink(sink: TranscriptSink) -> None:
+    """Set the sink of ChatAgents created without one (TerminalSink by default)."""
+    global _default_transcript_sink
+    _default_transcript_sink = sink
+
+
+def get_default_transcript_sink() -> TranscriptSink:
+    """Return the sink of ChatAgents created without one."""
+    return _default_transcript_sink
+
+
+def do_chat_completion(
+    messages: List[Dict[str, str]],
+    model: Optional[str] = None,
+    client: Optional[Any] = None,
+    cache: Optional[ChatCompletionCache] = None,
+    stream: bool = False,
+    on_delta: Optional[Callable[[str], None]] = None,
+    metrics: Optional[ChatMetrics] = None,
+    scheduler: Optional[RequestScheduler] = None,
+    **kwargs: Any,
+) -> str:
+    """A simple wrapper around OpenAI's chat completion API.
+
+    Args:
+        messages: A list of messages to send to the chat completion API.
+        model: The model to use for the completion.
+        client: The OpenAI client instance.
+        cache: A response cache. Identical requests are answered from the
+            cache instead of calling the API.
+        stream: Whether to stream the response (see stream_chat_completion).
+        on_delta: A callback receiving each content delta when streaming.
+            A cached response is passed as a single delta.
+        metrics: A recorder for the call's latency, token usage and cost.
+            Defaults to the one installed with set_default_metrics, if any.
+        scheduler: A scheduler applying rate limits, priorities and retries
+            (see RequestScheduler). Defaults to the one installed with
+            set_default_scheduler, if any. Streamed requests are not retried.
+        **kwargs: Additional arguments to pass to the completion API.
+
+    Returns:
+        The response from the chat completion API, assembled if streamed.
+
+    Raises:
+        ValueError: If client or model is not provided.
+        RuntimeError: If the OpenAI API returns an error (after any retries).
+        Exception: Whatever on_delta raises, unchanged.
+
+    Examples:
+        >>> messages = [
+        ...     {"role": "user", "content": "Hello, how are you?"},
+        ...     {"role": "assistant", "content": "I'm good, thanks!"},
+        ... ]
+        >>> from unittest.mock import patch
+        >>> with patch('openai.OpenAI') as mock_openai:
+        ...     # Setup mock response
+        ...     mock_client = mock_openai.return_value
+        ...     mock_chat = mock_client.chat
+        ...     mock_completions = mock_chat.completions
+        ...     mock_create = mock_completions.create
+        ...     mock_response = mock_create.return_value
+        ...     mock_response.choices = [type('obj', (object,), {
+        ...         'message': type('msg', (object,), {
+        ...             'content': "I'm good, thanks!"
+        ...         })()
+        ...     })]
+        ...     response = do_chat_completion(messages, model="gpt-4", client=mock_client)
+        >>> response
+        "I'm good, thanks!"
+    """
+    if client is None:
+        raise ValueError("A valid OpenAI client must be provided.")
+
+    if model is None:
+        raise ValueError("A valid model must be provided.")
+
+    recorder = metrics if metrics is not None else _default_metrics
+    scheduler = scheduler if scheduler is not None else _default_scheduler
+    started = time.perf_counter()
+
+    # Serve identical requests from the cache
+    cache_key = None
+    if cache is not None:
+        cache_key = cache.make_key(model, messages, kwargs)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            if stream and on_delta is not None:
+                on_delta(cached)
+            if recorder is not None:
+                recorder.record(model, time.perf_counter() - started, cache_hit=True)
+            return cached
+
+    usages: List[Any] = []
+    try:
+        if stream:
+            deltas: List[str] = []
+            if scheduler is not None:
+                estimated_tokens = scheduler.estimate_tokens(messages, kwargs)
+                scheduler.acquire(model, estimated_tokens)
+            try:
+                for delta in stream_chat_completion(
+                    messages,
+                    model=model,
+                    client=client,
+                    on_usage=usages.append,
+                    **kwargs,
+                ):
+                    deltas.append(delta)
+                    if on_delta is not None:
+                        on_delta(delta)
+            finally:
+                if scheduler is not None:
+                    scheduler.reconcile(
+                        model, estimated_tokens, usages[-1] if usages else None,
+                        tokens=estimate_message_tokens(messages) + estimate_tokens("".join(deltas)),
+                    )
+            content = "".join(deltas)
+        else:
+            if "response_format" not in kwargs:
+                send = client.chat.completions.create
+            else:
+                send = client.beta.chat.completions.parse
+
+            if scheduler is None:
+                response = send(model=model, messages=messages, **kwargs)
+            else:
+                response = scheduler.run(
+                    lambda: send(model=model, messages=messages, **kwargs),
+                    model,
+                    scheduler.estimate_tokens(messages, kwargs),
+                )
+
+            content = _completion_content(response)
+            usages.append(getattr(response, "usage", None))
+    except Exception as e:
+        if recorder is not None:
+            recorder.record(model, time.perf_counter() - started, error=True)
+        # stream_chat_completion reports its own API errors, and on_delta's are the caller's
+        if stream:
+            raise
+        raise RuntimeError(f"Error calling OpenAI API: {str(e)}") from e
+
+    if recorder is not None:
+        recorder.record(model, time.perf_counter() - started, usage=usages[-1] if usages else None)
+    if cache_key is not None:
+        cache.set(cache_key, content, model=model)
+    return content
+
+
+def stream_chat_completion(
+    messages: List[Dict[str, str]],
+    model: Optional[str] = None,
+    client: Optional[Any] = None,
+    on_usage: Optional[Callable[[Any], None]] = None,
+    **kwargs: Any,
+) -> Iterator[str]:
+    """Stream a chat completion from OpenAI's API, one content delta at a time.
+
+    Args:
+        messages: A list of messages to send to the chat completion API.
+        model: The model to use for the completion.
+        client: The OpenAI client instance.
+        on_usage: A callback receiving the usage object of the response.
+            Usage reporting is requested from the API when given.
+        **kwargs: Additional arguments to pass to the completion API.
+
+    Yields:
+        The non-empty content deltas of the response, in order.
+
+    Raises:
+        ValueError: If client or model is not provided, or if a
+            response_format is given (structured outputs are not streamed).
+        RuntimeError: If the OpenAI API returns an error.
+    """
+    if client is None:
+        raise ValueError("A valid OpenAI client must be provided.")
+
+    if model is None:
+        raise ValueError("A valid model must be provided.")
+
+    if "response_format" in kwargs:
+        raise ValueError("Streaming does not support response_format.")
+
+    if on_usage is not None:
+        kwargs.setdefault("stream_options", {"include_usage": True})
+
+    try:
+        stream = client.chat.completions.create(
+            model=model,
+            messages=messages,
+            stream=True,
+            **kwargs,
+        )
+        for chunk in stream:
+            usage = getattr(chunk, "usage", None)
+            if usage is not None and on_usage is not None:
+                on_usage(usage)
+            # The final usage chunk, if requested, has no choices
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                yield delta
+    except Exception as e:
+        raise RuntimeError(f"Error calling OpenAI API: {str(e)}") from e
+
+
+class ReActActionParser:
+    """Incrementally extract the ACTION tool call from a streamed ReAct response.
+
+    Feed the deltas of a THOUGHT/ACTION response as they arrive. The JSON
+    object after "ACTION:" is tracked with brace balancing, so the tool call
+    is available as soon as its closing brace arrives, before the rest of
+    the response is generated.
+
+    Examples:
+        >>> parser = ReActActionParser()
+        >>> parser.feed('THOUGHT: Check.\\nACTION: {"tool_name": "calc", ')
+        >>> parser.feed('"arguments": {"expression": "1 + }"}}\\n')
+        {'tool_name': 'calc', 'arguments': {'expression': '1 + }'}}
+    """
+
+    MARKER = "ACTION:"
+
+    def __init__(self) -> None:
+        """Initialize the ReActActionParser."""
+        self.reset()
+
+    def reset(self) -> None:
+        """Forget the text fed so far, to parse a new response."""
+        self.text = ""
+        self.action: Optional[Dict[str, Any]] = None
+        self.action_string: Optional[str] = None
+        self._marker_end: Optional[int] = None
+        self._start: Optional[int] = None
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    @property
+    def is_complete(self) -> bool:
+        """Return whether the full ACTION JSON object has been received."""
+        return self.action_string is not None
+
+    def feed(self, delta: str) -> Optional[Dict[str, Any]]:
+        """Add a delta of the response.
+
+        Args:
+            delta: The next piece of the response text.
+
+        Returns:
+            The parsed tool call when this delta completes the ACTION JSON
+            object, otherwise None. If the completed object is not valid
+            JSON, action stays None and action_string holds the raw text
+            (e.g. for json_repair).
+        """
+        scan_from = max(0, len(self.text) - len(self.MARKER))
+        self.text += delta
+        if self.is_complete:
+            return None
+
+        # Find the ACTION marker, then the opening brace of its object
+        if self._marker_end is None:
+            marker = self.text.find(self.MARKER, scan_from)
+            if marker == -1:
+                return None
+            self._marker_end = self._pos = marker + len(self.MARKER)
+        if self._start is None:
+            brace = self.text.find("{", self._pos)
+            if brace == -1:
+                self._pos = len(self.text)
+                return None
+            self._start = self._pos = brace
+
+        # Balance the braces outside of JSON strings
+        text = self.text
+        for i in range(self._pos, len(text)):
+            char = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char == "{":
+                self._depth += 1
+            elif char == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    self.action_string = text[self._start : i + 1]
+                    try:
+                        self.action = json.loads(self.action_string)
+                    except json.JSONDecodeError:
+                        return None
+                    return self.action
+        self._pos = len(text)
+        return None
+
+
+def _completion_content(response: Any) -> str:
+    """Return the message content of a chat completion response.
+
+    Raises:
+        RuntimeError: If the response carries an error.
+    """
+    if hasattr(response, "error"):
+        raise RuntimeError(f"OpenAI API returned an error: {str(response.error)}")
+
+    content = response.choices[0].message.content
+    return content if content is not None else ""
+
+
+_async_concurrency_limit = DEFAULT_ASYNC_CONCURRENCY
+
+
+class _AsyncConcurrencyLimiter:
+    """The shared concurrency limiter of one event loop.
+
+    Unlike a semaphore sized once, it counts the requests in flight and reads
+    the current limit on every acquisition, so a new limit applies to the
+    requests already running too.
+    """
+
+    def __init__(self) -> None:
+        self.in_flight = 0
+        self._condition = asyncio.Condition()
+
+    async def __aenter__(self) -> None:
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < _async_concurrency_limit)
+            self.in_flight += 1
+            # Pass the wake-up on if a raised limit leaves room for more
+            if self.in_flight < _async_concurrency_limit:
+                self._condition.notify()
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+
+
+# asyncio primitives are bound to the event loop they are first used on
+_async_limiters: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, _AsyncConcurrencyLimiter]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def set_async_concurrency_limit(limit: int) -> None:
+    """Set the maximum number of concurrent async chat completions per event loop.
+
+    The limit is shared by every ado_chat_completion call that is not given
+    its own semaphore, including those made through ChatAgent.achat. It may
+    be changed while requests are in flight: they count against the new
+    limit, and no new request starts until the count is below it.
+
+    Args:
+        limit: The maximum number of requests in flight per event loop.
+
+    Raises:
+        ValueError: If limit is not positive.
+    """
+    global _async_concurrency_limit
+
+    if limit <= 0:
+        raise ValueError("The concurrency limit must be positive.")
+
+    _async_concurrency_limit = limit
+
+
+def _async_limiter() -> _AsyncConcurrencyLimiter:
+    """Return the shared concurrency limiter of the running event loop."""
+    loop = asyncio.get_running_loop()
+    limiter = _async_limiters.get(loop)
+    if limiter is None:
+        limiter = _AsyncConcurrencyLimiter()
+        _async_limiters[loop] = limiter
+    return limiter
+
+
+async def _cache_call(cache: ChatCompletionCache, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    """Call a cache method, in a worker thread if it reaches the synchronous SQLite disk tier."""
+    if cache.path is None:
+        return fn(*args, **kwargs)
+    return await asyncio.to_thread(fn, *args, **kwargs)
+
+
+async def ado_chat_completion(
+    messages: List[Dict[str, str]],
+    model: Optional[str] = None,
+    client: Optional[Any] = None,
+    cache: Optional[ChatCompletionCache] = None,
+    semaphore: Optional[asyncio.Semaphore] = None,
+    metrics: Optional[ChatMetrics] = None,
+    scheduler: Optional[RequestScheduler] = None,
+    **kwargs: Any,
+) -> str:
+    """The async counterpart of do_chat_completion, for an AsyncOpenAI client.
+
+    Requests wait for a slot of the shared concurrency limiter (see
+    set_async_concurrency_limit), so many sessions can share one event loop
+    without flooding the API.
+
+    Args:
+        messages: A list of messages to send to the chat completion API.
+        model: The model to use for the completion.
+        client: The async OpenAI client instance.
+        cache: A response cache. Identical requests are answered from the
+            cache instead of calling the API.
+        semaphore: A limiter to use instead of the shared one.
+        metrics: A recorder for the call's latency, token usage and cost.
+            Defaults to the one installed with set_default_metrics, if any.
+        scheduler: A scheduler applying rate limits, priorities and retries
+            (see RequestScheduler). Defaults to the one installed with
+            set_default_scheduler, if any.
+        **kwargs: Additional arguments to pass to the completion API.
+
+    Returns:
+        The response from the chat completion API.
+
+    Raises:
+        ValueError: If client or model is not provided.
+        RuntimeError: If the OpenAI API returns an error (after any retries).
+    """
+    if client is None:
+        raise ValueError("A valid OpenAI client must be provided.")
+
+    if model is None:
+        raise ValueError("A valid model must be provided.")
+
+    recorder = metrics if metrics is not None else _default_metrics
+    started = time.perf_counter()
+
+    # Serve identical requests from the cache
+    cache_key = None
+    if cache is not None:
+        cache_key = cache.make_key(model, messages, kwargs)
+        cached = await _cache_call(cache, cache.get, cache_key)
+        if cached is not None:
+            if recorder is not None:
+                recorder.record(model, time.perf_counter() - started, cache_hit=True)
+            return cached
+
+    scheduler = scheduler if scheduler is not None else _default_scheduler
+    if "response_format" not in kwargs:
+        send = client.chat.completions.create
+    else:
+        send = client.beta.chat.completions.parse
+
+    try:
+        async with semaphore or _async_limiter():
+            if scheduler is None:
+                response = await send(model=model, messages=messages, **kwargs)
+            else:
+                response = await scheduler.arun(
+                    lambda: send(model=model, messages=messages, **kwargs),
+                    model,
+                    scheduler.estimate_tokens(messages, kwargs),
+                )
+
+        content = _completion_content(response)
+    except Exception as e:
+        if recorder is not None:
+            recorder.record(model, time.perf_counter() - started, error=True)
+        raise RuntimeError(f"Error calling OpenAI API: {str(e)}") from e
+
+    # Latency includes the wait for a concurrency slot
+    if recorder is not None:
+        recorder.record(model, time.perf_counter() - started, usage=getattr(response, "usage", None))
+    if cache_key is not None:
+        await _cache_call(cache, cache.set, cache_key, content, model=model)
+    return content
+
+
+ACTIVITY_CALENDAR = [
+    {
+        "activity_id": "event-2025-06-10-0",
         "name": "FutureTech Breakfast Meet-Up",
         "start_time": "2025-06-10 09:00",
         "end_time": "2025-06-10 11:00",
@@ -516,236 +2701,3443 @@ ACTIVITY_CALENDAR = [
         "related_interests": ["writing", "reading", "art"],
     },
     {
-        "activity_id": "event-2025-06-15-1",
-        "name": "Lunchtime Groove: AgentsVille Dance Social",
-        "start_time": "2025-06-15 12:00",
-        "end_time": "2025-06-15 13:30",
-        "location": "Sunbeam Community Hall, Downtown AgentsVille",
-        "description": "Join us for Lunchtime Groove, AgentsVille's exciting indoor dance social! Shake off your midday blues with an hour and a half of energetic dancing, fun choreography, and great music. Whether you're a beginner or a seasoned dancer, enjoy learning new moves and meeting fellow dance lovers. Related interests: dancing, music, fitness.",
-        "price": 15,
-        "related_interests": ["dancing", "music", "fitness"],
+        "activity_id": "event-2025-06-15-1",
+        "name": "Lunchtime Groove: AgentsVille Dance Social",
+        "start_time": "2025-06-15 12:00",
+        "end_time": "2025-06-15 13:30",
+        "location": "Sunbeam Community Hall, Downtown AgentsVille",
+        "description": "Join us for Lunchtime Groove, AgentsVille's exciting indoor dance social! Shake off your midday blues with an hour and a half of energetic dancing, fun choreography, and great music. Whether you're a beginner or a seasoned dancer, enjoy learning new moves and meeting fellow dance lovers. Related interests: dancing, music, fitness.",
+        "price": 15,
+        "related_interests": ["dancing", "music", "fitness"],
+    },
+    {
+        "activity_id": "event-2025-06-15-2",
+        "name": "AgentsVille Summer Dance Jam",
+        "start_time": "2025-06-15 15:00",
+        "end_time": "2025-06-15 17:00",
+        "location": "The Groove Pavilion, Central Park, AgentsVille",
+        "description": "Get ready to dance the afternoon away at AgentsVille's Summer Dance Jam! Whether you're a dancing enthusiast or just looking to bust a move, join us at the spacious, open-air Groove Pavilion in Central Park. Expect a lively mix of pop, salsa, and swing tunes, interactive group lessons, and fun dance-offs. This outdoor event welcomes dancers of all levels and ages. Make new friends, learn new moves, and celebrate your love for music and dancing!",
+        "price": 15,
+        "related_interests": ["dancing", "music", "fitness"],
+    },
+    {
+        "activity_id": "event-2025-06-15-3",
+        "name": "Twilight Tennis Rally",
+        "start_time": "2025-06-15 18:00",
+        "end_time": "2025-06-15 20:00",
+        "location": "Grand Courts at Sunfield Park, AgentsVille",
+        "description": "Join us for a thrilling outdoor evening of tennis under the setting sun at the Grand Courts! Whether you're a beginner or a seasoned player, this event offers friendly matches, skill challenges, and social time with fellow tennis enthusiasts. Embrace the fresh air, lively music, and exciting giveaways all themed around the love of tennis. Don't miss your chance to rally, serve, and have fun! Perfect for those passionate about tennis, fitness, and meeting new people.",
+        "price": 15,
+        "related_interests": ["tennis", "fitness", "music"],
+    },
+]
+
+
+INCLIMATE_WEATHER_CONDITIONS = ["thunderstorm", "rainy"]
+
+WEATHER_FORECAST = [
+    {
+        "date": "2025-06-10",
+        "city": "AgentsVille",
+        "temperature": 31,
+        "temperature_unit": "celsius",
+        "condition": "clear",
+        "description": "A bright and sunny day in AgentsVille with clear skies and warm temperatures. Perfect weather for outdoor activities!",
+    },
+    {
+        "date": "2025-06-11",
+        "city": "AgentsVille",
+        "temperature": 34,
+        "temperature_unit": "celsius",
+        "condition": "partly cloudy",
+        "description": "A warm day with periods of sunshine and mixed clouds, making it a perfect opportunity for outdoor activities.",
+    },
+    {
+        "date": "2025-06-12",
+        "city": "AgentsVille",
+        "temperature": 28,
+        "temperature_unit": "celsius",
+        "condition": "thunderstorm",
+        "description": "A thunderstorm is expected to roll in during the afternoon, bringing heavy rain and gusty winds. The atmosphere will feel charged with humidity, creating a sultry and dramatic setting as clouds build in the sky.",
+    },
+    {
+        "date": "2025-06-13",
+        "city": "AgentsVille",
+        "temperature": 15,
+        "temperature_unit": "celsius",
+        "condition": "rainy",
+        "description": "Cloudy skies with intermittent rain showers throughout the day, accompanied by a cool breeze and a chance of occasional thunderstorms.",
+    },
+    {
+        "date": "2025-06-14",
+        "city": "AgentsVille",
+        "temperature": 14,
+        "temperature_unit": "celsius",
+        "condition": "rainy",
+        "description": "A steady rain is expected throughout the day with overcast skies and cool temperatures. Residents should be prepared for slick roads and carry umbrellas.",
+    },
+    {
+        "date": "2025-06-15",
+        "city": "AgentsVille",
+        "temperature": 31,
+        "temperature_unit": "celsius",
+        "condition": "sunny",
+        "description": "A bright and sunny day perfect for outdoor activities with no chance of rain.",
     },
-    {
-        "activity_id": "event-2025-06-15-2",
-        "name": "AgentsVille Summer Dance Jam",
-        "start_time": "2025-06-15 15:00",
-        "end_time": "2025-06-15 17:00",
-        "location": "The Groove Pavilion, Central Park, AgentsVille",
-        "description": "Get ready to dance the afternoon away at AgentsVille's Summer Dance Jam! Whether you're a dancing enthusiast or just looking to bust a move, join us at the spacious, open-air Groove Pavilion in Central Park. Expect a lively mix of pop, salsa, and swing tunes, interactive group lessons, and fun dance-offs. This outdoor event welcomes dancers of all levels and ages. Make new friends, learn new moves, and celebrate your love for music and dancing!",
-        "price": 15,
-        "related_interests": ["dancing", "music", "fitness"],
+]
+
+
+class ActivitySetting(str, Enum):
+    """Enumeration of where an activity takes place, as far as weather goes."""
+
+    INDOOR = "indoor"
+    OUTDOOR = "outdoor"
+    OUTDOOR_WITH_BACKUP = "outdoor_with_backup"
+    UNKNOWN = "unknown"
+
+    def __str__(self) -> str:
+        """Return the string value of the setting."""
+        return self.value
+
+
+_BACKUP_PATTERN = re.compile(
+    r"in case of (rain|bad weather)|move[sd]? indoors|indoor (option|backup|alternative)",
+    re.IGNORECASE,
+)
+_INDOOR_PATTERN = re.compile(r"\bindoors?\b", re.IGNORECASE)
+_OUTDOOR_PATTERN = re.compile(r"\boutdoors?\b|\bopen[- ]air\b|\bopen sky\b", re.IGNORECASE)
+
+
+def classify_activity_setting(description: str) -> ActivitySetting:
+    """Classify an activity as indoor, outdoor or outdoor with a backup venue.
+
+    The classification uses keyword rules over the activity description,
+    e.g. "(Indoor event.)" or "in case of rain, we move indoors".
+
+    Args:
+        description: The description of the activity.
+
+    Returns:
+        The setting of the activity, or ActivitySetting.UNKNOWN when the
+        description is missing or ambiguous.
+    """
+    if _BACKUP_PATTERN.search(description):
+        return ActivitySetting.OUTDOOR_WITH_BACKUP
+
+    indoor = _INDOOR_PATTERN.search(description) is not None
+    outdoor = _OUTDOOR_PATTERN.search(description) is not None
+    if indoor and not outdoor:
+        return ActivitySetting.INDOOR
+    if outdoor and not indoor:
+        return ActivitySetting.OUTDOOR
+    return ActivitySetting.UNKNOWN
+
+
+class ActivityRecord(NamedTuple):
+    """An immutable, normalized activity calendar event.
+
+    Records are created once when a calendar is loaded and shared by
+    reference between queries. Use `to_dict` to convert a record into the
+    activities API response format at the JSON boundary.
+    """
+
+    activity_id: str
+    name: str
+    start_time: str
+    end_time: str
+    location: str
+    description: str
+    price: int
+    related_interests: Tuple[str, ...]
+    city: str = DEFAULT_CITY
+    interest_mask: int = 0
+
+    @classmethod
+    def from_event(cls, event: Dict[str, Any], default_city: str = DEFAULT_CITY) -> ActivityRecord:
+        """Normalize an activity event dictionary into a record.
+
+        Args:
+            event: The activity event, e.g. an entry of ACTIVITY_CALENDAR.
+            default_city: The city of the event if it has no "city" field.
+
+        Returns:
+            The activity record.
+        """
+        related_interests = tuple(str(interest) for interest in event["related_interests"])
+        return cls(
+            activity_id=str(event["activity_id"]),
+            name=str(event["name"]),
+            start_time=str(event["start_time"]),
+            end_time=str(event["end_time"]),
+            location=str(event["location"]),
+            description=str(event["description"]),
+            price=int(event["price"]),
+            related_interests=related_interests,
+            city=str(event.get("city", default_city)),
+            interest_mask=interests_to_mask(related_interests, strict=False),
+        )
+
+    @property
+    def date(self) -> str:
+        """Return the date (YYYY-MM-DD) the activity starts on."""
+        return self.start_time[:10]
+
+    def to_dict(self) -> Dict[str, Union[str, int, List[str]]]:
+        """Return the activity in the activities API response format."""
+        return {
+            "activity_id": self.activity_id,
+            "name": self.name,
+            "start_time": self.start_time,
+            "end_time": self.end_time,
+            "location": self.location,
+            "description": self.description,
+            "price": self.price,
+            "related_interests": list(self.related_interests),
+        }
+
+
+class ForecastRecord(NamedTuple):
+    """An immutable, normalized daily weather forecast."""
+
+    date: str
+    city: str
+    temperature: int
+    temperature_unit: str
+    condition: str
+    description: str
+
+    @classmethod
+    def from_forecast(cls, forecast: Dict[str, Any]) -> ForecastRecord:
+        """Normalize a forecast dictionary, e.g. an entry of WEATHER_FORECAST."""
+        return cls(
+            date=str(forecast["date"]),
+            city=str(forecast["city"]),
+            temperature=int(forecast["temperature"]),
+            temperature_unit=str(forecast["temperature_unit"]),
+            condition=str(forecast["condition"]),
+            description=str(forecast["description"]),
+        )
+
+    def to_dict(self) -> Dict[str, Union[str, int]]:
+        """Return the forecast in the weather API response format."""
+        return dict(self._asdict())
+
+
+class ActivityStore:
+    """An indexed, in-memory store of activity calendar events.
+
+    The store normalizes every event into an ActivityRecord once when it is
+    built and keeps hash indexes by date, activity ID and city, so that
+    queries cost time proportional to the number of matching events instead
+    of the size of the whole calendar. Queries return the shared records
+    themselves rather than copies.
+
+    Attributes:
+        default_city (str): The city assigned to events without a "city" field.
+    """
+
+    def __init__(
+        self,
+        events: Iterable[Union[Dict[str, Any], ActivityRecord]] = (),
+        default_city: str = DEFAULT_CITY,
+    ) -> None:
+        """Initialize the ActivityStore.
+
+        Args:
+            events: The activity events or records to index.
+            default_city: The city assigned to events without a "city" field.
+        """
+        self.default_city = default_city
+        self._records: Sequence[ActivityRecord] = []
+        self._by_id: Dict[str, int] = {}
+        self._by_date: Dict[str, List[int]] = {}
+        self._by_city: Dict[str, List[int]] = {}
+        self._city_date_ranges: Dict[str, Tuple[str, str]] = {}
+        self._sorted_dates: Optional[List[str]] = None
+        self._columnar: Optional[ColumnarActivityCalendar] = None
+
+        for event in events:
+            self.add(event)
+
+    def __len__(self) -> int:
+        """Return the number of events in the store."""
+        return len(self._records)
+
+    def __iter__(self) -> Iterator[ActivityRecord]:
+        """Iterate over the events, in calendar order."""
+        return iter(self._records)
+
+    def add(self, event: Union[Dict[str, Any], ActivityRecord]) -> None:
+        """Normalize an event and add it to the store indexes.
+
+        Args:
+            event: The activity event or record to add.
+
+        Raises:
+            ValueError: If an event with the same activity ID already exists.
+            TypeError: If the store is backed by a read-only snapshot.
+        """
+        if not isinstance(self._records, list):
+            raise TypeError("Cannot add events to a snapshot-backed ActivityStore.")
+
+        record = (
+            event if isinstance(event, ActivityRecord)
+            else ActivityRecord.from_event(event, default_city=self.default_city)
+        )
+        if record.activity_id in self._by_id:
+            raise ValueError(f"Duplicate activity ID: {record.activity_id}")
+
+        self._records.append(record)
+        self._columnar = None
+        self._index(len(self._records) - 1, record.activity_id, record.date, record.city)
+
+    @classmethod
+    def from_snapshot(cls, path: str) -> ActivityStore:
+        """Open a read-only store over a calendar snapshot.
+
+        The snapshot columns are memory-mapped, so processes opening the same
+        snapshot share its pages. Only the ID, date and city columns are read
+        to build the indexes; records are decoded on access.
+
+        Args:
+            path: The snapshot directory, as written by `write_calendar_snapshot`.
+
+        Returns:
+            The snapshot-backed activity store.
+        """
+        snapshot = _ActivitySnapshot(path)
+        store = cls()
+        store._records = snapshot
+        columns = zip(
+            snapshot.text_column("activity_id"),
+            snapshot.text_column("start_time"),
+            snapshot.city_column(),
+        )
+        for row, (activity_id, start_time, city) in enumerate(columns):
+            store._index(row, activity_id, start_time[:10], city)
+        store._columnar = snapshot.to_columnar()
+        return store
+
+    def _index(self, row: int, activity_id: str, date: str, city: str) -> None:
+        """Add the event at the given row to the hash and date indexes."""
+        self._by_id[activity_id] = row
+        if date not in self._by_date:
+            self._by_date[date] = []
+            self._sorted_dates = None
+        self._by_date[date].append(row)
+        self._by_city.setdefault(city, []).append(row)
+
+        first, last = self._city_date_ranges.get(city, (date, date))
+        self._city_date_ranges[city] = (min(first, date), max(last, date))
+
+    @property
+    def cities(self) -> AbstractSet[str]:
+        """Return the set of cities that have events in the store."""
+        return self._by_city.keys()
+
+    def date_range(self, city: Optional[str] = None) -> Optional[Tuple[str, str]]:
+        """Return the first and last dates (YYYY-MM-DD) with events.
+
+        Args:
+            city: Only consider events in this city.
+
+        Returns:
+            The (first, last) dates, or None if there are no matching events.
+        """
+        if city is not None:
+            return self._city_date_ranges.get(city)
+        if not self._by_date:
+            return None
+        if self._sorted_dates is None:
+            self._sorted_dates = sorted(self._by_date)
+        return self._sorted_dates[0], self._sorted_dates[-1]
+
+    def query(
+        self,
+        date: Optional[str] = None,
+        city: Optional[str] = None,
+        activity_ids: Optional[List[str]] = None,
+    ) -> List[ActivityRecord]:
+        """Return the events matching all the given filters.
+
+        The most selective index available is used to find the candidate
+        events, and the remaining filters are applied to those candidates only.
+
+        Args:
+            date: Only return events starting on this date (YYYY-MM-DD).
+            city: Only return events in this city.
+            activity_ids: Only return events with one of these IDs. An empty
+                list or None disables this filter.
+
+        Returns:
+            The matching events, in calendar order.
+        """
+        if activity_ids:
+            rows = sorted({self._by_id[i] for i in activity_ids if i in self._by_id})
+        elif date:
+            rows = self._by_date.get(date, [])
+        elif city:
+            rows = self._by_city.get(city, [])
+        else:
+            rows = list(range(len(self._records)))
+
+        records = [self._records[row] for row in rows]
+        return [
+            record
+            for record in records
+            if (not date or record.start_time.startswith(date))
+            and (not city or record.city == city)
+        ]
+
+    def query_range(
+        self,
+        start_date: str,
+        end_date: str,
+        city: Optional[str] = None,
+    ) -> Dict[str, List[ActivityRecord]]:
+        """Return the events in a date window, grouped by day.
+
+        The window is located with a binary search over the sorted date
+        index, so only the days inside it are visited.
+
+        Args:
+            start_date: The first date of the window (YYYY-MM-DD), inclusive.
+            end_date: The last date of the window (YYYY-MM-DD), inclusive.
+            city: Only return events in this city.
+
+        Returns:
+            A dictionary mapping each date in the window that has matching
+            events to those events, in date order.
+        """
+        if self._sorted_dates is None:
+            self._sorted_dates = sorted(self._by_date)
+
+        lo = bisect.bisect_left(self._sorted_dates, start_date)
+        hi = bisect.bisect_right(self._sorted_dates, end_date)
+
+        activities_by_date: Dict[str, List[ActivityRecord]] = {}
+        for date in self._sorted_dates[lo:hi]:
+            records = [
+                self._records[row]
+                for row in self._by_date[date]
+                if not city or self._records[row].city == city
+            ]
+            if records:
+                activities_by_date[date] = records
+        return activities_by_date
+
+    def get(self, activity_id: str) -> Optional[ActivityRecord]:
+        """Return the event with the given ID, or None if not found."""
+        row = self._by_id.get(activity_id)
+        return None if row is None else self._records[row]
+
+    def interest_mask(self, activity_id: str) -> int:
+        """Return the precomputed interest bitmask of an event.
+
+        Raises:
+            KeyError: If no event has the given ID.
+        """
+        return self._records[self._by_id[activity_id]].interest_mask
+
+    def get_many(
+        self, activity_ids: Iterable[str]
+    ) -> Tuple[Dict[str, ActivityRecord], List[str]]:
+        """Look up several events by ID with one index probe per ID.
+
+        Args:
+            activity_ids: The IDs of the events to retrieve. Duplicates are
+                only looked up once.
+
+        Returns:
+            A tuple of the found events keyed by activity ID, and the list of
+            IDs that were not found, in the order they were first requested.
+        """
+        found: Dict[str, ActivityRecord] = {}
+        missing: List[str] = []
+        seen = set()
+        for activity_id in activity_ids:
+            if activity_id in seen:
+                continue
+            seen.add(activity_id)
+            row = self._by_id.get(activity_id)
+            if row is None:
+                missing.append(activity_id)
+            else:
+                found[activity_id] = self._records[row]
+        return found, missing
+
+    def to_columnar(self) -> ColumnarActivityCalendar:
+        """Return a columnar, NumPy-backed view of the events in the store."""
+        if self._columnar is None:
+            self._columnar = ColumnarActivityCalendar.from_records(self._records)
+        return self._columnar
+
+
+class ForecastStore:
+    """An indexed, in-memory store of daily weather forecasts.
+
+    Forecasts are normalized into ForecastRecords once and indexed by city
+    and date, with a sorted date index per city for answering date-window
+    queries. Queries return the shared records themselves rather than copies.
+    """
+
+    def __init__(self, forecasts: Iterable[Union[Dict[str, Any], ForecastRecord]] = ()) -> None:
+        """Initialize the ForecastStore.
+
+        Args:
+            forecasts: The daily forecasts or forecast records to index.
+        """
+        self._by_city: Dict[str, Dict[str, ForecastRecord]] = {}
+        self._sorted_dates: Dict[str, List[str]] = {}
+
+        for forecast in forecasts:
+            self.add(forecast)
+
+    def add(self, forecast: Union[Dict[str, Any], ForecastRecord]) -> None:
+        """Normalize a forecast and add it to the store indexes.
+
+        Args:
+            forecast: The daily forecast or record to add. A later forecast
+                for the same city and date replaces the earlier one.
+        """
+        record = (
+            forecast if isinstance(forecast, ForecastRecord)
+            else ForecastRecord.from_forecast(forecast)
+        )
+
+        forecasts_by_date = self._by_city.setdefault(record.city, {})
+        if record.date not in forecasts_by_date:
+            bisect.insort(self._sorted_dates.setdefault(record.city, []), record.date)
+        forecasts_by_date[record.date] = record
+
+    def __len__(self) -> int:
+        """Return the number of forecasts in the store."""
+        return sum(len(forecasts_by_date) for forecasts_by_date in self._by_city.values())
+
+    def __iter__(self) -> Iterator[ForecastRecord]:
+        """Iterate over the forecasts, by city and then by date."""
+        for city, dates in self._sorted_dates.items():
+            for date in dates:
+                yield self._by_city[city][date]
+
+    @property
+    def cities(self) -> AbstractSet[str]:
+        """Return the set of cities that have forecasts in the store."""
+        return self._by_city.keys()
+
+    def date_range(self, city: str) -> Optional[Tuple[str, str]]:
+        """Return the first and last forecast dates for a city, or None if it has none."""
+        dates = self._sorted_dates.get(city)
+        return (dates[0], dates[-1]) if dates else None
+
+    def get(self, date: str, city: str) -> Optional[ForecastRecord]:
+        """Return the forecast for a date and city, or None if not found."""
+        return self._by_city.get(city, {}).get(date)
+
+    def query_range(
+        self, start_date: str, end_date: str, city: str
+    ) -> Dict[str, ForecastRecord]:
+        """Return the forecasts for a city in a date window.
+
+        Args:
+            start_date: The first date of the window (YYYY-MM-DD), inclusive.
+            end_date: The last date of the window (YYYY-MM-DD), inclusive.
+            city: The city to get forecasts for.
+
+        Returns:
+            A dictionary mapping each date in the window that has a forecast
+            to that forecast, in date order.
+        """
+        dates = self._sorted_dates.get(city, [])
+        lo = bisect.bisect_left(dates, start_date)
+        hi = bisect.bisect_right(dates, end_date)
+        forecasts_by_date = self._by_city[city] if dates else {}
+        return {date: forecasts_by_date[date] for date in dates[lo:hi]}
+
+
+class ColumnarActivityCalendar:
+    """A columnar, NumPy-backed activity calendar with vectorized filters.
+
+    Each event is a row across parallel arrays, so filters run as NumPy
+    operations over whole columns instead of per-row Python comprehensions.
+    Queries return row indices; records and dictionaries are only
+    materialized on demand with `records` and `to_dicts`.
+
+    Attributes:
+        price (np.ndarray): The price of each event (int32).
+        start_epoch (np.ndarray): The start time of each event, in seconds
+            since the epoch (int64).
+        end_epoch (np.ndarray): The end time of each event, in seconds since
+            the epoch (int64).
+        city_code (np.ndarray): The index of each event's city in `cities`
+            (int32).
+        interest_mask (np.ndarray): The interest bitmask of each event (uint32).
+        setting_code (np.ndarray): The index of each event's setting in
+            ActivitySetting definition order (int8).
+        cities (List[str]): The city names, indexed by city code.
+    """
+
+    def __init__(
+        self,
+        price: Any,
+        start_epoch: Any,
+        end_epoch: Any,
+        city_code: Any,
+        interest_mask: Any,
+        setting_code: Any,
+        cities: List[str],
+        records: Sequence[ActivityRecord],
+    ) -> None:
+        """Initialize the calendar from its columns.
+
+        Args:
+            price: The price column.
+            start_epoch: The start time column, in epoch seconds.
+            end_epoch: The end time column, in epoch seconds.
+            city_code: The city code column.
+            interest_mask: The interest bitmask column.
+            setting_code: The activity setting code column.
+            cities: The city names, indexed by city code.
+            records: The activity records to materialize rows from, in row order.
+
+        Raises:
+            ImportError: If NumPy is not installed.
+        """
+        if not NUMPY_AVAILABLE:
+            raise ImportError("NumPy is required for ColumnarActivityCalendar.")
+
+        self.price = np.asarray(price, dtype=np.int32)
+        self.start_epoch = np.asarray(start_epoch, dtype=np.int64)
+        self.end_epoch = np.asarray(end_epoch, dtype=np.int64)
+        self.city_code = np.asarray(city_code, dtype=np.int32)
+        self.interest_mask = np.asarray(interest_mask, dtype=np.uint32)
+        self.setting_code = np.asarray(setting_code, dtype=np.int8)
+        self.cities = list(cities)
+        self._city_codes = {city: code for code, city in enumerate(self.cities)}
+        self._records = records
+        # Date-window filters become two binary searches on a sorted calendar.
+        self._is_sorted = bool(np.all(self.start_epoch[1:] >= self.start_epoch[:-1]))
+
+    @classmethod
+    def from_events(
+        cls,
+        events: Sequence[Dict[str, Any]],
+        default_city: str = DEFAULT_CITY,
+    ) -> ColumnarActivityCalendar:
+        """Build a columnar calendar from a list of activity events.
+
+        Args:
+            events: The activity events, e.g. ACTIVITY_CALENDAR.
+            default_city: The city of events without a "city" field.
+
+        Returns:
+            The columnar calendar.
+        """
+        return cls.from_records(
+            [ActivityRecord.from_event(event, default_city=default_city) for event in events]
+        )
+
+    @classmethod
+    def from_records(cls, records: Sequence[ActivityRecord]) -> ColumnarActivityCalendar:
+        """Build a columnar calendar from a list of activity records.
+
+        Args:
+            records: The activity records. The calendar keeps a reference to
+                this sequence to materialize rows from.
+
+        Returns:
+            The columnar calendar.
+        """
+        city_names = sorted({record.city for record in records})
+        city_codes = {city: code for code, city in enumerate(city_names)}
+        settings = list(ActivitySetting)
+
+        def to_epoch(times: List[str]) -> Any:
+            return np.array(times, dtype="datetime64[m]").astype("datetime64[s]").astype(np.int64)
+
+        return cls(
+            price=[record.price for record in records],
+            start_epoch=to_epoch([record.start_time for record in records]),
+            end_epoch=to_epoch([record.end_time for record in records]),
+            city_code=[city_codes[record.city] for record in records],
+            interest_mask=[record.interest_mask for record in records],
+            setting_code=[
+                settings.index(classify_activity_setting(record.description))
+                for record in records
+            ],
+            cities=city_names,
+            records=records,
+        )
+
+    def __len__(self) -> int:
+        """Return the number of events in the calendar."""
+        return len(self.price)
+
+    def query(
+        self,
+        start_date: Optional[Union[str, datetime.date]] = None,
+        end_date: Optional[Union[str, datetime.date]] = None,
+        max_price: Optional[int] = None,
+        interests: Optional[Iterable[Union[str, Interest]]] = None,
+        city: Optional[str] = None,
+        exclude_outdoor: bool = False,
+    ) -> Any:
+        """Return the row indices of the events matching all the given filters.
+
+        Args:
+            start_date: Only match events starting on or after this date.
+            end_date: Only match events starting on or before this date.
+            max_price: Only match events costing at most this much.
+            interests: Only match events related to any of these interests.
+            city: Only match events in this city.
+            exclude_outdoor: Exclude events classified as outdoor-only.
+
+        Returns:
+            A NumPy array of matching row indices, in ascending order.
+        """
+        lo, hi = 0, len(self)
+        start = None if start_date is None else self._day_epoch(start_date)
+        end = None if end_date is None else self._day_epoch(end_date) + 86400
+        if self._is_sorted:
+            if start is not None:
+                lo = int(np.searchsorted(self.start_epoch, start, side="left"))
+            if end is not None:
+                hi = int(np.searchsorted(self.start_epoch, end, side="left"))
+            start = end = None
+        if hi <= lo:
+            return np.arange(0)
+
+        mask = np.ones(hi - lo, dtype=bool)
+        if start is not None:
+            mask &= self.start_epoch[lo:hi] >= start
+        if end is not None:
+            mask &= self.start_epoch[lo:hi] < end
+        if max_price is not None:
+            mask &= self.price[lo:hi] <= max_price
+        if interests is not None:
+            mask &= (self.interest_mask[lo:hi] & interests_to_mask(interests)) != 0
+        if city is not None:
+            if city not in self._city_codes:
+                return np.arange(0)
+            mask &= self.city_code[lo:hi] == self._city_codes[city]
+        if exclude_outdoor:
+            outdoor = list(ActivitySetting).index(ActivitySetting.OUTDOOR)
+            mask &= self.setting_code[lo:hi] != outdoor
+
+        return np.flatnonzero(mask) + lo
+
+    def records(self, rows: Iterable[int]) -> List[ActivityRecord]:
+        """Return the activity records at the given row indices.
+
+        Args:
+            rows: The row indices, e.g. the result of `query`.
+
+        Returns:
+            The shared activity records, in the order of the given rows.
+        """
+        return [self._records[int(row)] for row in rows]
+
+    def to_dicts(self, rows: Iterable[int]) -> List[Dict[str, Union[str, int, List[str]]]]:
+        """Materialize the events at the given row indices as API dictionaries.
+
+        Args:
+            rows: The row indices, e.g. the result of `query`.
+
+        Returns:
+            The events in the activities API response format, in the order of
+            the given rows.
+        """
+        return [record.to_dict() for record in self.records(rows)]
+
+    @staticmethod
+    def _day_epoch(value: Union[str, datetime.date]) -> int:
+        """Return the epoch seconds of midnight UTC at the start of a date."""
+        day = datetime.date.fromisoformat(_to_iso_date(value))
+        return (day - datetime.date(1970, 1, 1)).days * 86400
+
+
+ACTIVITY_STORE = ActivityStore(ACTIVITY_CALENDAR)
+WEATHER_STORE = ForecastStore(WEATHER_FORECAST)
+
+
+def _to_iso_date(value: Union[str, datetime.date]) -> str:
+    """Convert a date, datetime or YYYY-MM-DD string into a YYYY-MM-DD string.
+
+    Raises:
+        ValueError: If a string value is not in the format YYYY-MM-DD.
+    """
+    if isinstance(value, datetime.datetime):
+        return value.date().isoformat()
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    return datetime.datetime.strptime(value, "%Y-%m-%d").date().isoformat()
+
+
+def _iter_iso_dates(start_date: str, end_date: str) -> Iterable[str]:
+    """Yield every YYYY-MM-DD date from start_date to end_date, inclusive."""
+    day = datetime.date.fromisoformat(start_date)
+    last = datetime.date.fromisoformat(end_date)
+    while day <= last:
+        yield day.isoformat()
+        day += datetime.timedelta(days=1)
+
+
+SNAPSHOT_FORMAT = "agentsville-calendar-snapshot"
+SNAPSHOT_VERSION = 1
+_SNAPSHOT_TEXT_FIELDS = (
+    "activity_id",
+    "name",
+    "start_time",
+    "end_time",
+    "location",
+    "description",
+    "related_interests",
+)
+_SNAPSHOT_NUMERIC_FIELDS = (
+    "price",
+    "start_epoch",
+    "end_epoch",
+    "city_code",
+    "interest_mask",
+    "setting_code",
+)
+
+
+def read_jsonl(path: str) -> Iterator[Dict[str, Any]]:
+    """Yield the JSON objects of a JSON Lines file, skipping blank lines.
+
+    Args:
+        path: The path of the JSONL file.
+    """
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def write_jsonl(path: str, rows: Iterable[Dict[str, Any]]) -> int:
+    """Write JSON objects to a JSON Lines file, one per line.
+
+    Args:
+        path: The path of the JSONL file.
+        rows: The JSON-serializable objects to write.
+
+    Returns:
+        The number of rows written.
+    """
+    count = 0
+    with open(path, "w", encoding="utf-8") as f:
+        for row in rows:
+            f.write(json.dumps(row, ensure_ascii=False))
+            f.write("\n")
+            count += 1
+    return count
+
+
+def write_calendar_snapshot(
+    path: str,
+    activities: Iterable[Union[Dict[str, Any], ActivityRecord]],
+    forecasts: Iterable[Union[Dict[str, Any], ForecastRecord]] = (),
+) -> None:
+    """Write activities and forecasts to a memory-mappable snapshot directory.
+
+    The snapshot stores one NumPy array per numeric column and, for each text
+    column, a UTF-8 blob with an array of row offsets into it. Opening it with
+    `SnapshotDataSource` maps these files instead of parsing them.
+
+    Args:
+        path: The snapshot directory. It is created if it does not exist.
+        activities: The activity events or records to write.
+        forecasts: The daily forecasts or forecast records to write.
+
+    Raises:
+        ImportError: If NumPy is not installed.
+    """
+    if not NUMPY_AVAILABLE:
+        raise ImportError("NumPy is required for calendar snapshots.")
+
+    records = [
+        activity if isinstance(activity, ActivityRecord) else ActivityRecord.from_event(activity)
+        for activity in activities
+    ]
+    columnar = ColumnarActivityCalendar.from_records(records)
+    os.makedirs(path, exist_ok=True)
+
+    for field in _SNAPSHOT_NUMERIC_FIELDS:
+        np.save(os.path.join(path, f"{field}.npy"), getattr(columnar, field))
+
+    for field in _SNAPSHOT_TEXT_FIELDS:
+        encoded = [
+            (",".join(record.related_interests) if field == "related_interests"
+             else getattr(record, field)).encode("utf-8")
+            for record in records
+        ]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(value) for value in encoded], out=offsets[1:])
+        np.save(os.path.join(path, f"{field}.offsets.npy"), offsets)
+        with open(os.path.join(path, f"{field}.bin"), "wb") as f:
+            f.write(b"".join(encoded))
+
+    write_jsonl(
+        os.path.join(path, "forecasts.jsonl"),
+        (
+            (forecast if isinstance(forecast, ForecastRecord)
+             else ForecastRecord.from_forecast(forecast)).to_dict()
+            for forecast in forecasts
+        ),
+    )
+
+    # The manifest is written last, so a partial snapshot fails to open.
+    with open(os.path.join(path, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "format": SNAPSHOT_FORMAT,
+                "version": SNAPSHOT_VERSION,
+                "num_activities": len(records),
+                "cities": columnar.cities,
+            },
+            f,
+        )
+
+
+class _ActivitySnapshot(Sequence[ActivityRecord]):
+    """A read-only sequence of activity records over a memory-mapped snapshot."""
+
+    def __init__(self, path: str) -> None:
+        """Map the columns of the snapshot at the given directory.
+
+        Raises:
+            ImportError: If NumPy is not installed.
+            ValueError: If the directory does not contain a supported snapshot.
+        """
+        if not NUMPY_AVAILABLE:
+            raise ImportError("NumPy is required for calendar snapshots.")
+
+        with open(os.path.join(path, "manifest.json"), encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get("format") != SNAPSHOT_FORMAT or manifest.get("version") != SNAPSHOT_VERSION:
+            raise ValueError(f"Unsupported calendar snapshot: {path}")
+
+        self.path = path
+        self.cities: List[str] = manifest["cities"]
+        self._length: int = manifest["num_activities"]
+        self._columns = {
+            field: np.load(os.path.join(path, f"{field}.npy"), mmap_mode="r")
+            for field in _SNAPSHOT_NUMERIC_FIELDS
+        }
+        self._offsets = {
+            field: np.load(os.path.join(path, f"{field}.offsets.npy"), mmap_mode="r")
+            for field in _SNAPSHOT_TEXT_FIELDS
+        }
+        self._blobs = {}
+        for field in _SNAPSHOT_TEXT_FIELDS:
+            blob_path = os.path.join(path, f"{field}.bin")
+            # np.memmap cannot map empty files.
+            self._blobs[field] = (
+                np.memmap(blob_path, dtype=np.uint8, mode="r")
+                if os.path.getsize(blob_path) else np.zeros(0, dtype=np.uint8)
+            )
+
+    def __len__(self) -> int:
+        """Return the number of activities in the snapshot."""
+        return self._length
+
+    def __getitem__(self, row: Any) -> Any:
+        """Decode the activity record at a row index."""
+        if isinstance(row, slice):
+            return [self[i] for i in range(*row.indices(self._length))]
+        if row < 0:
+            row += self._length
+        if not 0 <= row < self._length:
+            raise IndexError("snapshot row index out of range")
+
+        related_interests = self.text("related_interests", row)
+        return ActivityRecord(
+            activity_id=self.text("activity_id", row),
+            name=self.text("name", row),
+            start_time=self.text("start_time", row),
+            end_time=self.text("end_time", row),
+            location=self.text("location", row),
+            description=self.text("description", row),
+            price=int(self._columns["price"][row]),
+            related_interests=tuple(related_interests.split(",")) if related_interests else (),
+            city=self.city(row),
+            interest_mask=int(self._columns["interest_mask"][row]),
+        )
+
+    def __iter__(self) -> Iterator[ActivityRecord]:
+        """Iterate over the records, decoding them one at a time."""
+        for row in range(self._length):
+            yield self[row]
+
+    def text(self, field: str, row: int) -> str:
+        """Decode a single text field of a row."""
+        offsets = self._offsets[field]
+        return bytes(self._blobs[field][offsets[row]:offsets[row + 1]]).decode("utf-8")
+
+    def text_column(self, field: str) -> List[str]:
+        """Decode a whole text column at once."""
+        blob = bytes(self._blobs[field])
+        offsets = self._offsets[field].tolist()
+        return [blob[start:end].decode("utf-8") for start, end in zip(offsets, offsets[1:])]
+
+    def city(self, row: int) -> str:
+        """Return the city of a row."""
+        return self.cities[int(self._columns["city_code"][row])]
+
+    def city_column(self) -> List[str]:
+        """Return the city of every row."""
+        return [self.cities[code] for code in self._columns["city_code"].tolist()]
+
+    def to_columnar(self) -> ColumnarActivityCalendar:
+        """Return a columnar calendar over the mapped columns, without copying them."""
+        return ColumnarActivityCalendar(
+            cities=self.cities,
+            records=self,
+            **self._columns,
+        )
+
+
+class CalendarDataSource:
+    """Base class for the sources the activity and weather stores are loaded from.
+
+    Subclasses implement `load_activities` and `load_forecasts`; pass an
+    instance to `use_data_source` to serve the mocked APIs from it.
+    """
+
+    def load_activities(self) -> ActivityStore:
+        """Load the activity calendar into an ActivityStore."""
+        raise NotImplementedError
+
+    def load_forecasts(self) -> ForecastStore:
+        """Load the weather forecasts into a ForecastStore."""
+        raise NotImplementedError
+
+
+class InMemoryDataSource(CalendarDataSource):
+    """A data source over in-memory lists of activities and forecasts.
+
+    By default it serves the ACTIVITY_CALENDAR and WEATHER_FORECAST literals.
+    """
+
+    def __init__(
+        self,
+        activities: Iterable[Dict[str, Any]] = ACTIVITY_CALENDAR,
+        forecasts: Iterable[Dict[str, Any]] = WEATHER_FORECAST,
+        default_city: str = DEFAULT_CITY,
+    ) -> None:
+        """Initialize the InMemoryDataSource.
+
+        Args:
+            activities: The activity events.
+            forecasts: The daily weather forecasts.
+            default_city: The city of activity events without a "city" field.
+        """
+        self.activities = activities
+        self.forecasts = forecasts
+        self.default_city = default_city
+
+    def load_activities(self) -> ActivityStore:
+        """Load the activity calendar into an ActivityStore."""
+        return ActivityStore(self.activities, default_city=self.default_city)
+
+    def load_forecasts(self) -> ForecastStore:
+        """Load the weather forecasts into a ForecastStore."""
+        return ForecastStore(self.forecasts)
+
+
+class JsonlDataSource(CalendarDataSource):
+    """A data source reading activities and forecasts from JSON Lines files.
+
+    Each line of the activities file is an event shaped like the entries of
+    ACTIVITY_CALENDAR, optionally with a "city" field. Each line of the
+    forecasts file is shaped like the entries of WEATHER_FORECAST.
+    """
+
+    def __init__(
+        self,
+        activities_path: str,
+        forecasts_path: Optional[str] = None,
+        default_city: str = DEFAULT_CITY,
+    ) -> None:
+        """Initialize the JsonlDataSource.
+
+        Args:
+            activities_path: The path of the activities JSONL file.
+            forecasts_path: The path of the forecasts JSONL file, if any.
+            default_city: The city of activity events without a "city" field.
+        """
+        self.activities_path = activities_path
+        self.forecasts_path = forecasts_path
+        self.default_city = default_city
+
+    def load_activities(self) -> ActivityStore:
+        """Load the activity calendar into an ActivityStore."""
+        return ActivityStore(read_jsonl(self.activities_path), default_city=self.default_city)
+
+    def load_forecasts(self) -> ForecastStore:
+        """Load the weather forecasts into a ForecastStore."""
+        if self.forecasts_path is None:
+            return ForecastStore()
+        return ForecastStore(read_jsonl(self.forecasts_path))
+
+
+class SnapshotDataSource(CalendarDataSource):
+    """A data source over a memory-mapped snapshot from `write_calendar_snapshot`.
+
+    Worker processes that open the same snapshot share its pages through the
+    OS page cache instead of each parsing their own copy of the calendar.
+    """
+
+    def __init__(self, path: str) -> None:
+        """Initialize the SnapshotDataSource.
+
+        Args:
+            path: The snapshot directory.
+        """
+        self.path = path
+
+    def load_activities(self) -> ActivityStore:
+        """Open a read-only ActivityStore over the snapshot."""
+        return ActivityStore.from_snapshot(self.path)
+
+    def load_forecasts(self) -> ForecastStore:
+        """Load the snapshot's weather forecasts into a ForecastStore."""
+        return ForecastStore(read_jsonl(os.path.join(self.path, "forecasts.jsonl")))
+
+
+_SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS activities (
+    activity_id TEXT PRIMARY KEY,
+    city TEXT NOT NULL,
+    date TEXT NOT NULL,
+    name TEXT NOT NULL,
+    start_time TEXT NOT NULL,
+    end_time TEXT NOT NULL,
+    location TEXT NOT NULL,
+    description TEXT NOT NULL,
+    price INTEGER NOT NULL,
+    related_interests TEXT NOT NULL,
+    interest_mask INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS activity_interests (
+    interest TEXT NOT NULL,
+    activity_id TEXT NOT NULL,
+    PRIMARY KEY (interest, activity_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS forecasts (
+    city TEXT NOT NULL,
+    date TEXT NOT NULL,
+    temperature INTEGER NOT NULL,
+    temperature_unit TEXT NOT NULL,
+    condition TEXT NOT NULL,
+    description TEXT NOT NULL,
+    PRIMARY KEY (city, date)
+);
+"""
+
+# Indexes are created after a bulk import, which is faster than maintaining them row by row.
+_SQLITE_INDEXES = """
+CREATE INDEX IF NOT EXISTS activities_city_date ON activities (city, date);
+CREATE INDEX IF NOT EXISTS activities_date ON activities (date);
+"""
+
+_ACTIVITY_COLUMNS = (
+    "activity_id, name, start_time, end_time, location, description, price, "
+    "related_interests, city, interest_mask"
+)
+_SQL_ACTIVITIES_ALL = f"SELECT {_ACTIVITY_COLUMNS} FROM activities ORDER BY rowid"
+_SQL_ACTIVITIES_BY_DATE = f"SELECT {_ACTIVITY_COLUMNS} FROM activities WHERE date = ? ORDER BY rowid"
+_SQL_ACTIVITIES_BY_CITY = f"SELECT {_ACTIVITY_COLUMNS} FROM activities WHERE city = ? ORDER BY rowid"
+_SQL_ACTIVITIES_BY_CITY_DATE = (
+    f"SELECT {_ACTIVITY_COLUMNS} FROM activities WHERE city = ? AND date = ? ORDER BY rowid"
+)
+_SQL_ACTIVITIES_BY_DATE_RANGE = (
+    f"SELECT {_ACTIVITY_COLUMNS} FROM activities WHERE date BETWEEN ? AND ? ORDER BY date, rowid"
+)
+_SQL_ACTIVITIES_BY_CITY_DATE_RANGE = (
+    f"SELECT {_ACTIVITY_COLUMNS} FROM activities "
+    "WHERE city = ? AND date BETWEEN ? AND ? ORDER BY date, rowid"
+)
+_SQL_ACTIVITY_BY_ID = f"SELECT {_ACTIVITY_COLUMNS} FROM activities WHERE activity_id = ?"
+# A single prepared statement serves any number of IDs, passed as one JSON array.
+_SQL_ACTIVITIES_BY_IDS = (
+    f"SELECT {_ACTIVITY_COLUMNS} FROM activities "
+    "WHERE activity_id IN (SELECT value FROM json_each(?)) ORDER BY rowid"
+)
+_SQL_ACTIVITIES_BY_INTERESTS = (
+    f"SELECT {_ACTIVITY_COLUMNS} FROM activities WHERE activity_id IN ("
+    "SELECT activity_id FROM activity_interests WHERE interest IN (SELECT value FROM json_each(?))"
+    ") ORDER BY rowid"
+)
+_SQL_ACTIVITY_CITIES = "SELECT DISTINCT city FROM activities"
+_SQL_ACTIVITY_DATE_RANGE = "SELECT MIN(date), MAX(date) FROM activities"
+_SQL_ACTIVITY_CITY_DATE_RANGE = "SELECT MIN(date), MAX(date) FROM activities WHERE city = ?"
+_SQL_ACTIVITY_COUNT = "SELECT COUNT(*) FROM activities"
+
+_FORECAST_COLUMNS = "date, city, temperature, temperature_unit, condition, description"
+_SQL_FORECAST = f"SELECT {_FORECAST_COLUMNS} FROM forecasts WHERE city = ? AND date = ?"
+_SQL_FORECASTS_ALL = f"SELECT {_FORECAST_COLUMNS} FROM forecasts ORDER BY city, date"
+_SQL_FORECASTS_BY_DATE_RANGE = (
+    f"SELECT {_FORECAST_COLUMNS} FROM forecasts WHERE city = ? AND date BETWEEN ? AND ? ORDER BY date"
+)
+_SQL_FORECAST_CITIES = "SELECT DISTINCT city FROM forecasts"
+_SQL_FORECAST_DATE_RANGE = "SELECT MIN(date), MAX(date) FROM forecasts WHERE city = ?"
+_SQL_FORECAST_COUNT = "SELECT COUNT(*) FROM forecasts"
+
+
+def import_calendar_to_sqlite(
+    path: str,
+    activities: Iterable[Union[Dict[str, Any], ActivityRecord]] = ACTIVITY_CALENDAR,
+    forecasts: Iterable[Union[Dict[str, Any], ForecastRecord]] = WEATHER_FORECAST,
+    default_city: str = DEFAULT_CITY,
+    batch_size: int = 10_000,
+) -> Tuple[int, int]:
+    """Bulk import activities and forecasts into a SQLite calendar database.
+
+    The database and its tables are created if needed. Rows are inserted in
+    batches inside a single transaction, and indexes are built at the end.
+
+    Args:
+        path: The path of the SQLite database file.
+        activities: The activity events or records to import, in calendar
+            order. Defaults to ACTIVITY_CALENDAR.
+        forecasts: The daily forecasts or records to import. Defaults to
+            WEATHER_FORECAST.
+        default_city: The city of activity events without a "city" field.
+        batch_size: The number of rows inserted per executemany call.
+
+    Returns:
+        The number of activities and forecasts imported.
+    """
+    def activity_rows() -> Iterator[Tuple[Any, ...]]:
+        for activity in activities:
+            record = (
+                activity if isinstance(activity, ActivityRecord)
+                else ActivityRecord.from_event(activity, default_city=default_city)
+            )
+            yield (
+                record.activity_id, record.city, record.date, record.name, record.start_time,
+                record.end_time, record.location, record.description, record.price,
+                ",".join(record.related_interests), record.interest_mask,
+            )
+
+    def forecast_rows() -> Iterator[Tuple[Any, ...]]:
+        for forecast in forecasts:
+            record = (
+                forecast if isinstance(forecast, ForecastRecord)
+                else ForecastRecord.from_forecast(forecast)
+            )
+            yield (
+                record.city, record.date, record.temperature, record.temperature_unit,
+                record.condition, record.description,
+            )
+
+    def batches(rows: Iterator[Tuple[Any, ...]]) -> Iterator[List[Tuple[Any, ...]]]:
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    num_activities = num_forecasts = 0
+    connection = sqlite3.connect(path)
+    try:
+        connection.execute("PRAGMA journal_mode = WAL")
+        connection.execute("PRAGMA synchronous = OFF")
+        connection.executescript(_SQLITE_SCHEMA)
+        with connection:
+            for batch in batches(activity_rows()):
+                connection.executemany(
+                    "INSERT INTO activities VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", batch
+                )
+                connection.executemany(
+                    "INSERT OR IGNORE INTO activity_interests VALUES (?, ?)",
+                    [(interest, row[0]) for row in batch for interest in row[9].split(",") if interest],
+                )
+                num_activities += len(batch)
+            for batch in batches(forecast_rows()):
+                connection.executemany(
+                    "INSERT OR REPLACE INTO forecasts VALUES (?, ?, ?, ?, ?, ?)", batch
+                )
+                num_forecasts += len(batch)
+        connection.executescript(_SQLITE_INDEXES)
+        connection.execute("ANALYZE")
+    finally:
+        connection.close()
+
+    return num_activities, num_forecasts
+
+
+class SQLiteConnectionPool:
+    """A pool of read-only SQLite connections, one per thread.
+
+    sqlite3 caches the compiled form of each SQL statement per connection,
+    so keeping one long-lived connection per thread means every query
+    statement is prepared once per thread and then reused.
+    """
+
+    def __init__(self, path: str, cached_statements: int = 128) -> None:
+        """Initialize the SQLiteConnectionPool.
+
+        Args:
+            path: The path of the SQLite database file.
+            cached_statements: The number of prepared statements each
+                connection keeps.
+        """
+        self.path = path
+        self.cached_statements = cached_statements
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections: List[sqlite3.Connection] = []
+
+    def connection(self) -> sqlite3.Connection:
+        """Return the calling thread's connection, opening it if needed."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(
+                f"file:{self.path}?mode=ro",
+                uri=True,
+                cached_statements=self.cached_statements,
+                # Each connection is only used by its own thread; this allows close_all().
+                check_same_thread=False,
+            )
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    def execute(self, sql: str, parameters: Sequence[Any] = ()) -> sqlite3.Cursor:
+        """Execute a statement on the calling thread's connection."""
+        return self.connection().execute(sql, parameters)
+
+    def close_all(self) -> None:
+        """Close the connections of all threads."""
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
+        self._local = threading.local()
+
+
+def _activity_record_from_row(row: Tuple[Any, ...]) -> ActivityRecord:
+    """Build an ActivityRecord from a row selected with _ACTIVITY_COLUMNS."""
+    (activity_id, name, start_time, end_time, location, description, price,
+     related_interests, city, interest_mask) = row
+    return ActivityRecord(
+        activity_id=activity_id,
+        name=name,
+        start_time=start_time,
+        end_time=end_time,
+        location=location,
+        description=description,
+        price=price,
+        related_interests=tuple(related_interests.split(",")) if related_interests else (),
+        city=city,
+        interest_mask=interest_mask,
+    )
+
+
+class SQLiteActivityStore:
+    """An activity store backed by a SQLite database.
+
+    It implements the query interface of ActivityStore, so it can serve the
+    mocked activity APIs through `use_data_source(SQLiteDataSource(path))`.
+    Lookups use the indexes on (city, date), date, activity_id and interest.
+    """
+
+    def __init__(self, pool: SQLiteConnectionPool) -> None:
+        """Initialize the SQLiteActivityStore.
+
+        Args:
+            pool: The connection pool of the calendar database.
+        """
+        self._pool = pool
+        self._cities: Optional[AbstractSet[str]] = None
+        self._date_ranges: Dict[Optional[str], Optional[Tuple[str, str]]] = {}
+
+    def __len__(self) -> int:
+        """Return the number of events in the store."""
+        return self._pool.execute(_SQL_ACTIVITY_COUNT).fetchone()[0]
+
+    def __iter__(self) -> Iterator[ActivityRecord]:
+        """Iterate over the events, in calendar order."""
+        return map(_activity_record_from_row, self._pool.execute(_SQL_ACTIVITIES_ALL))
+
+    @property
+    def cities(self) -> AbstractSet[str]:
+        """Return the set of cities that have events in the store."""
+        if self._cities is None:
+            self._cities = frozenset(row[0] for row in self._pool.execute(_SQL_ACTIVITY_CITIES))
+        return self._cities
+
+    def date_range(self, city: Optional[str] = None) -> Optional[Tuple[str, str]]:
+        """Return the first and last dates (YYYY-MM-DD) with events.
+
+        Args:
+            city: Only consider events in this city.
+
+        Returns:
+            The (first, last) dates, or None if there are no matching events.
+        """
+        if city not in self._date_ranges:
+            if city is None:
+                first, last = self._pool.execute(_SQL_ACTIVITY_DATE_RANGE).fetchone()
+            else:
+                first, last = self._pool.execute(_SQL_ACTIVITY_CITY_DATE_RANGE, (city,)).fetchone()
+            self._date_ranges[city] = None if first is None else (first, last)
+        return self._date_ranges[city]
+
+    def query(
+        self,
+        date: Optional[str] = None,
+        city: Optional[str] = None,
+        activity_ids: Optional[List[str]] = None,
+    ) -> List[ActivityRecord]:
+        """Return the events matching all the given filters, in calendar order.
+
+        Args:
+            date: Only return events starting on this date (YYYY-MM-DD).
+            city: Only return events in this city.
+            activity_ids: Only return events with one of these IDs. An empty
+                list or None disables this filter.
+        """
+        if activity_ids:
+            cursor = self._pool.execute(_SQL_ACTIVITIES_BY_IDS, (json.dumps(list(activity_ids)),))
+            return [
+                record
+                for record in map(_activity_record_from_row, cursor)
+                if (not date or record.date == date) and (not city or record.city == city)
+            ]
+        if date and city:
+            cursor = self._pool.execute(_SQL_ACTIVITIES_BY_CITY_DATE, (city, date))
+        elif date:
+            cursor = self._pool.execute(_SQL_ACTIVITIES_BY_DATE, (date,))
+        elif city:
+            cursor = self._pool.execute(_SQL_ACTIVITIES_BY_CITY, (city,))
+        else:
+            cursor = self._pool.execute(_SQL_ACTIVITIES_ALL)
+        return [_activity_record_from_row(row) for row in cursor]
+
+    def query_range(
+        self,
+        start_date: str,
+        end_date: str,
+        city: Optional[str] = None,
+    ) -> Dict[str, List[ActivityRecord]]:
+        """Return the events in a date window, grouped by day.
+
+        Args:
+            start_date: The first date of the window (YYYY-MM-DD), inclusive.
+            end_date: The last date of the window (YYYY-MM-DD), inclusive.
+            city: Only return events in this city.
+
+        Returns:
+            A dictionary mapping each date in the window that has matching
+            events to those events, in date order.
+        """
+        if city:
+            cursor = self._pool.execute(_SQL_ACTIVITIES_BY_CITY_DATE_RANGE, (city, start_date, end_date))
+        else:
+            cursor = self._pool.execute(_SQL_ACTIVITIES_BY_DATE_RANGE, (start_date, end_date))
+
+        activities_by_date: Dict[str, List[ActivityRecord]] = {}
+        for record in map(_activity_record_from_row, cursor):
+            activities_by_date.setdefault(record.date, []).append(record)
+        return activities_by_date
+
+    def query_interests(
+        self,
+        interests: Iterable[Union[str, Interest]],
+        city: Optional[str] = None,
+    ) -> List[ActivityRecord]:
+        """Return the events related to any of the given interests, in calendar order.
+
+        Args:
+            interests: The interests to match.
+            city: Only return events in this city.
+        """
+        cursor = self._pool.execute(
+            _SQL_ACTIVITIES_BY_INTERESTS, (json.dumps([str(interest) for interest in interests]),)
+        )
+        return [
+            record
+            for record in map(_activity_record_from_row, cursor)
+            if not city or record.city == city
+        ]
+
+    def get(self, activity_id: str) -> Optional[ActivityRecord]:
+        """Return the event with the given ID, or None if not found."""
+        row = self._pool.execute(_SQL_ACTIVITY_BY_ID, (activity_id,)).fetchone()
+        return None if row is None else _activity_record_from_row(row)
+
+    def interest_mask(self, activity_id: str) -> int:
+        """Return the precomputed interest bitmask of an event.
+
+        Raises:
+            KeyError: If no event has the given ID.
+        """
+        record = self.get(activity_id)
+        if record is None:
+            raise KeyError(activity_id)
+        return record.interest_mask
+
+    def get_many(
+        self, activity_ids: Iterable[str]
+    ) -> Tuple[Dict[str, ActivityRecord], List[str]]:
+        """Look up several events by ID with a single query.
+
+        Args:
+            activity_ids: The IDs of the events to retrieve.
+
+        Returns:
+            A tuple of the found events keyed by activity ID, and the list of
+            IDs that were not found, in the order they were first requested.
+        """
+        requested = list(dict.fromkeys(activity_ids))
+        cursor = self._pool.execute(_SQL_ACTIVITIES_BY_IDS, (json.dumps(requested),))
+        records = {record.activity_id: record for record in map(_activity_record_from_row, cursor)}
+        found = {activity_id: records[activity_id] for activity_id in requested if activity_id in records}
+        missing = [activity_id for activity_id in requested if activity_id not in records]
+        return found, missing
+
+    def to_columnar(self) -> ColumnarActivityCalendar:
+        """Return a columnar, NumPy-backed copy of the events in the store."""
+        return ColumnarActivityCalendar.from_records(list(self))
+
+
+class SQLiteForecastStore:
+    """A weather forecast store backed by a SQLite database.
+
+    It implements the query interface of ForecastStore, so it can serve the
+    mocked weather APIs through `use_data_source(SQLiteDataSource(path))`.
+    """
+
+    def __init__(self, pool: SQLiteConnectionPool) -> None:
+        """Initialize the SQLiteForecastStore.
+
+        Args:
+            pool: The connection pool of the calendar database.
+        """
+        self._pool = pool
+        self._cities: Optional[AbstractSet[str]] = None
+        self._date_ranges: Dict[str, Optional[Tuple[str, str]]] = {}
+
+    def __len__(self) -> int:
+        """Return the number of forecasts in the store."""
+        return self._pool.execute(_SQL_FORECAST_COUNT).fetchone()[0]
+
+    def __iter__(self) -> Iterator[ForecastRecord]:
+        """Iterate over the forecasts, by city and then by date."""
+        return (ForecastRecord(*row) for row in self._pool.execute(_SQL_FORECASTS_ALL))
+
+    @property
+    def cities(self) -> AbstractSet[str]:
+        """Return the set of cities that have forecasts in the store."""
+        if self._cities is None:
+            self._cities = frozenset(row[0] for row in self._pool.execute(_SQL_FORECAST_CITIES))
+        return self._cities
+
+    def date_range(self, city: str) -> Optional[Tuple[str, str]]:
+        """Return the first and last forecast dates for a city, or None if it has none."""
+        if city not in self._date_ranges:
+            first, last = self._pool.execute(_SQL_FORECAST_DATE_RANGE, (city,)).fetchone()
+            self._date_ranges[city] = None if first is None else (first, last)
+        return self._date_ranges[city]
+
+    def get(self, date: str, city: str) -> Optional[ForecastRecord]:
+        """Return the forecast for a date and city, or None if not found."""
+        row = self._pool.execute(_SQL_FORECAST, (city, date)).fetchone()
+        return None if row is None else ForecastRecord(*row)
+
+    def query_range(
+        self, start_date: str, end_date: str, city: str
+    ) -> Dict[str, ForecastRecord]:
+        """Return the forecasts for a city in a date window, keyed by date."""
+        cursor = self._pool.execute(_SQL_FORECASTS_BY_DATE_RANGE, (city, start_date, end_date))
+        return {row[0]: ForecastRecord(*row) for row in cursor}
+
+
+class SQLiteDataSource(CalendarDataSource):
+    """A data source over a SQLite calendar database.
+
+    Create the database with `import_calendar_to_sqlite`. Both stores share
+    one per-thread connection pool.
+    """
+
+    def __init__(self, path: str) -> None:
+        """Initialize the SQLiteDataSource.
+
+        Args:
+            path: The path of the SQLite database file.
+        """
+        self.path = path
+        self.pool = SQLiteConnectionPool(path)
+
+    def load_activities(self) -> SQLiteActivityStore:
+        """Return an activity store querying the database."""
+        return SQLiteActivityStore(self.pool)
+
+    def load_forecasts(self) -> SQLiteForecastStore:
+        """Return a forecast store querying the database."""
+        return SQLiteForecastStore(self.pool)
+
+
+def use_data_source(source: CalendarDataSource) -> None:
+    """Serve the mocked activity and weather APIs from a data source.
+
+    The valid cities and date ranges accepted by the APIs are derived from
+    the loaded data. WEATHER_VERDICTS is replaced by an empty store, since
+    verdicts are keyed by activity ID and those of the previous calendar may
+    not apply; verdicts for the new calendar are filled in as activities are
+    checked.
+
+    Args:
+        source: The data source to load ACTIVITY_STORE and WEATHER_STORE from.
+    """
+    global ACTIVITY_STORE, WEATHER_STORE, WEATHER_VERDICTS
+    ACTIVITY_STORE = source.load_activities()
+    WEATHER_STORE = source.load_forecasts()
+    WEATHER_VERDICTS = WeatherVerdictStore()
+
+
+def call_activities_api_mocked(
+    date: Optional[str] = None,
+    city: Optional[str] = None,
+    activity_ids: Optional[List[str]] = None,
+) -> List[Dict[str, Union[str, int, List[str]]]]:
+    """Call the mocked activities API to get a list of activities.
+
+    This function simulates an API call to retrieve activities based on the
+    provided date and city parameters.
+
+    Args:
+        date: The date to get activities for. Must be in the format YYYY-MM-DD.
+        city: The city to get activities for. Must be a city of the loaded
+            activity calendar.
+        activity_ids: A list of activity IDs to filter the results. If None,
+            all activities for the date and city will be returned.
+
+    Returns:
+        A list of activities for the given date and city. Only dates within
+        the range of the loaded activity calendar return activities.
+    """
+    # Validate city parameter
+    if city and city not in ACTIVITY_STORE.cities:
+        return []
+
+    # Validate date format
+    if date:
+        try:
+            datetime.datetime.strptime(date, "%Y-%m-%d")
+        except ValueError:
+            print(f"Invalid date format: {date}")
+            return []
+
+    # Validate date range
+    valid_start, valid_end = ACTIVITY_STORE.date_range(city) or ("", "")
+    if date and (date < valid_start or date > valid_end):
+        print(f"Date {date} is outside the valid range ({valid_start} - {valid_end})")
+        return []
+
+    activities = [
+        record.to_dict()
+        for record in ACTIVITY_STORE.query(date=date, city=city, activity_ids=activity_ids)
+    ]
+
+    if not activities:
+        print(f"No activities found for {date} in {city}.")
+
+    return activities
+
+
+def call_activity_by_id_api_mocked(
+    activity_id: str,
+) -> Optional[Dict[str, Union[str, int, List[str]]]]:
+    """Call the mocked activity API to get an activity by its ID.
+
+    Args:
+        activity_id: The ID of the event to retrieve.
+
+    Returns:
+        A dictionary containing the event details, or None if not found.
+    """
+    record = ACTIVITY_STORE.get(activity_id)
+    if record is not None:
+        return record.to_dict()
+
+    print(f"Event with ID {activity_id} not found.")
+    return None
+
+
+def call_activities_by_ids_api_mocked(
+    activity_ids: Iterable[str],
+) -> Dict[str, Any]:
+    """Call the mocked activity API to get several activities by their IDs.
+
+    This is the batch counterpart of `call_activity_by_id_api_mocked`, meant
+    for validating a whole itinerary with one lookup per activity.
+
+    Args:
+        activity_ids: The IDs of the events to retrieve.
+
+    Returns:
+        A dictionary with two keys:
+            - "activities": the found events, keyed by activity ID.
+            - "missing_activity_ids": the requested IDs that were not found.
+    """
+    records, missing_activity_ids = ACTIVITY_STORE.get_many(activity_ids)
+
+    if missing_activity_ids:
+        print(f"Events with IDs {missing_activity_ids} not found.")
+
+    return {
+        "activities": {activity_id: record.to_dict() for activity_id, record in records.items()},
+        "missing_activity_ids": missing_activity_ids,
+    }
+
+
+def call_weather_api_mocked(date: str, city: str) -> Dict[str, Union[str, int]]:
+    """Return the weather forecast for a given date and city.
+
+    Args:
+        date: The date to get weather for. Must be in the format YYYY-MM-DD.
+        city: The city to get weather for.
+
+    Returns:
+        A dictionary containing the weather forecast for the given date and city.
+    """
+    # Validate city parameter
+    if city not in WEATHER_STORE.cities:
+        return {}
+
+    # Validate date format
+    try:
+        datetime.datetime.strptime(date, "%Y-%m-%d")
+    except ValueError:
+        print(f"Invalid date format: {date}")
+        return {}
+
+    # Validate date range
+    valid_start, valid_end = WEATHER_STORE.date_range(city) or ("", "")
+    if date < valid_start or date > valid_end:
+        print(f"Date {date} is outside the valid range ({valid_start} - {valid_end})")
+        return {}
+
+    record = WEATHER_STORE.get(date, city)
+    return record.to_dict() if record is not None else {}
+
+
+def call_activities_for_date_range_api_mocked(
+    start_date: Union[str, datetime.date],
+    end_date: Union[str, datetime.date],
+    city: Optional[str] = None,
+) -> Dict[str, List[Dict[str, Union[str, int, List[str]]]]]:
+    """Call the mocked activities API to get the activities for a date window.
+
+    This answers a whole trip in one sweep of the sorted date index, instead
+    of one `call_activities_api_mocked` call per day.
+
+    Args:
+        start_date: The first date of the window (YYYY-MM-DD or a date).
+        end_date: The last date of the window (YYYY-MM-DD or a date), inclusive.
+        city: The city to get activities for. Must be a city of the loaded
+            activity calendar.
+
+    Returns:
+        A dictionary mapping every date in the window, in order, to the list
+        of activities on that date. Dates without activities map to an empty
+        list. Returns an empty dictionary if the arguments are invalid.
+    """
+    # Validate city parameter
+    if city and city not in ACTIVITY_STORE.cities:
+        return {}
+
+    # Validate date format
+    try:
+        start, end = _to_iso_date(start_date), _to_iso_date(end_date)
+    except ValueError:
+        print(f"Invalid date format: {start_date} - {end_date}")
+        return {}
+
+    # Validate date range
+    valid_start, valid_end = ACTIVITY_STORE.date_range(city) or ("", "")
+    if start < valid_start or end > valid_end:
+        print(f"Dates {start} - {end} extend outside the valid range ({valid_start} - {valid_end})")
+
+    activities_by_date = ACTIVITY_STORE.query_range(
+        max(start, valid_start), min(end, valid_end), city=city
+    )
+    return {
+        date: [record.to_dict() for record in activities_by_date.get(date, [])]
+        for date in _iter_iso_dates(start, end)
+    }
+
+
+def call_weather_for_date_range_api_mocked(
+    start_date: Union[str, datetime.date],
+    end_date: Union[str, datetime.date],
+    city: str,
+) -> Dict[str, Dict[str, Union[str, int]]]:
+    """Return the weather forecasts for a date window and city.
+
+    This answers a whole trip in one sweep of the sorted date index, instead
+    of one `call_weather_api_mocked` call per day.
+
+    Args:
+        start_date: The first date of the window (YYYY-MM-DD or a date).
+        end_date: The last date of the window (YYYY-MM-DD or a date), inclusive.
+        city: The city to get weather for.
+
+    Returns:
+        A dictionary mapping every date in the window, in order, to the
+        forecast for that date. Dates without a forecast map to an empty
+        dictionary. Returns an empty dictionary if the arguments are invalid.
+    """
+    # Validate city parameter
+    if city not in WEATHER_STORE.cities:
+        return {}
+
+    # Validate date format
+    try:
+        start, end = _to_iso_date(start_date), _to_iso_date(end_date)
+    except ValueError:
+        print(f"Invalid date format: {start_date} - {end_date}")
+        return {}
+
+    # Validate date range
+    valid_start, valid_end = WEATHER_STORE.date_range(city) or ("", "")
+    if start < valid_start or end > valid_end:
+        print(f"Dates {start} - {end} extend outside the valid range ({valid_start} - {valid_end})")
+
+    forecasts_by_date = WEATHER_STORE.query_range(
+        max(start, valid_start), min(end, valid_end), city=city
+    )
+    return {
+        date: forecasts_by_date[date].to_dict() if date in forecasts_by_date else {}
+        for date in _iter_iso_dates(start, end)
+    }
+
+
+class CompatibilityCheckMode(str, Enum):
+    """How check_activities_weather_compatibility queries the model."""
+
+    SEQUENTIAL = "sequential"  # One request per activity, one at a time
+    CONCURRENT = "concurrent"  # One request per activity, fanned out to a thread pool
+    BATCHED = "batched"  # One structured-output request for the whole plan
+
+
+class WeatherCompatibilityVerdict(NamedTuple):
+    """The verdict on one (activity, weather) pair of a travel plan."""
+
+    date: str
+    activity_id: str
+    activity_name: str
+    weather_condition: str
+    is_compatible: bool
+    reasoning: str = ""
+
+
+DEFAULT_COMPATIBILITY_WORKERS = 8
+
+BATCHED_COMPATIBILITY_INSTRUCTIONS = """
+## Batch mode
+
+You will receive several numbered (activity, weather) pairs. Evaluate each pair
+independently with the rules above, and return one verdict per pair. Set
+is_compatible to true where you would answer IS_COMPATIBLE and to false where
+you would answer IS_INCOMPATIBLE.
+""".strip()
+
+_BATCHED_COMPATIBILITY_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "weather_compatibility_verdicts",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "verdicts": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "pair": {"type": "integer"},
+                            "reasoning": {"type": "string"},
+                            "is_compatible": {"type": "boolean"},
+                        },
+                        "required": ["pair", "reasoning", "is_compatible"],
+                        "additionalProperties": False,
+                    },
+                },
+            },
+            "required": ["verdicts"],
+            "additionalProperties": False,
+        },
     },
-    {
-        "activity_id": "event-2025-06-15-3",
-        "name": "Twilight Tennis Rally",
-        "start_time": "2025-06-15 18:00",
-        "end_time": "2025-06-15 20:00",
-        "location": "Grand Courts at Sunfield Park, AgentsVille",
-        "description": "Join us for a thrilling outdoor evening of tennis under the setting sun at the Grand Courts! Whether you're a beginner or a seasoned player, this event offers friendly matches, skill challenges, and social time with fellow tennis enthusiasts. Embrace the fresh air, lively music, and exciting giveaways all themed around the love of tennis. Don't miss your chance to rally, serve, and have fun! Perfect for those passionate about tennis, fitness, and meeting new people.",
-        "price": 15,
-        "related_interests": ["tennis", "fitness", "music"],
+}
+
+
+def iter_activity_weather_pairs(travel_plan: Any) -> Iterator[Tuple[str, Any, str]]:
+    """Iterate over the scheduled activities of a travel plan with their weather.
+
+    Args:
+        travel_plan: A TravelPlan model or its dictionary form.
+
+    Yields:
+        A (date, activity, weather condition) tuple per activity
+        recommendation, in plan order.
+    """
+    for itinerary_day in _field(travel_plan, "itinerary_days"):
+        date = str(_field(itinerary_day, "date"))
+        weather_condition = _field(_field(itinerary_day, "weather"), "condition")
+        for activity_recommendation in _field(itinerary_day, "activity_recommendations"):
+            yield date, _field(activity_recommendation, "activity"), weather_condition
+
+
+def format_activity_weather_prompt(activity: Any, weather_condition: str) -> str:
+    """Return the user prompt asking whether an activity suits the weather."""
+    return (
+        f"Activity: {_field(activity, 'name')}\n"
+        f"Description: {_field(activity, 'description')}\n"
+        f"Weather Condition: {weather_condition}"
+    )
+
+
+def parse_weather_compatibility_response(response: str) -> bool:
+    """Return whether a compatibility response answers IS_COMPATIBLE.
+
+    Raises:
+        RuntimeError: If the response contains neither answer.
+    """
+    if "IS_COMPATIBLE" in (response or ""):
+        return True
+    if "IS_INCOMPATIBLE" in (response or ""):
+        return False
+    raise RuntimeError(
+        f"Expected 'IS_COMPATIBLE' or 'IS_INCOMPATIBLE' in response, got: {response}"
+    )
+
+
+def format_incompatible_activities_message(verdicts: Iterable[WeatherCompatibilityVerdict]) -> str:
+    """Return the AgentError message listing the incompatible activities.
+
+    Returns:
+        The message, or an empty string if every activity is compatible.
+    """
+    incompatible = [verdict for verdict in verdicts if not verdict.is_compatible]
+    if not incompatible:
+        return ""
+
+    error_message = "The following activities are incompatible with the weather:\n"
+    for verdict in incompatible:
+        error_message += f"  - {verdict.date}: {verdict.activity_name} (Weather: {verdict.weather_condition})\n"
+    return error_message
+
+
+def _check_pairs_with_model(
+    pairs: Sequence[Tuple[Any, str]],
+    client: Any,
+    model: str,
+    system_prompt: str,
+    mode: CompatibilityCheckMode,
+    max_workers: int,
+    cache: Optional[ChatCompletionCache],
+) -> List[Tuple[bool, str]]:
+    """Ask the model for an (is_compatible, reasoning) verdict per (activity, condition) pair."""
+    if mode == CompatibilityCheckMode.BATCHED:
+        user_prompt = "\n\n".join(
+            f"Pair {i}:\n{format_activity_weather_prompt(activity, weather_condition)}"
+            for i, (activity, weather_condition) in enumerate(pairs)
+        )
+        response = do_chat_completion(
+            messages=[
+                {"role": "system", "content": f"{system_prompt}\n\n{BATCHED_COMPATIBILITY_INSTRUCTIONS}"},
+                {"role": "user", "content": user_prompt},
+            ],
+            model=model,
+            client=client,
+            cache=cache,
+            response_format=_BATCHED_COMPATIBILITY_RESPONSE_FORMAT,
+        )
+        try:
+            answers = {int(item["pair"]): item for item in json.loads(response)["verdicts"]}
+        except (ValueError, KeyError, TypeError) as e:
+            raise RuntimeError(f"Unexpected batched compatibility response: {response}") from e
+
+        missing = [i for i in range(len(pairs)) if i not in answers]
+        if missing:
+            raise RuntimeError(f"The batched compatibility response has no verdict for pairs {missing}.")
+        return [(bool(answers[i]["is_compatible"]), str(answers[i]["reasoning"])) for i in range(len(pairs))]
+
+    def check_pair(pair: Tuple[Any, str]) -> Tuple[bool, str]:
+        activity, weather_condition = pair
+        response = do_chat_completion(
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": format_activity_weather_prompt(activity, weather_condition)},
+            ],
+            model=model,
+            client=client,
+            cache=cache,
+        )
+        return parse_weather_compatibility_response(response), response
+
+    if mode == CompatibilityCheckMode.CONCURRENT:
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(pairs)))) as executor:
+            # Run each request in a copy of the caller's context to keep its call_label
+            futures = [executor.submit(contextvars.copy_context().run, check_pair, pair) for pair in pairs]
+            return [future.result() for future in futures]
+    return [check_pair(pair) for pair in pairs]
+
+
+def rule_based_weather_verdict(setting: ActivitySetting, weather_condition: str) -> Optional[bool]:
+    """Decide weather compatibility from an activity's setting, without a model.
+
+    Args:
+        setting: The setting of the activity (see classify_activity_setting).
+        weather_condition: The weather condition of the day.
+
+    Returns:
+        Whether the activity suits the weather, or None if the rules cannot
+        tell (an activity of unknown setting in inclement weather).
+    """
+    if _normalize_condition(weather_condition) not in INCLIMATE_WEATHER_CONDITIONS:
+        return True
+    if setting in (ActivitySetting.INDOOR, ActivitySetting.OUTDOOR_WITH_BACKUP):
+        return True
+    if setting == ActivitySetting.OUTDOOR:
+        return False
+    return None
+
+
+def _normalize_condition(weather_condition: str) -> str:
+    """Return the canonical spelling of a weather condition."""
+    return str(weather_condition).strip().lower()
+
+
+class WeatherVerdictStore:
+    """Weather-compatibility verdicts keyed by (activity_id, condition).
+
+    Verdicts are kept in memory and, when a path is given, persisted to a
+    SQLite database so later runs start with every verdict already known.
+    """
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        """Initialize the WeatherVerdictStore.
+
+        Args:
+            path: The path of the SQLite database to persist verdicts to.
+                Defaults to a memory-only store.
+        """
+        self.path = path
+        self._verdicts: Dict[Tuple[str, str], Tuple[bool, str]] = {}
+        self._lock = threading.Lock()
+        self._connection: Optional[sqlite3.Connection] = None
+
+        if path is not None:
+            self._connection = sqlite3.connect(path, check_same_thread=False)
+            with self._connection:
+                self._connection.execute(
+                    "CREATE TABLE IF NOT EXISTS weather_verdicts ("
+                    "activity_id TEXT NOT NULL, condition TEXT NOT NULL, "
+                    "is_compatible INTEGER NOT NULL, reasoning TEXT NOT NULL, "
+                    "PRIMARY KEY (activity_id, condition))"
+                )
+            for activity_id, condition, is_compatible, reasoning in self._connection.execute(
+                "SELECT activity_id, condition, is_compatible, reasoning FROM weather_verdicts"
+            ):
+                self._verdicts[(activity_id, condition)] = (bool(is_compatible), reasoning)
+
+    def __len__(self) -> int:
+        """Return the number of stored verdicts."""
+        return len(self._verdicts)
+
+    def __contains__(self, key: Tuple[str, str]) -> bool:
+        """Return whether a verdict is stored for an (activity_id, condition) pair."""
+        activity_id, weather_condition = key
+        return (activity_id, _normalize_condition(weather_condition)) in self._verdicts
+
+    def get(self, activity_id: str, weather_condition: str) -> Optional[Tuple[bool, str]]:
+        """Return the (is_compatible, reasoning) verdict of a pair, or None if unknown."""
+        return self._verdicts.get((activity_id, _normalize_condition(weather_condition)))
+
+    def set(self, activity_id: str, weather_condition: str, is_compatible: bool, reasoning: str = "") -> None:
+        """Store the verdict of a pair.
+
+        Args:
+            activity_id: The ID of the activity.
+            weather_condition: The weather condition.
+            is_compatible: Whether the activity suits the weather.
+            reasoning: Why, for the record.
+        """
+        key = (activity_id, _normalize_condition(weather_condition))
+        with self._lock:
+            self._verdicts[key] = (is_compatible, reasoning)
+            if self._connection is not None:
+                with self._connection:
+                    self._connection.execute(
+                        "INSERT OR REPLACE INTO weather_verdicts VALUES (?, ?, ?, ?)",
+                        (*key, int(is_compatible), reasoning),
+                    )
+
+    def close(self) -> None:
+        """Close the database. Stored verdicts stay readable from memory."""
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+def precompute_weather_verdicts(
+    activities: Optional[Iterable[Any]] = None,
+    conditions: Iterable[str] = INCLIMATE_WEATHER_CONDITIONS,
+    verdicts: Optional[WeatherVerdictStore] = None,
+    client: Optional[Any] = None,
+    model: Optional[str] = None,
+    system_prompt: Optional[str] = None,
+    mode: Union[str, CompatibilityCheckMode] = CompatibilityCheckMode.BATCHED,
+    max_workers: int = DEFAULT_COMPATIBILITY_WORKERS,
+) -> List[Tuple[str, str]]:
+    """Decide the weather compatibility of every activity once and store it.
+
+    Activities are classified as indoor, outdoor or outdoor with an indoor
+    backup from their descriptions. Pairs the rules cannot decide are sent to
+    the model once, if a client is given. Pairs already in the store are
+    skipped, so only unseen activities cost anything.
+
+    Args:
+        activities: The activity events or records. Defaults to ACTIVITY_STORE.
+        conditions: The weather conditions to judge each activity against.
+            Defaults to INCLIMATE_WEATHER_CONDITIONS.
+        verdicts: The store to fill. Defaults to WEATHER_VERDICTS.
+        client: The OpenAI client for the fallback, if any.
+        model: The model for the fallback.
+        system_prompt: The single-pair compatibility prompt for the fallback.
+        mode: How to query the model (see CompatibilityCheckMode).
+        max_workers: The maximum number of concurrent fallback requests.
+
+    Returns:
+        The (activity_id, condition) pairs left undecided, which is only
+        non-empty when no client is given.
+
+    Raises:
+        ValueError: If a client is given without a model and system prompt.
+    """
+    activities = ACTIVITY_STORE if activities is None else activities
+    verdicts = WEATHER_VERDICTS if verdicts is None else verdicts
+    conditions = [_normalize_condition(condition) for condition in conditions]
+
+    # Apply the rules and collect the pairs they cannot decide
+    undecided: List[Tuple[Any, str]] = []
+    for activity in activities:
+        activity_id = str(_field(activity, "activity_id"))
+        setting = None
+        for condition in conditions:
+            if (activity_id, condition) in verdicts:
+                continue
+            if setting is None:
+                setting = classify_activity_setting(_field(activity, "description"))
+            is_compatible = rule_based_weather_verdict(setting, condition)
+            if is_compatible is None:
+                undecided.append((activity, condition))
+            else:
+                verdicts.set(activity_id, condition, is_compatible, f"rule: {setting.value} activity")
+
+    if not undecided or client is None:
+        return [(str(_field(activity, "activity_id")), condition) for activity, condition in undecided]
+
+    if model is None or system_prompt is None:
+        raise ValueError("A model and system prompt are required for the LLM fallback.")
+
+    # Ask the model once for the rest, behind interactive requests
+    with request_priority(RequestPriority.BACKGROUND):
+        results = _check_pairs_with_model(
+            undecided, client, model, system_prompt, CompatibilityCheckMode(mode), max_workers, cache=None
+        )
+    for (activity, condition), (is_compatible, reasoning) in zip(undecided, results):
+        verdicts.set(str(_field(activity, "activity_id")), condition, is_compatible, reasoning)
+    return []
+
+
+def _stored_or_rule_verdict(
+    activity: Any, weather_condition: str, verdicts: Optional[WeatherVerdictStore]
+) -> Optional[Tuple[bool, str]]:
+    """Return the verdict of a pair from the store or the rules, or None if neither decides.
+
+    Rule verdicts for inclement conditions are added to the store, so each
+    activity is classified at most once per condition.
+    """
+    activity_id = str(_field(activity, "activity_id"))
+    if verdicts is not None:
+        verdict = verdicts.get(activity_id, weather_condition)
+        if verdict is not None:
+            return verdict
+    setting = classify_activity_setting(_field(activity, "description"))
+    is_compatible = rule_based_weather_verdict(setting, weather_condition)
+    if is_compatible is None:
+        return None
+    verdict = (is_compatible, f"rule: {setting.value} activity")
+    if verdicts is not None and _normalize_condition(weather_condition) in INCLIMATE_WEATHER_CONDITIONS:
+        verdicts.set(activity_id, weather_condition, *verdict)
+    return verdict
+
+
+def check_activities_weather_compatibility(
+    travel_plan: Any,
+    client: Any,
+    model: str,
+    system_prompt: str,
+    mode: Union[str, CompatibilityCheckMode] = CompatibilityCheckMode.SEQUENTIAL,
+    max_workers: int = DEFAULT_COMPATIBILITY_WORKERS,
+    cache: Optional[ChatCompletionCache] = None,
+    verdicts: Optional[WeatherVerdictStore] = None,
+) -> List[WeatherCompatibilityVerdict]:
+    """Ask the model whether each activity of a travel plan suits its day's weather.
+
+    All modes return the same verdicts in plan order, so callers can build
+    the same AgentError message with format_incompatible_activities_message.
+
+    Args:
+        travel_plan: A TravelPlan model or its dictionary form.
+        client: The OpenAI client instance.
+        model: The model to use for the checks.
+        system_prompt: The single-pair compatibility prompt, which must ask
+            for an IS_COMPATIBLE or IS_INCOMPATIBLE final answer.
+        mode: "sequential", "concurrent" or "batched".
+        max_workers: The maximum number of concurrent requests in
+            concurrent mode.
+        cache: A response cache for the requests.
+        verdicts: A verdict store (e.g. WEATHER_VERDICTS). Known pairs are
+            looked up and rule-decidable pairs are settled without asking
+            the model; new verdicts for inclement weather are added to the
+            store.
+
+    Returns:
+        One verdict per activity recommendation, in plan order.
+
+    Raises:
+        ValueError: If the mode is unknown.
+        RuntimeError: If the model returns an unexpected response.
+    """
+    mode = CompatibilityCheckMode(mode)
+    pairs = list(iter_activity_weather_pairs(travel_plan))
+
+    # Look up the known verdicts, then apply the rules to unseen pairs
+    results: List[Optional[Tuple[bool, str]]] = [None] * len(pairs)
+    if verdicts is not None:
+        for i, (_, activity, weather_condition) in enumerate(pairs):
+            results[i] = _stored_or_rule_verdict(activity, weather_condition, verdicts)
+
+    # Ask the model about the rest
+    unknown = [i for i, result in enumerate(results) if result is None]
+    if unknown:
+        answers = _check_pairs_with_model(
+            [(pairs[i][1], pairs[i][2]) for i in unknown],
+            client, model, system_prompt, mode, max_workers, cache,
+        )
+        for i, answer in zip(unknown, answers):
+            results[i] = answer
+            if verdicts is not None:
+                verdicts.set(str(_field(pairs[i][1], "activity_id")), pairs[i][2], *answer)
+
+    return [
+        WeatherCompatibilityVerdict(
+            date=date,
+            activity_id=str(_field(activity, "activity_id")),
+            activity_name=str(_field(activity, "name")),
+            weather_condition=str(weather_condition),
+            is_compatible=is_compatible,
+            reasoning=reasoning,
+        )
+        for (date, activity, weather_condition), (is_compatible, reasoning) in zip(pairs, results)
+    ]
+
+
+# Verdicts for the loaded calendar, filled in lazily as activities are checked
+# and replaced by use_data_source()
+WEATHER_VERDICTS = WeatherVerdictStore()
+
+
+# The solver's default cap on activities per day
+DEFAULT_MAX_ACTIVITIES_PER_DAY = 4
+# Beyond this many distinct interest profiles, which travelers are covered is
+# no longer tracked (2^profiles states) and the solver only maximizes matches
+SOLVER_MAX_COVERAGE_PROFILES = 10
+
+
+class _DayOption(NamedTuple):
+    """A set of non-overlapping activities for one day, scored for the solver."""
+
+    activities: Tuple[ActivityRecord, ...]
+    cost: int
+    covered: int  # Bitmask of the interest profiles with a matching activity
+    hits: int  # Matching (traveler, activity) pairs
+
+
+class _PartialPlan(NamedTuple):
+    """The solver's choices for the days so far."""
+
+    cost: int
+    hits: int
+    covered: int
+    choices: Tuple[_DayOption, ...]
+
+
+def _pareto_front(options: Iterable[Any], key: Callable[[Any], Hashable] = lambda option: option.covered) -> List[Any]:
+    """Keep, per key, only the options no cheaper option matches or beats in hits."""
+    by_key: Dict[Hashable, List[Any]] = {}
+    for option in options:
+        by_key.setdefault(key(option), []).append(option)
+
+    front = []
+    for group in by_key.values():
+        best_hits = -1
+        for option in sorted(group, key=lambda option: (option.cost, -option.hits)):
+            if option.hits > best_hits:
+                front.append(option)
+                best_hits = option.hits
+    return front
+
+
+def _activity_is_weather_safe(
+    activity: ActivityRecord, weather_condition: str, verdicts: Optional[WeatherVerdictStore], allow_unknown: bool
+) -> bool:
+    """Return whether an activity can be scheduled in a weather condition, from stored verdicts or rules."""
+    verdict = _stored_or_rule_verdict(activity, weather_condition, verdicts)
+    return allow_unknown if verdict is None else verdict[0]
+
+
+def _day_options(
+    activities: List[ActivityRecord],
+    profiles: List[Tuple[int, int]],
+    min_count: int,
+    max_count: int,
+    track_coverage: bool = True,
+) -> List[_DayOption]:
+    """Find the Pareto-optimal sets of non-overlapping activities for a day.
+
+    A dynamic program over the activities in order of end time. The sets
+    whose last activity is among the first i activities are kept as a
+    Pareto front of (cost, hits) per (count, covered) key, pruned as it is
+    built, so the work grows with the number of activities times the front
+    size instead of with the number of subsets.
+
+    Args:
+        activities: The suitable activities of the day.
+        profiles: The distinct (interest mask, number of travelers) pairs of
+            the group.
+        min_count: The minimum number of activities.
+        max_count: The maximum number of activities.
+        track_coverage: Whether to key the fronts on which profiles are
+            covered, or only on the number of activities.
+    """
+    activities = sorted(activities, key=lambda record: (record.end_time, record.start_time))
+    end_times = [record.end_time for record in activities]
+    options: List[_DayOption] = [_DayOption((), 0, 0, 0)]
+    # fronts[i]: the non-empty sets whose last activity is one of activities[:i + 1]
+    fronts: List[List[_DayOption]] = []
+    for i, record in enumerate(activities):
+        covered = hits = 0
+        for position, (profile_mask, travelers) in enumerate(profiles):
+            if profile_mask & record.interest_mask:
+                covered |= 1 << position
+                hits += travelers
+        if not track_coverage:
+            covered = 0
+
+        # Activities may start when the previous one ends
+        before = bisect.bisect_right(end_times, record.start_time, 0, i)
+        extended = [
+            _DayOption(
+                option.activities + (record,),
+                option.cost + record.price,
+                option.covered | covered,
+                option.hits + hits,
+            )
+            for option in options[:1] + (fronts[before - 1] if before else [])
+            if len(option.activities) < max_count
+        ]
+        fronts.append(_pareto_front(
+            (fronts[-1] if fronts else []) + extended,
+            key=lambda option: (len(option.activities), option.covered),
+        ))
+
+    candidates = options[:1] + (fronts[-1] if fronts else [])
+    return _pareto_front(option for option in candidates if len(option.activities) >= min_count)
+
+
+def _recommendation_reasons(
+    record: ActivityRecord, travelers: List[Tuple[str, int]], weather_condition: str
+) -> List[str]:
+    """Explain deterministically why the solver picked an activity."""
+    reasons = []
+    for name, traveler_mask in travelers:
+        shared = mask_to_interests(traveler_mask & record.interest_mask)
+        if shared:
+            reasons.append(f"Matches {name}'s interest in {', '.join(interest.value for interest in shared)}.")
+    if _normalize_condition(weather_condition) in INCLIMATE_WEATHER_CONDITIONS:
+        setting = classify_activity_setting(record.description)
+        reasons.append(f"Suitable for {weather_condition} weather ({setting.value} activity).")
+    return reasons or ["Fits the schedule and budget."]
+
+
+def solve_itinerary(
+    vacation_info: Any,
+    min_activities_per_day: int = 1,
+    max_activities_per_day: int = DEFAULT_MAX_ACTIVITIES_PER_DAY,
+    budget: Optional[int] = None,
+    verdicts: Optional[WeatherVerdictStore] = None,
+    allow_unknown_weather: bool = False,
+) -> Dict[str, Any]:
+    """Plan an itinerary with an exact solver instead of a model.
+
+    For each day, a dynamic program over the activities that suit the day's
+    weather finds the Pareto-optimal sets of non-overlapping activities. A
+    second one over the days, keyed on which travelers already have a
+    matching activity, then keeps the cheapest plans for each number of
+    interest matches. The result covers every traveler's interests if
+    possible, stays within the budget, and among those has the most interest
+    matches, then the lowest cost. Both run in milliseconds for hundreds of
+    activities a day.
+
+    Travelers with the same interests are tracked together. For groups with
+    more than SOLVER_MAX_COVERAGE_PROFILES distinct interest profiles,
+    coverage is not tracked and the plan has the most interest matches.
+
+    The plan passes the date, cost, budget, event and interest evals by
+    construction and avoids outdoor activities in inclement weather, so a
+    model only needs to write the reasons (see annotate_plan_reasons).
+
+    Args:
+        vacation_info: The vacation information (travelers, destination,
+            date_of_arrival, date_of_departure, budget), as the notebook's
+            VacationInfo model or a dictionary.
+        min_activities_per_day: The minimum number of activities per day.
+        max_activities_per_day: The maximum number of activities per day.
+        budget: The budget. Defaults to vacation_info's budget.
+        verdicts: Weather verdicts to consult before the rules. Defaults to
+            WEATHER_VERDICTS.
+        allow_unknown_weather: Whether activities of unknown setting may be
+            scheduled in inclement weather.
+
+    Returns:
+        The travel plan as a dictionary in the TravelPlan format, e.g.
+        TravelPlan.model_validate(solve_itinerary(vacation_info)).
+
+    Raises:
+        ValueError: If the activity counts are invalid, if a day has no
+            forecast or not enough suitable activities, or if no plan fits the
+            budget.
+    """
+    if not 0 <= min_activities_per_day <= max_activities_per_day:
+        raise ValueError(
+            f"Invalid activities per day: min {min_activities_per_day}, max {max_activities_per_day}."
+        )
+    verdicts = WEATHER_VERDICTS if verdicts is None else verdicts
+    city = str(_field(vacation_info, "destination"))
+    budget = int(_field(vacation_info, "budget")) if budget is None else budget
+    travelers = [
+        (str(_field(traveler, "name")), interests_to_mask(str(interest) for interest in _field(traveler, "interests")))
+        for traveler in _field(vacation_info, "travelers")
+    ]
+    profile_sizes: Dict[int, int] = {}
+    for _, mask in travelers:
+        profile_sizes[mask] = profile_sizes.get(mask, 0) + 1
+    profiles = list(profile_sizes.items())
+    track_coverage = len(profiles) <= SOLVER_MAX_COVERAGE_PROFILES
+    dates = list(_iter_iso_dates(
+        _to_iso_date(_field(vacation_info, "date_of_arrival")),
+        _to_iso_date(_field(vacation_info, "date_of_departure")),
+    ))
+
+    # Find the suitable activity sets of each day
+    forecasts = []
+    options_by_day = []
+    for date in dates:
+        forecast = WEATHER_STORE.get(date, city)
+        if forecast is None:
+            raise ValueError(f"No weather forecast for {city} on {date}.")
+        suitable = [
+            record for record in ACTIVITY_STORE.query(date=date, city=city)
+            if _activity_is_weather_safe(record, forecast.condition, verdicts, allow_unknown_weather)
+        ]
+        options = _day_options(suitable, profiles, min_activities_per_day, max_activities_per_day, track_coverage)
+        if not options:
+            raise ValueError(
+                f"Not enough activities suitable for {forecast.condition} weather in {city} on {date} "
+                f"({len(suitable)} suitable, {min_activities_per_day} required)."
+            )
+        forecasts.append(forecast)
+        options_by_day.append(options)
+
+    # Dynamic program over days: Pareto-optimal (cost, hits) partial plans per covered set
+    partials = [_PartialPlan(0, 0, 0, ())]
+    for options in options_by_day:
+        extended = [
+            _PartialPlan(
+                partial.cost + option.cost,
+                partial.hits + option.hits,
+                partial.covered | option.covered,
+                partial.choices + (option,),
+            )
+            for partial in partials
+            for option in options
+            if partial.cost + option.cost <= budget
+        ]
+        if not extended:
+            raise ValueError(
+                f"No itinerary with {min_activities_per_day} activities per day fits the budget of {budget}."
+            )
+        partials = _pareto_front(extended)
+
+    def travelers_covered(partial: _PartialPlan) -> int:
+        return sum(size for position, (_, size) in enumerate(profiles) if partial.covered >> position & 1)
+
+    best = max(partials, key=lambda partial: (travelers_covered(partial), partial.hits, -partial.cost))
+
+    itinerary_days = []
+    for date, forecast, option in zip(dates, forecasts, best.choices):
+        itinerary_days.append({
+            "date": date,
+            "weather": {
+                "temperature": forecast.temperature,
+                "temperature_unit": forecast.temperature_unit,
+                "condition": forecast.condition,
+            },
+            "activity_recommendations": [
+                {
+                    "activity": record.to_dict(),
+                    "reasons_for_recommendation": _recommendation_reasons(record, travelers, forecast.condition),
+                }
+                for record in option.activities
+            ],
+        })
+    return {
+        "city": city,
+        "start_date": dates[0],
+        "end_date": dates[-1],
+        "total_cost": best.cost,
+        "itinerary_days": itinerary_days,
+    }
+
+
+ANNOTATE_REASONS_SYSTEM_PROMPT = """
+You are a friendly travel assistant. You are given the travelers' vacation
+information and a finished itinerary. For each activity, write one to three
+short reasons the travelers will enjoy it, mentioning which traveler's
+interests it matches and, on rainy or stormy days, why it suits the weather.
+Do not change, add or remove activities.
+""".strip()
+
+_ANNOTATE_REASONS_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "activity_reasons",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "activities": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "activity_id": {"type": "string"},
+                            "reasons_for_recommendation": {"type": "array", "items": {"type": "string"}},
+                        },
+                        "required": ["activity_id", "reasons_for_recommendation"],
+                        "additionalProperties": False,
+                    },
+                }
+            },
+            "required": ["activities"],
+            "additionalProperties": False,
+        },
     },
-]
+}
+
+
+def annotate_plan_reasons(
+    travel_plan: Dict[str, Any],
+    vacation_info: Any,
+    client: Any,
+    model: str,
+    system_prompt: str = ANNOTATE_REASONS_SYSTEM_PROMPT,
+    **kwargs: Any,
+) -> Dict[str, Any]:
+    """Have a model write the reasons_for_recommendation of a solved plan.
+
+    The model sees the activities' IDs, names and descriptions and returns
+    only reasons, in one structured call; the activities, costs and weather
+    stay exactly as solved. Activities the model skips keep their
+    deterministic reasons, and if the response cannot be parsed, the error
+    is logged and every activity keeps them.
+
+    Args:
+        travel_plan: A plan from solve_itinerary.
+        vacation_info: The vacation information the plan was solved for.
+        client: The OpenAI client instance.
+        model: The model to use.
+        system_prompt: The instructions for the model.
+        **kwargs: Additional arguments to pass to do_chat_completion.
 
+    Returns:
+        A copy of the plan with the model's reasons.
+    """
+    if hasattr(vacation_info, "model_dump_json"):
+        vacation_json = vacation_info.model_dump_json()
+    else:
+        vacation_json = json.dumps(vacation_info, default=str)
+    days = [
+        {
+            "date": day["date"],
+            "weather": day["weather"]["condition"],
+            "activities": [
+                {
+                    "activity_id": rec["activity"]["activity_id"],
+                    "name": rec["activity"]["name"],
+                    "description": rec["activity"]["description"],
+                    "related_interests": rec["activity"]["related_interests"],
+                }
+                for rec in day["activity_recommendations"]
+            ],
+        }
+        for day in travel_plan["itinerary_days"]
+    ]
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": f"Vacation information: {vacation_json}\n\nItinerary: {json.dumps(days)}"},
+    ]
 
-INCLIMATE_WEATHER_CONDITIONS = ["thunderstorm", "rainy"]
+    with call_label("annotate_plan_reasons"):
+        response = do_chat_completion(
+            messages, model=model, client=client, response_format=_ANNOTATE_REASONS_RESPONSE_FORMAT, **kwargs
+        )
+    try:
+        reasons = {
+            str(item["activity_id"]): [str(reason) for reason in item["reasons_for_recommendation"]]
+            for item in json.loads(response)["activities"]
+        }
+    except (json.JSONDecodeError, KeyError, TypeError) as e:
+        logger.warning("Could not parse the model's recommendation reasons, keeping the solver's: %r", e)
+        reasons = {}
 
-WEATHER_FORECAST = [
-    {
-        "date": "2025-06-10",
-        "city": "AgentsVille",
-        "temperature": 31,
-        "temperature_unit": "celsius",
-        "condition": "clear",
-        "description": "A bright and sunny day in AgentsVille with clear skies and warm temperatures. Perfect weather for outdoor activities!",
-    },
-    {
-        "date": "2025-06-11",
-        "city": "AgentsVille",
-        "temperature": 34,
-        "temperature_unit": "celsius",
-        "condition": "partly cloudy",
-        "description": "A warm day with periods of sunshine and mixed clouds, making it a perfect opportunity for outdoor activities.",
-    },
-    {
-        "date": "2025-06-12",
-        "city": "AgentsVille",
-        "temperature": 28,
-        "temperature_unit": "celsius",
-        "condition": "thunderstorm",
-        "description": "A thunderstorm is expected to roll in during the afternoon, bringing heavy rain and gusty winds. The atmosphere will feel charged with humidity, creating a sultry and dramatic setting as clouds build in the sky.",
-    },
-    {
-        "date": "2025-06-13",
-        "city": "AgentsVille",
-        "temperature": 15,
-        "temperature_unit": "celsius",
-        "condition": "rainy",
-        "description": "Cloudy skies with intermittent rain showers throughout the day, accompanied by a cool breeze and a chance of occasional thunderstorms.",
-    },
-    {
-        "date": "2025-06-14",
-        "city": "AgentsVille",
-        "temperature": 14,
-        "temperature_unit": "celsius",
-        "condition": "rainy",
-        "description": "A steady rain is expected throughout the day with overcast skies and cool temperatures. Residents should be prepared for slick roads and carry umbrellas.",
-    },
-    {
-        "date": "2025-06-15",
-        "city": "AgentsVille",
-        "temperature": 31,
-        "temperature_unit": "celsius",
-        "condition": "sunny",
-        "description": "A bright and sunny day perfect for outdoor activities with no chance of rain.",
+    annotated = json.loads(json.dumps(travel_plan))
+    for day in annotated["itinerary_days"]:
+        for rec in day["activity_recommendations"]:
+            if reasons.get(rec["activity"]["activity_id"]):
+                rec["reasons_for_recommendation"] = reasons[rec["activity"]["activity_id"]]
+    return annotated
+
+
+DEFAULT_DESCRIPTION_CHARS = 80
+
+
+def _interest_codes() -> Dict[str, str]:
+    """Return the shortest unique prefix code of each interest, at least three letters."""
+    values = [interest.value for interest in Interest]
+    length = 3
+    while len({value[:length] for value in values}) < len(values):
+        length += 1
+    return {value: value[:length] for value in values}
+
+
+# Short codes for the compact prompt encoding, e.g. "technology" -> "tec"
+INTEREST_CODES: Dict[str, str] = _interest_codes()
+SETTING_CODES: Dict[ActivitySetting, str] = {
+    ActivitySetting.INDOOR: "I",
+    ActivitySetting.OUTDOOR: "O",
+    ActivitySetting.OUTDOOR_WITH_BACKUP: "B",
+    ActivitySetting.UNKNOWN: "?",
+}
+
+COMPACT_PLAN_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "compact_travel_plan",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "days": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "date": {"type": "string"},
+                            "activities": {
+                                "type": "array",
+                                "items": {
+                                    "type": "object",
+                                    "properties": {
+                                        "id": {"type": "string"},
+                                        "reasons": {"type": "array", "items": {"type": "string"}},
+                                    },
+                                    "required": ["id", "reasons"],
+                                    "additionalProperties": False,
+                                },
+                            },
+                        },
+                        "required": ["date", "activities"],
+                        "additionalProperties": False,
+                    },
+                }
+            },
+            "required": ["days"],
+            "additionalProperties": False,
+        },
     },
-]
+}
 
 
-def call_activities_api_mocked(
-    date: Optional[str] = None,
-    city: Optional[str] = None,
-    activity_ids: Optional[List[str]] = None,
-) -> List[Dict[str, Union[str, int, List[str]]]]:
-    """Call the mocked activities API to get a list of activities.
+def _summarize_description(description: str, max_chars: int) -> str:
+    """Return the first sentence of a description, truncated to max_chars."""
+    summary = " ".join(description.split())
+    sentence_end = re.search(r"[.!?](\s|$)", summary)
+    if sentence_end is not None:
+        summary = summary[: sentence_end.start() + 1]
+    if len(summary) > max_chars:
+        summary = summary[: max_chars - 1].rstrip() + "…"
+    return summary.replace("|", "/")
 
-    This function simulates an API call to retrieve activities based on the
-    provided date and city parameters.
 
-    Args:
-        date: The date to get activities for. Must be in the format YYYY-MM-DD.
-        city: The city to get activities for. Only "AgentsVille" is supported.
-        activity_ids: A list of activity IDs to filter the results. If None,
-            all activities for the date and city will be returned.
+class CompactCandidates(NamedTuple):
+    """The candidate activities and weather of a trip, encoded compactly for a prompt.
 
-    Returns:
-        A list of activities for the given date and city. Currently only
-        returns activities for AgentsVille between 2025-06-10 and 2025-06-15.
+    Attributes:
+        text: The encoding: a legend, a weather table and an activity table
+            with short IDs.
+        activities: The activity record of each short ID.
+        forecasts: The forecast of each trip date that has one.
+        dropped: Why each pre-filtered activity was left out, by activity ID.
+        city: The city of the trip.
+        dates: The dates of the trip, from arrival to departure.
     """
-    # Validate city parameter
-    if city and city != "AgentsVille":
-        return []
 
-    # Validate date format
-    if date:
-        try:
-            datetime.datetime.strptime(date, "%Y-%m-%d")
-        except ValueError:
-            print(f"Invalid date format: {date}")
-            return []
+    text: str
+    activities: Dict[str, ActivityRecord]
+    forecasts: Dict[str, ForecastRecord]
+    dropped: Dict[str, str]
+    city: str
+    dates: Tuple[str, ...]
 
-    # Validate date range
-    valid_start = "2025-06-10"
-    valid_end = "2025-06-15"
-    if date and (date < valid_start or date > valid_end):
-        print(f"Date {date} is outside the valid range ({valid_start} - {valid_end})")
-        return []
+    def expand_plan(self, compact_plan: Union[str, Dict[str, Any]]) -> Dict[str, Any]:
+        """Expand a plan answered in COMPACT_PLAN_RESPONSE_FORMAT into the TravelPlan format.
+
+        Activities are copied from the calendar and the weather and total
+        cost are filled in, so only the choice of activities and the reasons
+        come from the model.
+
+        Args:
+            compact_plan: The model's answer, as JSON or parsed.
 
-    # Filter activities
-    activities: List[Dict[str, Union[str, int, List[str]]]] = []
-    for event in ACTIVITY_CALENDAR:
-        activity: Dict[str, Union[str, int, List[str]]] = {
-            "activity_id": str(event["activity_id"]),
-            "name": str(event["name"]),
-            "start_time": str(event["start_time"]),
-            "end_time": str(event["end_time"]),
-            "location": str(event["location"]),
-            "description": str(event["description"]),
-            "price": int(event["price"]),  # type: ignore
-            "related_interests": [
-                str(interest)
-                for interest in event["related_interests"]  # type: ignore
+        Returns:
+            The travel plan as a dictionary in the TravelPlan format.
+
+        Raises:
+            ValueError: If the trip has no dates or a date has no forecast, or
+                if the plan uses an unknown short ID or date, places an
+                activity on another day than its own, or repeats an activity.
+        """
+        if not self.dates:
+            raise ValueError("The trip has no dates.")
+        missing = [date for date in self.dates if date not in self.forecasts]
+        if missing:
+            raise ValueError(f"No weather forecast for {self.city} on {', '.join(missing)}.")
+        if isinstance(compact_plan, str):
+            compact_plan = json.loads(compact_plan)
+
+        chosen: Dict[str, List[Dict[str, Any]]] = {date: [] for date in self.dates}
+        seen = set()
+        for day in compact_plan["days"]:
+            date = str(day["date"])
+            if date not in chosen:
+                raise ValueError(f"Date {date} is not part of the trip.")
+            for item in day["activities"]:
+                short_id = str(item["id"])
+                record = self.activities.get(short_id)
+                if record is None:
+                    raise ValueError(f"Unknown activity ID: {short_id}")
+                if record.start_time[:10] != date:
+                    raise ValueError(f"Activity {short_id} takes place on {record.start_time[:10]}, not {date}.")
+                if short_id in seen:
+                    raise ValueError(f"Activity {short_id} appears more than once in the plan.")
+                seen.add(short_id)
+                chosen[date].append({
+                    "activity": record.to_dict(),
+                    "reasons_for_recommendation": [str(reason) for reason in item["reasons"]],
+                })
+
+        dates = self.dates
+        return {
+            "city": self.city,
+            "start_date": dates[0],
+            "end_date": dates[-1],
+            "total_cost": sum(rec["activity"]["price"] for recs in chosen.values() for rec in recs),
+            "itinerary_days": [
+                {
+                    "date": date,
+                    "weather": {
+                        "temperature": self.forecasts[date].temperature,
+                        "temperature_unit": self.forecasts[date].temperature_unit,
+                        "condition": self.forecasts[date].condition,
+                    },
+                    "activity_recommendations": sorted(chosen[date], key=lambda rec: rec["activity"]["start_time"]),
+                }
+                for date in dates
             ],
         }
-        activities.append(activity)
 
-    if date:
-        activities = [
-            event for event in activities if str(event["start_time"]).startswith(date)
-        ]
 
-    if activity_ids:
-        activities = [
-            event for event in activities if event["activity_id"] in activity_ids
-        ]
+def encode_candidates_compact(
+    vacation_info: Any,
+    description_chars: int = DEFAULT_DESCRIPTION_CHARS,
+    prefilter: bool = True,
+    allow_unknown_weather: bool = False,
+    verdicts: Optional[WeatherVerdictStore] = None,
+) -> CompactCandidates:
+    """Encode a trip's candidate activities and weather as compact tables.
 
-    if not activities:
-        print(f"No activities found for {date} in {city}.")
+    A drop-in for embedding json.dumps(activities, indent=2) and the weather
+    in the ItineraryAgent prompt. Activities get short IDs (A1, A2, ...),
+    first-sentence descriptions, an indoor/outdoor flag and interest codes.
+    With prefilter, activities matching nobody's interests or unsuited to the
+    day's weather are left out. Have the model answer in
+    COMPACT_PLAN_RESPONSE_FORMAT and rebuild the plan with expand_plan.
 
-    return activities
+    Args:
+        vacation_info: The vacation information (travelers, destination,
+            date_of_arrival, date_of_departure), as the notebook's
+            VacationInfo model or a dictionary.
+        description_chars: The maximum length of a description.
+        prefilter: Whether to leave out activities nobody can use.
+        allow_unknown_weather: Whether to keep activities of unknown setting
+            on inclement days.
+        verdicts: Weather verdicts to consult before the rules. Defaults to
+            WEATHER_VERDICTS.
 
+    Returns:
+        The encoding, with the mappings needed to expand the model's answer.
+    """
+    verdicts = WEATHER_VERDICTS if verdicts is None else verdicts
+    city = str(_field(vacation_info, "destination"))
+    wanted = 0
+    for traveler in _field(vacation_info, "travelers"):
+        wanted |= interests_to_mask(str(interest) for interest in _field(traveler, "interests"))
+    dates = list(_iter_iso_dates(
+        _to_iso_date(_field(vacation_info, "date_of_arrival")),
+        _to_iso_date(_field(vacation_info, "date_of_departure")),
+    ))
 
-def call_activity_by_id_api_mocked(
-    activity_id: str,
-) -> Optional[Dict[str, Union[str, int, List[str]]]]:
-    """Call the mocked activity API to get an activity by its ID.
+    forecasts: Dict[str, ForecastRecord] = {}
+    activities: Dict[str, ActivityRecord] = {}
+    dropped: Dict[str, str] = {}
+    weather_rows = ["date|weather|temp"]
+    activity_rows = ["id|date|time|price|set|interests|name|summary"]
+    for date in dates:
+        forecast = WEATHER_STORE.get(date, city)
+        if forecast is not None:
+            forecasts[date] = forecast
+            unit = forecast.temperature_unit[:1].upper()
+            weather_rows.append(f"{date}|{forecast.condition}|{forecast.temperature}{unit}")
+
+        for record in ACTIVITY_STORE.query(date=date, city=city):
+            if prefilter and not record.interest_mask & wanted:
+                dropped[record.activity_id] = "matches no traveler's interests"
+                continue
+            if (
+                prefilter
+                and forecast is not None
+                and not _activity_is_weather_safe(record, forecast.condition, verdicts, allow_unknown_weather)
+            ):
+                dropped[record.activity_id] = f"unsuitable for {forecast.condition} weather"
+                continue
+
+            short_id = f"A{len(activities) + 1}"
+            activities[short_id] = record
+            # Interests outside the Interest enum have no code and are written out
+            interests = ",".join(INTEREST_CODES.get(interest, interest) for interest in record.related_interests)
+            activity_rows.append("|".join([
+                short_id,
+                date,
+                f"{record.start_time[11:16]}-{record.end_time[11:16]}",
+                str(record.price),
+                SETTING_CODES[classify_activity_setting(record.description)],
+                interests,
+                record.name.replace("|", "/"),
+                _summarize_description(record.description, description_chars),
+            ]))
+
+    used = {interest for record in activities.values() for interest in record.related_interests}
+    codes = ", ".join(f"{code}={value}" for value, code in INTEREST_CODES.items() if value in used)
+    legend = [
+        f"Interest codes: {codes}",
+        "set: I=indoor, O=outdoor, B=outdoor with indoor backup, ?=unknown",
+        "Refer to activities by id only.",
+    ]
+    text = "\n".join(legend + ["", "WEATHER"] + weather_rows + ["", "ACTIVITIES"] + activity_rows)
+    return CompactCandidates(text, activities, forecasts, dropped, city, tuple(dates))
+
+
+class EvalCost(str, Enum):
+    """The cost class of an evaluation function."""
+
+    CHEAP = "cheap"  # Deterministic checks on the plan, e.g. dates and totals
+    LLM = "llm"  # Checks that call a model
+
+
+DEFAULT_EVAL_WORKERS = 8
+
+
+def eval_cost(cost: Union[str, EvalCost]) -> Callable[[Callable[..., Any]], Callable[..., Any]]:
+    """Tag an evaluation function with its cost class for run_evals.
+
+    Examples:
+        >>> @eval_cost("cheap")
+        ... def eval_start_end_dates_match(vacation_info, final_output):
+        ...     pass
+        >>> get_eval_cost(eval_start_end_dates_match)
+        <EvalCost.CHEAP: 'cheap'>
+    """
+    cost = EvalCost(cost)
+
+    def decorator(eval_fn: Callable[..., Any]) -> Callable[..., Any]:
+        eval_fn.eval_cost = cost
+        return eval_fn
+
+    return decorator
+
+
+def get_eval_cost(eval_fn: Callable[..., Any]) -> EvalCost:
+    """Return the cost class of an evaluation function. Untagged ones count as LLM."""
+    return EvalCost(getattr(eval_fn, "eval_cost", EvalCost.LLM))
+
+
+def run_evals(
+    vacation_info: Any,
+    final_output: Any,
+    eval_functions: List[Callable[..., Any]],
+    error_type: type = Exception,
+    fail_fast: bool = False,
+    max_workers: int = DEFAULT_EVAL_WORKERS,
+    result_type: Optional[Callable[..., Any]] = None,
+) -> Any:
+    """Run evaluation functions with the LLM-backed ones in parallel.
+
+    A drop-in for the notebooks' get_eval_results. Cheap checks run in the
+    calling thread while the LLM-backed ones run in a thread pool. Failures
+    are reported in eval_functions order, whatever order the evals finish in.
+    Their chat completions have RequestPriority.BACKGROUND, so a scheduler
+    serves interactive requests first.
 
     Args:
-        activity_id: The ID of the event to retrieve.
+        vacation_info: The vacation information used to generate the plan.
+        final_output: The travel plan to evaluate.
+        eval_functions: The evaluation functions. Tag them with eval_cost.
+        error_type: The exception an eval raises to report a failure, e.g.
+            AgentError. Other exceptions propagate.
+        fail_fast: Run the cheap checks first and return without running the
+            LLM-backed ones if any of them fails.
+        max_workers: The maximum number of LLM-backed evals run at once.
+        result_type: A class to build the result with, e.g. EvaluationResults.
 
     Returns:
-        A dictionary containing the event details, or None if not found.
+        The success flag, failure messages and names of the evals that ran,
+        as a dictionary or as result_type(**dictionary).
     """
-    for event in ACTIVITY_CALENDAR:
-        if event["activity_id"] == activity_id:
-            return {
-                "activity_id": str(event["activity_id"]),
-                "name": str(event["name"]),
-                "start_time": str(event["start_time"]),
-                "end_time": str(event["end_time"]),
-                "location": str(event["location"]),
-                "description": str(event["description"]),
-                "price": int(event["price"]),  # type: ignore
-                "related_interests": [
-                    str(interest)
-                    for interest in event["related_interests"]  # type: ignore
-                ],
-            }
+    cheap = [fn for fn in eval_functions if get_eval_cost(fn) == EvalCost.CHEAP]
+    expensive = [fn for fn in eval_functions if get_eval_cost(fn) != EvalCost.CHEAP]
+    failures: Dict[Callable[..., Any], str] = {}
 
-    print(f"Event with ID {activity_id} not found.")
-    return None
+    def run_eval(eval_fn: Callable[..., Any]) -> Optional[str]:
+        try:
+            with call_label(eval_fn.__name__), request_priority(RequestPriority.BACKGROUND):
+                eval_fn(vacation_info, final_output)
+        except error_type as e:
+            return str(e)
+        return None
 
+    def run_cheap() -> None:
+        for eval_fn in cheap:
+            error_msg = run_eval(eval_fn)
+            if error_msg is not None:
+                failures[eval_fn] = error_msg
+
+    ran = list(eval_functions)
+    if fail_fast:
+        run_cheap()
+        if failures:
+            ran = cheap
+            expensive = []
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(expensive) or 1))) as executor:
+        futures = {eval_fn: executor.submit(run_eval, eval_fn) for eval_fn in expensive}
+        if not fail_fast:
+            run_cheap()
+        for eval_fn, future in futures.items():
+            error_msg = future.result()
+            if error_msg is not None:
+                failures[eval_fn] = error_msg
+
+    # Report failures in eval_functions order
+    eval_results = []
+    for eval_fn in ran:
+        if eval_fn in failures:
+            print_in_box(failures[eval_fn], title="Evaluation Error")
+            print("\n\n")
+            eval_results.append(failures[eval_fn])
+
+    results = {
+        "success": len(eval_results) == 0,
+        "failures": eval_results,
+        "eval_functions": [fn.__name__ for fn in ran],
+    }
+    return result_type(**results) if result_type is not None else results
+
+
+class EvalScope(str, Enum):
+    """The part of a travel plan an evaluation function depends on."""
+
+    PLAN = "plan"  # The whole plan, e.g. dates and totals
+    DAY = "day"  # One itinerary day at a time
+    ACTIVITY = "activity"  # One activity recommendation and its day's weather
+
+
+def eval_scope(scope: Union[str, EvalScope]) -> Callable[[Callable[..., Any]], Callable[..., Any]]:
+    """Tag an evaluation function with its scope for IncrementalEvaluator.
+
+    A DAY or ACTIVITY scoped eval must only depend on the vacation info and
+    the day or activity it is given: it is run on a copy of the plan holding
+    just that day, or just that activity.
+    """
+    scope = EvalScope(scope)
+
+    def decorator(eval_fn: Callable[..., Any]) -> Callable[..., Any]:
+        eval_fn.eval_scope = scope
+        return eval_fn
+
+    return decorator
+
+
+def get_eval_scope(eval_fn: Callable[..., Any]) -> EvalScope:
+    """Return the scope of an evaluation function. Untagged ones cover the whole plan."""
+    return EvalScope(getattr(eval_fn, "eval_scope", EvalScope.PLAN))
+
+
+def _content_hash(value: Any) -> str:
+    """Return a SHA-256 digest of the JSON content of a value or model."""
+    payload = json.dumps(value, sort_keys=True, separators=(",", ":"), default=_cache_key_default)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
 
-def call_weather_api_mocked(date: str, city: str) -> Dict[str, Union[str, int]]:
-    """Return the weather forecast for a given date and city.
+
+def _with_fields(obj: Any, **updates: Any) -> Any:
+    """Return a shallow copy of a dictionary or pydantic model with some fields replaced."""
+    if isinstance(obj, dict):
+        return {**obj, **updates}
+    return obj.model_copy(update=updates)
+
+
+def _plan_header(travel_plan: Any) -> Any:
+    """Return the fields of a travel plan other than its itinerary days."""
+    if isinstance(travel_plan, dict):
+        return {key: value for key, value in travel_plan.items() if key != "itinerary_days"}
+    return travel_plan.model_dump(mode="json", exclude={"itinerary_days"})
+
+
+def diff_plans(old_plan: Optional[Any], new_plan: Any) -> Dict[str, Any]:
+    """Compare two travel plans by content.
+
+    Activities are compared per day as a multiset, so an activity
+    recommended twice in a day is counted twice and a reordering of a day's
+    recommendations changes the day but none of its activities.
 
     Args:
-        date: The date to get weather for. Must be in the format YYYY-MM-DD.
-        city: The city to get weather for.
+        old_plan: The previous plan, or None.
+        new_plan: The revised plan.
 
     Returns:
-        A dictionary containing the weather forecast for the given date and city.
+        A dictionary with whether the plan-level fields changed
+        ("plan_fields_changed"), the dates of new or changed days
+        ("changed_days"), the dates of removed days ("removed_days"), and the
+        (date, activity_id) pairs of new or changed activities
+        ("changed_activities") and of removed ones ("removed_activities"),
+        one pair per occurrence.
     """
-    # Validate city parameter
-    if city != "AgentsVille":
-        return {}
+    def day_hashes(travel_plan: Optional[Any]) -> Dict[str, Tuple[str, Counter]]:
+        if travel_plan is None:
+            return {}
+        return {
+            str(_field(day, "date")): (
+                _content_hash(day),
+                Counter(
+                    (str(_field(_field(rec, "activity"), "activity_id")), _content_hash((_field(day, "weather"), rec)))
+                    for rec in _field(day, "activity_recommendations")
+                ),
+            )
+            for day in _field(travel_plan, "itinerary_days")
+        }
 
-    # Validate date format
-    try:
-        datetime.datetime.strptime(date, "%Y-%m-%d")
-    except ValueError:
-        print(f"Invalid date format: {date}")
-        return {}
+    old_days, new_days = day_hashes(old_plan), day_hashes(new_plan)
+    changed_days = [date for date, (digest, _) in new_days.items() if old_days.get(date, ("",))[0] != digest]
+    changed_activities, removed_activities = [], []
+    for date in changed_days:
+        old_activities = old_days.get(date, ("", Counter()))[1]
+        new_activities = new_days[date][1]
+        changed_activities += [(date, activity_id) for activity_id, _ in (new_activities - old_activities).elements()]
+        old_ids = Counter(activity_id for activity_id, _ in old_activities.elements())
+        new_ids = Counter(activity_id for activity_id, _ in new_activities.elements())
+        removed_activities += [(date, activity_id) for activity_id in (old_ids - new_ids).elements()]
+    return {
+        "plan_fields_changed": old_plan is None
+        or _content_hash(_plan_header(old_plan)) != _content_hash(_plan_header(new_plan)),
+        "changed_days": changed_days,
+        "removed_days": [date for date in old_days if date not in new_days],
+        "changed_activities": changed_activities,
+        "removed_activities": removed_activities,
+    }
 
-    # Validate date range
-    valid_start = "2025-06-10"
-    valid_end = "2025-06-15"
-    if date < valid_start or date > valid_end:
-        print(f"Date {date} is outside the valid range ({valid_start} - {valid_end})")
-        return {}
 
-    for forecast in WEATHER_FORECAST:
-        if forecast["date"] == date:
-            return {
-                "date": str(forecast["date"]),
-                "city": str(forecast["city"]),
-                "temperature": int(forecast["temperature"]),  # type: ignore
-                "temperature_unit": str(forecast["temperature_unit"]),
-                "condition": str(forecast["condition"]),
-                "description": str(forecast["description"]),
-            }
+class IncrementalEvaluator:
+    """Re-evaluate revised travel plans, re-running only the affected evals.
+
+    Each eval is split into units by its scope (see eval_scope): the whole
+    plan, one unit per day, or one unit per activity recommendation. Unit
+    outcomes are memoized by content, so after a small revision only the
+    units of changed days or activities run again; the rest are reused. The
+    memo keeps the max_memo_entries most recently used outcomes.
+
+    Failures of a DAY or ACTIVITY scoped eval are reported as one failure
+    joining the distinct messages of its failing units.
+
+    Attributes:
+        vacation_info: The vacation information the plans are evaluated against.
+        eval_functions (List[Callable]): The evaluation functions.
+        last_diff (Optional[Dict[str, Any]]): How the last evaluated plan
+            differed from the one before (see diff_plans).
+        stats (Dict[str, int]): Counts of evaluations, and of units run and
+            reused from the memo.
+    """
+
+    def __init__(
+        self,
+        vacation_info: Any,
+        eval_functions: List[Callable[..., Any]],
+        error_type: type = Exception,
+        max_workers: int = DEFAULT_EVAL_WORKERS,
+        result_type: Optional[Callable[..., Any]] = None,
+        max_memo_entries: int = 4096,
+    ) -> None:
+        """Initialize the IncrementalEvaluator.
+
+        Args:
+            vacation_info: The vacation information used to generate the plans.
+            eval_functions: The evaluation functions. Tag them with eval_scope
+                and eval_cost.
+            error_type: The exception an eval raises to report a failure,
+                e.g. AgentError. Other exceptions propagate.
+            max_workers: The maximum number of LLM-backed units run at once.
+            result_type: A class to build results with, e.g. EvaluationResults.
+            max_memo_entries: The maximum number of unit outcomes memoized.
+
+        Raises:
+            ValueError: If max_memo_entries is not positive.
+        """
+        if max_memo_entries <= 0:
+            raise ValueError("max_memo_entries must be positive.")
+        self.vacation_info = vacation_info
+        self.eval_functions = list(eval_functions)
+        self.error_type = error_type
+        self.max_workers = max_workers
+        self.result_type = result_type
+        self.max_memo_entries = max_memo_entries
+        self.last_diff: Optional[Dict[str, Any]] = None
+        self.stats = {"evaluations": 0, "units_run": 0, "units_reused": 0}
+        self._memo: "OrderedDict[Tuple[Callable[..., Any], str], Optional[str]]" = OrderedDict()
+        self._last_plan: Optional[Any] = None
+
+    def clear(self) -> None:
+        """Forget all memoized outcomes."""
+        self._memo.clear()
+        self._last_plan = None
+        self.last_diff = None
+
+    def _units(self, eval_fn: Callable[..., Any], travel_plan: Any) -> List[Tuple[str, Any]]:
+        """Return the (content hash, sub-plan) units of an eval on a plan."""
+        scope = get_eval_scope(eval_fn)
+        if scope == EvalScope.PLAN:
+            return [(_content_hash(travel_plan), travel_plan)]
+
+        units = []
+        for day in _field(travel_plan, "itinerary_days"):
+            if scope == EvalScope.DAY:
+                units.append((_content_hash(day), _with_fields(travel_plan, itinerary_days=[day])))
+                continue
+            for rec in _field(day, "activity_recommendations"):
+                single = _with_fields(day, activity_recommendations=[rec])
+                units.append((_content_hash(single), _with_fields(travel_plan, itinerary_days=[single])))
+        return units
+
+    def _run_unit(self, eval_fn: Callable[..., Any], sub_plan: Any) -> Optional[str]:
+        """Run an eval on a sub-plan and return its failure message, if any."""
+        try:
+            with call_label(eval_fn.__name__), request_priority(RequestPriority.BACKGROUND):
+                eval_fn(self.vacation_info, sub_plan)
+        except self.error_type as e:
+            return str(e)
+        return None
+
+    def evaluate(self, travel_plan: Any) -> Any:
+        """Evaluate a plan, reusing the outcomes of unchanged units.
+
+        Args:
+            travel_plan: The travel plan to evaluate.
+
+        Returns:
+            The success flag, failure messages and eval names, as a
+            dictionary or as result_type(**dictionary), like run_evals.
+        """
+        self.last_diff = diff_plans(self._last_plan, travel_plan)
+        self._last_plan = travel_plan
+        self.stats["evaluations"] += 1
+
+        # Split the evals into units and find those not memoized yet
+        units_by_eval = {eval_fn: self._units(eval_fn, travel_plan) for eval_fn in self.eval_functions}
+        outcomes: Dict[Tuple[Callable[..., Any], str], Optional[str]] = {}
+        pending: Dict[Tuple[Callable[..., Any], str], Any] = {}
+        for eval_fn, units in units_by_eval.items():
+            for digest, sub_plan in units:
+                key = (eval_fn, digest)
+                if key in outcomes or key in pending:
+                    self.stats["units_reused"] += 1
+                elif key in self._memo:
+                    self._memo.move_to_end(key)
+                    outcomes[key] = self._memo[key]
+                    self.stats["units_reused"] += 1
+                else:
+                    pending[key] = sub_plan
+        self.stats["units_run"] += len(pending)
+
+        # Run the LLM-backed units in a thread pool and the cheap ones meanwhile
+        expensive = [key for key in pending if get_eval_cost(key[0]) != EvalCost.CHEAP]
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(expensive) or 1))) as executor:
+            futures = {key: executor.submit(self._run_unit, key[0], pending[key]) for key in expensive}
+            for key, sub_plan in pending.items():
+                if key not in futures:
+                    outcomes[key] = self._run_unit(key[0], sub_plan)
+            for key, future in futures.items():
+                outcomes[key] = future.result()
+        for key in pending:
+            self._memo[key] = outcomes[key]
+        while len(self._memo) > self.max_memo_entries:
+            self._memo.popitem(last=False)
+
+        # Report failures in eval_functions order
+        eval_results = []
+        for eval_fn, units in units_by_eval.items():
+            messages = list(dict.fromkeys(
+                outcomes[(eval_fn, digest)] for digest, _ in units
+                if outcomes[(eval_fn, digest)] is not None
+            ))
+            if messages:
+                error_msg = "\n".join(messages)
+                print_in_box(error_msg, title="Evaluation Error")
+                print("\n\n")
+                eval_results.append(error_msg)
+
+        results = {
+            "success": len(eval_results) == 0,
+            "failures": eval_results,
+            "eval_functions": [fn.__name__ for fn in self.eval_functions],
+        }
+        return self.result_type(**results) if self.result_type is not None else results
+
+
+DEFAULT_BATCH_WORKERS = 16
+
+
+class TripResult(NamedTuple):
+    """The outcome of planning one trip in a batch.
+
+    Attributes:
+        index: The position of the request in the input stream.
+        vacation_info: The vacation information of the request.
+        plan: The final travel plan, revised if the evaluation failed, or
+            None if a stage raised.
+        evaluation: The last evaluation result, if evaluated.
+        revisions: The number of revisions made.
+        error: The exception a stage raised, if any.
+        timings: Seconds spent queued, in each stage (summed over rounds)
+            and in total.
+    """
+
+    index: int
+    vacation_info: Any
+    plan: Any
+    evaluation: Any
+    revisions: int
+    error: Optional[BaseException]
+    timings: Dict[str, float]
+
+    @property
+    def ok(self) -> bool:
+        """Whether the trip was planned and its last evaluation passed (or was skipped)."""
+        if self.error is not None or self.plan is None:
+            return False
+        return self.evaluation is None or bool(_field(self.evaluation, "success"))
+
 
-    return {}
+class BatchPlanner:
+    """Plan many trips concurrently: generation, evaluation and revision.
+
+    Each trip runs the stages in a worker thread. Stages are callables that
+    build their own agents, so each trip's ChatAgent history is isolated
+    while the client, cache, metrics and scheduler are shared. The calendar
+    and weather data are loaded once (see use_data_source) and read by all
+    workers.
+
+    Requests are read from the input lazily, with at most max_pending trips
+    in flight, so an unbounded stream can be planned in constant memory.
+
+    Chat completions keep the labels the stages set, or are labeled by
+    stage ("generate", "evaluate" or "revise"), and ChatMetrics records
+    carry the trip index in ChatCallRecord.trip.
+
+    Examples:
+        >>> planner = BatchPlanner(  # doctest: +SKIP
+        ...     generate=lambda info: ItineraryAgent(client=client).get_itinerary(info),
+        ...     evaluate=lambda info, plan: get_eval_results(info, plan, ALL_EVAL_FUNCTIONS),
+        ...     revise=lambda info, plan, evaluation: ItineraryRevisionAgent(client=client).run_react_cycle(plan),
+        ... )
+        >>> for result in planner.run(vacation_infos):  # doctest: +SKIP
+        ...     print(result.index, result.ok, result.timings["total"])
+
+    Attributes:
+        stats (Dict[str, int]): Counts of trips submitted, planned, failed
+            (evaluation) and errored (exception), and of revisions.
+    """
+
+    def __init__(
+        self,
+        generate: Callable[[Any], Any],
+        evaluate: Optional[Callable[[Any, Any], Any]] = None,
+        revise: Optional[Callable[[Any, Any, Any], Any]] = None,
+        max_workers: int = DEFAULT_BATCH_WORKERS,
+        max_pending: Optional[int] = None,
+        max_revisions: int = 1,
+        data_source: Optional[CalendarDataSource] = None,
+    ) -> None:
+        """Initialize the BatchPlanner.
+
+        Args:
+            generate: Returns the initial travel plan for a VacationInfo.
+            evaluate: Returns the evaluation of (vacation_info, plan), with a
+                success field like run_evals. Defaults to no evaluation.
+            revise: Returns a revised plan for (vacation_info, plan,
+                evaluation) after a failed evaluation. Defaults to no revision.
+            max_workers: The maximum number of trips planned at once.
+            max_pending: The maximum number of trips read from the input and
+                not yet yielded. Defaults to twice max_workers.
+            max_revisions: The maximum number of revise-and-re-evaluate rounds.
+            data_source: A data source to load once and serve the mocked
+                APIs from. Defaults to the data already in use.
+        """
+        self.generate = generate
+        self.evaluate = evaluate
+        self.revise = revise
+        self.max_workers = max_workers
+        self.max_pending = max(max_pending or 2 * max_workers, max_workers)
+        self.max_revisions = max_revisions
+        self.stats = {"submitted": 0, "planned": 0, "failed": 0, "errors": 0, "revisions": 0}
+        self._lock = threading.Lock()
+        if data_source is not None:
+            use_data_source(data_source)
+
+    def _plan_trip(self, index: int, vacation_info: Any, submitted: float) -> TripResult:
+        """Run the stages for one trip, capturing any exception in the result."""
+        started = time.perf_counter()
+        timings = {"queued": started - submitted, "generate": 0.0, "evaluate": 0.0, "revise": 0.0}
+        plan = evaluation = error = None
+        revisions = 0
+
+        def timed(stage: str, fn: Callable[..., Any], *args: Any) -> Any:
+            stage_started = time.perf_counter()
+            # Label calls by stage unless the caller or the stage sets a label
+            try:
+                with call_label(stage) if _CALL_LABEL.get() is None else nullcontext():
+                    return fn(*args)
+            finally:
+                timings[stage] += time.perf_counter() - stage_started
+
+        try:
+            with _planning_trip(index):
+                plan = timed("generate", self.generate, vacation_info)
+                if self.evaluate is not None:
+                    evaluation = timed("evaluate", self.evaluate, vacation_info, plan)
+                    while (
+                        self.revise is not None
+                        and revisions < self.max_revisions
+                        and not _field(evaluation, "success")
+                    ):
+                        plan = timed("revise", self.revise, vacation_info, plan, evaluation)
+                        revisions += 1
+                        evaluation = timed("evaluate", self.evaluate, vacation_info, plan)
+        except Exception as e:
+            error = e
+
+        timings["total"] = time.perf_counter() - submitted
+        plan = plan if error is None else None
+        result = TripResult(index, vacation_info, plan, evaluation, revisions, error, timings)
+        with self._lock:
+            self.stats["revisions"] += revisions
+            if error is not None:
+                self.stats["errors"] += 1
+            elif not result.ok:
+                self.stats["failed"] += 1
+            else:
+                self.stats["planned"] += 1
+        return result
+
+    def run(self, requests: Iterable[Any]) -> Iterator[TripResult]:
+        """Plan trips for a stream of VacationInfo requests.
+
+        Args:
+            requests: The vacation information of each trip, read lazily.
+
+        Yields:
+            Each trip's result as soon as it finishes, in completion order
+            (see TripResult.index for the input order). Closing the generator
+            cancels the trips not yet started.
+        """
+        requests = iter(requests)
+        pending: set = set()
+        executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="BatchPlanner")
+        try:
+            for index, vacation_info in enumerate(requests):
+                # Wait for room before reading the next request
+                while len(pending) >= self.max_pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+                # Trips run in a copy of the caller's context, e.g. its request_priority()
+                context = contextvars.copy_context()
+                pending.add(executor.submit(context.run, self._plan_trip, index, vacation_info, time.perf_counter()))
+                with self._lock:
+                    self.stats["submitted"] += 1
+
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def run_all(self, requests: Iterable[Any]) -> List[TripResult]:
+        """Plan all trips and return their results in input order."""
+        return sorted(self.run(requests), key=lambda result: result.index)
 
 
 def narrate_my_trip(
@@ -785,11 +6177,12 @@ def narrate_my_trip(
     Do not reference the narrative itself in the response.
     """
 
-    resp = do_chat_completion(
-        messages=[{"role": "user", "content": prompt}],
-        client=client,
-        model=model,
-    )
+    with call_label("narrate_my_trip"):
+        resp = do_chat_completion(
+            messages=[{"role": "user", "content": prompt}],
+            client=client,
+            model=model,
+        )
 
     # Display the response if IPython is available
     if IPYTHON_AVAILABLE:
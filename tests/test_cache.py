@@ -0,0 +1,90 @@
+"""Tests for the content-addressed chat completion cache in project_lib."""
+
+import pydantic
+import pytest
+
+import project_lib
+from fake_openai import FakeOpenAIClient, ScriptedResponder
+from project_lib import ChatCompletionCache, do_chat_completion
+
+MESSAGES = [{"role": "user", "content": "Plan a trip."}]
+
+
+class Plan(pydantic.BaseModel):
+    city: str
+    total_cost: int
+
+
+def test_key_is_stable_and_ignores_argument_order():
+    first = ChatCompletionCache.make_key("gpt-4.1-mini", MESSAGES, {"temperature": 0, "seed": 1})
+    second = ChatCompletionCache.make_key("gpt-4.1-mini", [dict(MESSAGES[0])], {"seed": 1, "temperature": 0})
+    assert first == second
+    assert first != ChatCompletionCache.make_key("gpt-4.1", MESSAGES, {"temperature": 0, "seed": 1})
+    assert first != ChatCompletionCache.make_key("gpt-4.1-mini", MESSAGES, {"temperature": 1, "seed": 1})
+
+
+def test_key_uses_schema_of_model_classes_and_content_of_instances():
+    by_class = ChatCompletionCache.make_key("m", MESSAGES, {"response_format": Plan})
+    assert by_class == ChatCompletionCache.make_key("m", MESSAGES, {"response_format": Plan})
+
+    keys = {
+        ChatCompletionCache.make_key("m", MESSAGES, {"plan": Plan(city="AgentsVille", total_cost=cost)})
+        for cost in (100, 120)
+    }
+    assert len(keys) == 2
+    assert by_class not in keys
+
+
+def test_memory_tier_evicts_least_recently_used():
+    cache = ChatCompletionCache(max_entries=2)
+    cache.set("a", "A")
+    cache.set("b", "B")
+    assert cache.get("a") == "A"
+    cache.set("c", "C")
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == ("A", "C")
+    assert cache.evictions == 1
+
+
+def test_entries_expire_after_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(project_lib.time, "time", lambda: now[0])
+    cache = ChatCompletionCache(ttl=10)
+    cache.set("a", "A")
+    now[0] += 5
+    assert cache.get("a") == "A"
+    now[0] += 10
+    assert cache.get("a") is None
+
+
+def test_disk_tier_survives_restarts_and_promotes_to_memory(tmp_path):
+    path = str(tmp_path / "cache.db")
+    ChatCompletionCache(path=path).set("a", "A", model="m")
+
+    cache = ChatCompletionCache(path=path)
+    assert len(cache) == 0
+    assert cache.get("a") == "A"
+    assert (cache.disk_hits, len(cache)) == (1, 1)
+    assert cache.get("a") == "A"
+    assert cache.disk_hits == 1
+
+
+def test_disk_tier_is_bounded(tmp_path):
+    cache = ChatCompletionCache(max_entries=1, path=str(tmp_path / "cache.db"), max_disk_entries=2)
+    for key in "abc":
+        cache.set(key, key.upper())
+    reopened = ChatCompletionCache(path=cache.path)
+    assert [reopened.get(key) for key in "abc"] == [None, "B", "C"]
+
+
+def test_do_chat_completion_answers_repeats_from_cache():
+    client = FakeOpenAIClient(responder=ScriptedResponder(["first", "second"]))
+    cache = ChatCompletionCache()
+    answers = [do_chat_completion(MESSAGES, model="gpt-4.1-mini", client=client, cache=cache) for _ in range(2)]
+    assert answers == ["first", "first"]
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_rejects_empty_memory_tier():
+    with pytest.raises(ValueError):
+        ChatCompletionCache(max_entries=0)
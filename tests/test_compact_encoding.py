@@ -0,0 +1,101 @@
+"""Tests for the compact prompt encoding of candidate activities in project_lib."""
+
+import json
+
+import pytest
+
+import project_lib
+from project_lib import (
+    ACTIVITY_CALENDAR,
+    WEATHER_FORECAST,
+    InMemoryDataSource,
+    WeatherVerdictStore,
+    encode_candidates_compact,
+    use_data_source,
+)
+
+INFO = {
+    "travelers": [
+        {"name": "Yuri", "interests": ["tennis", "cooking", "technology"]},
+        {"name": "Hiro", "interests": ["music", "art", "writing"]},
+    ],
+    "destination": "AgentsVille",
+    "date_of_arrival": "2025-06-10",
+    "date_of_departure": "2025-06-12",
+    "budget": 130,
+}
+
+
+@pytest.fixture(autouse=True)
+def calendar(monkeypatch):
+    """Serve the notebook calendar, with an extra event of an interest outside the enum."""
+    for name in ("ACTIVITY_STORE", "WEATHER_STORE", "WEATHER_VERDICTS"):
+        monkeypatch.setattr(project_lib, name, getattr(project_lib, name))
+    knitting = {
+        **ACTIVITY_CALENDAR[0],
+        "activity_id": "event-2025-06-10-knitting",
+        "name": "Knit Night",
+        "related_interests": ["knitting", "art"],
+    }
+    use_data_source(InMemoryDataSource([*ACTIVITY_CALENDAR, knitting], WEATHER_FORECAST))
+
+
+def encode(**kwargs):
+    return encode_candidates_compact(INFO, verdicts=WeatherVerdictStore(), **kwargs)
+
+
+def short_ids_by_date(candidates) -> dict:
+    by_date = {}
+    for short_id, record in candidates.activities.items():
+        by_date.setdefault(record.date, []).append(short_id)
+    return by_date
+
+
+def compact_plan(days: dict) -> str:
+    return json.dumps({"days": [
+        {"date": date, "activities": [{"id": short_id, "reasons": ["Fun."]} for short_id in ids]}
+        for date, ids in days.items()
+    ]})
+
+
+def test_expand_plan_rebuilds_the_travel_plan():
+    candidates = encode()
+    by_date = short_ids_by_date(candidates)
+    plan = candidates.expand_plan(compact_plan({date: ids[:1] for date, ids in by_date.items()}))
+
+    assert (plan["city"], plan["start_date"], plan["end_date"]) == ("AgentsVille", "2025-06-10", "2025-06-12")
+    assert [day["date"] for day in plan["itinerary_days"]] == list(candidates.dates)
+    chosen = [rec["activity"] for day in plan["itinerary_days"] for rec in day["activity_recommendations"]]
+    assert chosen == [candidates.activities[ids[0]].to_dict() for ids in by_date.values()]
+    assert plan["total_cost"] == sum(activity["price"] for activity in chosen)
+    assert plan["itinerary_days"][0]["weather"]["condition"] == candidates.forecasts["2025-06-10"].condition
+
+
+def test_unknown_interests_are_written_out():
+    candidates = encode(prefilter=False)
+    row = next(line for line in candidates.text.splitlines() if "Knit Night" in line)
+    assert "|knitting,art|" in row
+    assert "knitting" not in candidates.text.splitlines()[0]
+
+
+@pytest.mark.parametrize(
+    "days, error",
+    [
+        (lambda ids: {"2025-06-13": ids["2025-06-10"][:1]}, "Date 2025-06-13 is not part of the trip."),
+        (lambda ids: {"2025-06-11": ids["2025-06-10"][:1]}, "takes place on 2025-06-10, not 2025-06-11"),
+        (lambda ids: {"2025-06-10": ids["2025-06-10"][:1] * 2}, "appears more than once"),
+        (lambda ids: {"2025-06-10": ["A999"]}, "Unknown activity ID: A999"),
+    ],
+)
+def test_expand_plan_rejects_invalid_plans(days, error):
+    candidates = encode()
+    with pytest.raises(ValueError, match=error):
+        candidates.expand_plan(compact_plan(days(short_ids_by_date(candidates))))
+
+
+def test_expand_plan_requires_a_forecast_for_every_date(monkeypatch):
+    forecasts = [forecast for forecast in WEATHER_FORECAST if forecast["date"] != "2025-06-11"]
+    use_data_source(InMemoryDataSource(ACTIVITY_CALENDAR, forecasts))
+    candidates = encode()
+    with pytest.raises(ValueError, match="No weather forecast for AgentsVille on 2025-06-11"):
+        candidates.expand_plan(compact_plan({}))
@@ -0,0 +1,163 @@
+"""Tests that every calendar backend in project_lib answers like the in-memory store."""
+
+import pytest
+
+import project_lib
+from project_lib import (
+    ACTIVITY_CALENDAR,
+    WEATHER_FORECAST,
+    ActivitySetting,
+    ActivityStore,
+    ColumnarActivityCalendar,
+    InMemoryDataSource,
+    Interest,
+    JsonlDataSource,
+    SnapshotDataSource,
+    SQLiteDataSource,
+    call_activities_api_mocked,
+    call_activity_by_id_api_mocked,
+    call_weather_api_mocked,
+    classify_activity_setting,
+    import_calendar_to_sqlite,
+    interests_to_mask,
+    use_data_source,
+    write_calendar_snapshot,
+    write_jsonl,
+)
+
+OTHER_CITY = "Byteburg"
+# The notebook calendar, plus a copy in a second city whose events have a city field
+ACTIVITIES = list(ACTIVITY_CALENDAR) + [
+    {**event, "activity_id": f"bb-{event['activity_id']}", "city": OTHER_CITY, "price": event["price"] + 3}
+    for event in ACTIVITY_CALENDAR
+]
+FORECASTS = list(WEATHER_FORECAST) + [{**forecast, "city": OTHER_CITY} for forecast in WEATHER_FORECAST]
+DATES = sorted({forecast["date"] for forecast in WEATHER_FORECAST})
+
+
+@pytest.fixture(scope="module")
+def store():
+    return ActivityStore(ACTIVITIES)
+
+
+@pytest.mark.parametrize(
+    "filters",
+    [
+        {},
+        {"start_date": DATES[1], "end_date": DATES[3]},
+        {"max_price": 20},
+        {"interests": ["tennis", "music"]},
+        {"city": OTHER_CITY, "exclude_outdoor": True},
+        {"city": "Nowhere"},
+        {"start_date": DATES[0], "end_date": DATES[0], "interests": [Interest.COOKING], "max_price": 30},
+    ],
+)
+def test_columnar_query_matches_a_row_by_row_filter(store, filters):
+    calendar = store.to_columnar()
+    exclude_outdoor = filters.get("exclude_outdoor", False)
+    expected = [
+        record
+        for record in store
+        if (filters.get("start_date") is None or record.date >= filters["start_date"])
+        and (filters.get("end_date") is None or record.date <= filters["end_date"])
+        and (filters.get("max_price") is None or record.price <= filters["max_price"])
+        and (filters.get("interests") is None or record.interest_mask & interests_to_mask(filters["interests"]))
+        and (filters.get("city") is None or record.city == filters["city"])
+        and not (exclude_outdoor and classify_activity_setting(record.description) == ActivitySetting.OUTDOOR)
+    ]
+    rows = calendar.query(**filters)
+    assert calendar.records(rows) == expected
+    assert calendar.to_dicts(rows) == [record.to_dict() for record in expected]
+
+
+def test_columnar_calendar_from_events_matches_the_store(store):
+    calendar = ColumnarActivityCalendar.from_events(ACTIVITIES)
+    assert len(calendar) == len(store)
+    rows = calendar.query(city=OTHER_CITY)
+    assert calendar.to_dicts(rows) == [record.to_dict() for record in store.query(city=OTHER_CITY)]
+
+
+def make_source(kind: str, tmp_path):
+    """Write ACTIVITIES and FORECASTS to a backend and return a data source over it."""
+    if kind == "jsonl":
+        write_jsonl(str(tmp_path / "activities.jsonl"), ACTIVITIES)
+        write_jsonl(str(tmp_path / "forecasts.jsonl"), FORECASTS)
+        return JsonlDataSource(str(tmp_path / "activities.jsonl"), str(tmp_path / "forecasts.jsonl"))
+    if kind == "snapshot":
+        write_calendar_snapshot(str(tmp_path / "snapshot"), ACTIVITIES, FORECASTS)
+        return SnapshotDataSource(str(tmp_path / "snapshot"))
+    if kind == "sqlite":
+        import_calendar_to_sqlite(str(tmp_path / "calendar.db"), ACTIVITIES, FORECASTS, batch_size=7)
+        return SQLiteDataSource(str(tmp_path / "calendar.db"))
+    raise ValueError(kind)
+
+
+def assert_same_activities(expected, actual):
+    assert len(actual) == len(expected)
+    assert [record.to_dict() for record in actual] == [record.to_dict() for record in expected]
+    assert set(actual.cities) == set(expected.cities)
+    for city in [None, "AgentsVille", OTHER_CITY, "Nowhere"]:
+        assert actual.date_range(city) == expected.date_range(city)
+        assert actual.query_range(DATES[1], DATES[4], city) == expected.query_range(DATES[1], DATES[4], city)
+        for date in [None, *DATES, "2030-01-01"]:
+            assert actual.query(date=date, city=city) == expected.query(date=date, city=city)
+    ids = ["event-2025-06-12-0", "bb-event-2025-06-10-1", "missing", "event-2025-06-12-0"]
+    assert actual.query(activity_ids=ids) == expected.query(activity_ids=ids)
+    assert actual.get_many(ids) == expected.get_many(ids)
+    for record in expected:
+        assert actual.get(record.activity_id) == record
+        assert actual.interest_mask(record.activity_id) == record.interest_mask
+    assert actual.get("missing") is None
+
+
+def assert_same_forecasts(expected, actual):
+    assert len(actual) == len(expected)
+    assert sorted(actual) == sorted(expected)
+    assert set(actual.cities) == set(expected.cities)
+    for city in ["AgentsVille", OTHER_CITY, "Nowhere"]:
+        assert actual.date_range(city) == expected.date_range(city)
+        assert actual.query_range(DATES[0], DATES[2], city) == expected.query_range(DATES[0], DATES[2], city)
+        for date in [*DATES, "2030-01-01"]:
+            assert actual.get(date, city) == expected.get(date, city)
+
+
+@pytest.mark.parametrize("kind", ["jsonl", "snapshot", "sqlite"])
+def test_file_backends_match_the_in_memory_stores(kind, tmp_path):
+    reference = InMemoryDataSource(ACTIVITIES, FORECASTS)
+    source = make_source(kind, tmp_path)
+    assert_same_activities(reference.load_activities(), source.load_activities())
+    assert_same_forecasts(reference.load_forecasts(), source.load_forecasts())
+
+
+def api_answers() -> list:
+    """Call the mocked APIs over every date and city, including invalid ones."""
+    answers = []
+    for city in [None, "AgentsVille", OTHER_CITY, "Nowhere"]:
+        for date in [None, *DATES, "2030-01-01"]:
+            answers.append(call_activities_api_mocked(date=date, city=city))
+            if city is not None and date is not None:
+                answers.append(call_weather_api_mocked(date, city))
+    answers.append(call_activities_api_mocked(activity_ids=["bb-event-2025-06-10-1", "missing"]))
+    answers.append([call_activity_by_id_api_mocked(event["activity_id"]) for event in ACTIVITIES])
+    return answers
+
+
+@pytest.mark.parametrize("kind", ["jsonl", "snapshot", "sqlite"])
+def test_mocked_apis_answer_the_same_from_file_backends(kind, tmp_path, monkeypatch):
+    for name in ("ACTIVITY_STORE", "WEATHER_STORE", "WEATHER_VERDICTS"):
+        monkeypatch.setattr(project_lib, name, getattr(project_lib, name))
+    use_data_source(InMemoryDataSource(ACTIVITIES, FORECASTS))
+    expected = api_answers()
+    use_data_source(make_source(kind, tmp_path))
+    assert api_answers() == expected
+
+
+def test_sqlite_interest_and_columnar_queries_match(tmp_path):
+    expected = ActivityStore(ACTIVITIES)
+    actual = make_source("sqlite", tmp_path).load_activities()
+    for interests, city in [(["tennis"], None), (["music", Interest.COOKING], OTHER_CITY), (["knitting"], None)]:
+        mask = interests_to_mask(interests, strict=False)
+        matching = [record for record in expected if record.interest_mask & mask and (not city or record.city == city)]
+        assert actual.query_interests(interests, city=city) == matching
+    columnar, reference = actual.to_columnar(), expected.to_columnar()
+    assert columnar.to_dicts(columnar.query(max_price=20)) == reference.to_dicts(reference.query(max_price=20))
@@ -0,0 +1,107 @@
+"""Tests for the cost-tiered eval runner in project_lib."""
+
+import threading
+
+import pytest
+
+import project_lib
+from project_lib import EvalCost, RequestPriority, eval_cost, get_eval_cost, run_evals
+
+
+class PlanError(Exception):
+    pass
+
+
+def make_evals(log: list, failing: set = frozenset()) -> list:
+    """Two cheap and two LLM-backed evals; the first LLM eval finishes only after the second."""
+    second_done = threading.Event()
+
+    def check(name):
+        log.append(name)
+        if name in failing:
+            raise PlanError(f"{name} failed")
+
+    @eval_cost("cheap")
+    def eval_dates(vacation_info, final_output):
+        check("eval_dates")
+
+    @eval_cost(EvalCost.LLM)
+    def eval_weather(vacation_info, final_output):
+        assert second_done.wait(5)
+        check("eval_weather")
+
+    @eval_cost("cheap")
+    def eval_budget(vacation_info, final_output):
+        check("eval_budget")
+
+    def eval_tone(vacation_info, final_output):
+        try:
+            check("eval_tone")
+        finally:
+            second_done.set()
+
+    return [eval_dates, eval_weather, eval_budget, eval_tone]
+
+
+def test_untagged_evals_count_as_llm():
+    assert [get_eval_cost(fn) for fn in make_evals([])] == [EvalCost.CHEAP, EvalCost.LLM, EvalCost.CHEAP, EvalCost.LLM]
+
+
+def test_failures_are_reported_in_eval_order():
+    log = []
+    evals = make_evals(log, failing={"eval_tone", "eval_weather", "eval_dates"})
+    results = run_evals({}, {}, evals, error_type=PlanError)
+    # eval_weather waits for eval_tone, so the LLM evals ran in parallel
+    assert log.index("eval_tone") < log.index("eval_weather")
+    assert results == {
+        "success": False,
+        "failures": ["eval_dates failed", "eval_weather failed", "eval_tone failed"],
+        "eval_functions": ["eval_dates", "eval_weather", "eval_budget", "eval_tone"],
+    }
+
+
+def test_fail_fast_skips_llm_evals_after_a_cheap_failure():
+    log = []
+    results = run_evals({}, {}, make_evals(log, failing={"eval_budget"}), error_type=PlanError, fail_fast=True)
+    assert log == ["eval_dates", "eval_budget"]
+    assert results == {
+        "success": False,
+        "failures": ["eval_budget failed"],
+        "eval_functions": ["eval_dates", "eval_budget"],
+    }
+
+
+def test_fail_fast_runs_cheap_evals_first():
+    log = []
+    results = run_evals({}, {}, make_evals(log), error_type=PlanError, fail_fast=True)
+    assert log[:2] == ["eval_dates", "eval_budget"]
+    assert sorted(log[2:]) == ["eval_tone", "eval_weather"]
+    assert results["success"] and len(results["eval_functions"]) == 4
+
+
+def test_evals_run_labeled_at_background_priority():
+    seen = {}
+
+    @eval_cost("cheap")
+    def eval_cheap(vacation_info, final_output):
+        seen["eval_cheap"] = project_lib._CALL_LABEL.get(), project_lib._REQUEST_PRIORITY.get()
+
+    def eval_llm(vacation_info, final_output):
+        seen["eval_llm"] = project_lib._CALL_LABEL.get(), project_lib._REQUEST_PRIORITY.get()
+
+    run_evals({}, {}, [eval_cheap, eval_llm])
+    assert seen == {
+        "eval_cheap": ("eval_cheap", RequestPriority.BACKGROUND),
+        "eval_llm": ("eval_llm", RequestPriority.BACKGROUND),
+    }
+
+
+def test_other_exceptions_propagate_and_result_type_is_used():
+    def eval_broken(vacation_info, final_output):
+        raise KeyError("travelers")
+
+    with pytest.raises(KeyError):
+        run_evals({}, {}, [eval_broken], error_type=PlanError)
+
+    results = run_evals({}, {}, make_evals([]), error_type=PlanError, result_type=lambda **fields: fields["success"])
+    assert results is True
@@ -0,0 +1,96 @@
+"""Tests for the token-budgeted history compaction of ChatAgent in project_lib."""
+
+import json
+
+from fake_openai import FakeOpenAIClient
+from project_lib import ChatAgent, NullSink, TokenBudgetPolicy, estimate_message_tokens
+
+PLAN = json.dumps({"city": "AgentsVille", "itinerary_days": [{"date": "2025-06-10"}]})
+
+
+def message(role: str, content: str) -> dict:
+    return {"role": role, "content": content}
+
+
+def react_history(steps: int = 6) -> list:
+    """A system prompt followed by THOUGHT/ACTION turns and long tool observations."""
+    messages = [message("system", "You are a travel agent. " * 20)]
+    for step in range(steps):
+        messages.append(message("assistant", f"THOUGHT: step {step}.\nACTION: {{\"tool_name\": \"weather\"}}"))
+        messages.append(message("user", f"OBSERVATION: result {step} " + "rain " * 400))
+    messages.insert(5, message("assistant", f"THOUGHT: Here is a draft.\nACTION: {PLAN}"))
+    return messages
+
+
+def test_history_under_budget_is_sent_unchanged():
+    messages = react_history(steps=1)
+    compacted = TokenBudgetPolicy(max_tokens=10_000).apply(messages)
+    assert compacted == messages and compacted is not messages
+
+
+def test_stale_observations_are_elided_oldest_first():
+    messages = react_history()
+    policy = TokenBudgetPolicy(max_tokens=estimate_message_tokens(messages) - 1000, keep_recent=2)
+    compacted = policy.apply(messages)
+
+    assert estimate_message_tokens(compacted) <= policy.max_tokens
+    changed = [i for i, (old, new) in enumerate(zip(messages, compacted)) if old != new]
+    assert changed == [2, 4, 7]
+    for i in changed:
+        assert compacted[i]["role"] == messages[i]["role"]
+        assert compacted[i]["content"].startswith("OBSERVATION: [Stale output elided (")
+    # Elisions are stable, so the compacted prefix stays cacheable
+    assert policy.apply(messages) == compacted
+    assert messages == react_history()
+
+
+def test_protected_messages_are_never_elided():
+    messages = react_history()
+    compacted = TokenBudgetPolicy(max_tokens=1, keep_recent=3).apply(messages)
+    protected = {0, 5, len(messages) - 3, len(messages) - 2, len(messages) - 1}
+    assert [compacted[i] for i in sorted(protected)] == [messages[i] for i in sorted(protected)]
+    for i in set(range(len(messages))) - protected:
+        if messages[i]["content"].startswith("OBSERVATION:"):
+            assert "[Stale output elided" in compacted[i]["content"]
+        else:
+            # Eliding a short thought would not save anything
+            assert compacted[i] == messages[i]
+
+
+def test_summaries_are_memoized_per_content():
+    calls = []
+
+    def summarizer(body):
+        calls.append(body)
+        return "rain all week"
+
+    policy = TokenBudgetPolicy(max_tokens=1, keep_recent=1, summarizer=summarizer)
+    observation = message("user", "OBSERVATION: " + "rain " * 200)
+    messages = [message("system", "Plan."), observation, observation, observation, message("user", "Go")]
+    compacted = policy.apply(messages)
+    policy.apply(messages)
+    assert len(calls) == 1
+    assert compacted[1]["content"].endswith(": rain all week]")
+
+
+def test_chat_agent_sends_the_compacted_history_and_keeps_its_own():
+    sent = []
+
+    def responder(model, messages, kwargs):
+        sent.append(messages)
+        return "THOUGHT: Done."
+
+    agent = ChatAgent(
+        name="planner",
+        system_prompt="You are a travel agent.",
+        client=FakeOpenAIClient(responder=responder),
+        model="gpt-4.1-mini",
+        transcript=NullSink(),
+        history_policy=TokenBudgetPolicy(max_tokens=400, keep_recent=2),
+    )
+    for _ in range(4):
+        agent.chat("OBSERVATION: " + "sunny " * 300)
+
+    assert all("[Stale output elided" not in m["content"] for m in agent.messages)
+    assert estimate_message_tokens(sent[-1]) < estimate_message_tokens(agent.messages[:-1])
+    assert sent[-1][0] == agent.messages[0] and sent[-1][-1] == agent.messages[-2]
@@ -0,0 +1,89 @@
+"""Tests for plan diffs and the IncrementalEvaluator in project_lib."""
+
+import copy
+
+import pytest
+
+from project_lib import EvalScope, IncrementalEvaluator, diff_plans, eval_scope
+
+
+class PlanError(Exception):
+    pass
+
+
+def recommendation(activity_id: str, price: int = 10) -> dict:
+    return {"activity": {"activity_id": activity_id, "price": price}, "reasoning": "Fun."}
+
+
+def plan(*days: list) -> dict:
+    return {
+        "city": "AgentsVille",
+        "total_cost": 0,
+        "itinerary_days": [
+            {"date": f"2025-06-1{i}", "weather": {"condition": "clear"}, "activity_recommendations": recs}
+            for i, recs in enumerate(days)
+        ],
+    }
+
+
+def test_diff_plans_counts_repeated_activities():
+    old = plan([recommendation("a1"), recommendation("a1")], [recommendation("b1")])
+    new = copy.deepcopy(old)
+    new["itinerary_days"][0]["activity_recommendations"][1] = recommendation("a1", price=99)
+
+    diff = diff_plans(old, new)
+    assert diff["changed_days"] == ["2025-06-10"]
+    assert diff["changed_activities"] == [("2025-06-10", "a1")]
+    assert diff["removed_activities"] == []
+
+    del new["itinerary_days"][0]["activity_recommendations"][1]
+    diff = diff_plans(old, new)
+    assert diff["changed_activities"] == []
+    assert diff["removed_activities"] == [("2025-06-10", "a1")]
+
+
+def test_diff_plans_ignores_reordered_activities():
+    old = plan([recommendation("a1"), recommendation("a2")])
+    new = plan([recommendation("a2"), recommendation("a1")])
+    diff = diff_plans(old, new)
+    assert diff["changed_days"] == ["2025-06-10"]
+    assert diff["changed_activities"] == [] and diff["removed_activities"] == []
+    assert not diff["plan_fields_changed"]
+
+
+def test_memo_is_bounded_and_keeps_recent_outcomes():
+    runs = []
+
+    @eval_scope(EvalScope.ACTIVITY)
+    def eval_price(vacation_info, travel_plan):
+        activity = travel_plan["itinerary_days"][0]["activity_recommendations"][0]["activity"]
+        runs.append(activity["activity_id"])
+        if activity["price"] > 50:
+            raise PlanError(f"{activity['activity_id']} is too expensive")
+
+    evaluator = IncrementalEvaluator({}, [eval_price], error_type=PlanError, max_memo_entries=3)
+    for i in range(10):
+        result = evaluator.evaluate(plan([recommendation(f"a{i}", price=10 * i)]))
+        assert result["success"] == (i <= 5)
+    assert len(evaluator._memo) == 3
+
+    runs.clear()
+    assert evaluator.evaluate(plan([recommendation("a9", price=90)]))["failures"] == ["a9 is too expensive"]
+    assert runs == []
+    evaluator.evaluate(plan([recommendation("a0", price=0)]))
+    assert runs == ["a0"]
+
+
+def test_memo_bound_smaller_than_a_plan_still_reports_every_unit():
+    @eval_scope(EvalScope.ACTIVITY)
+    def eval_price(vacation_info, travel_plan):
+        activity = travel_plan["itinerary_days"][0]["activity_recommendations"][0]["activity"]
+        if activity["price"] > 50:
+            raise PlanError(f"{activity['activity_id']} is too expensive")
+
+    evaluator = IncrementalEvaluator({}, [eval_price], error_type=PlanError, max_memo_entries=1)
+    result = evaluator.evaluate(plan([recommendation("a1", 60), recommendation("a2", 70), recommendation("a3")]))
+    assert result["failures"] == ["a1 is too expensive\na2 is too expensive"]
+
+    with pytest.raises(ValueError):
+        IncrementalEvaluator({}, [eval_price], max_memo_entries=0)
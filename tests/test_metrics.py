@@ -0,0 +1,62 @@
+"""Tests for the chat completion metrics exports in project_lib."""
+
+import csv
+import json
+import threading
+from types import SimpleNamespace
+
+from project_lib import ChatMetrics, call_label
+
+MODEL = "gpt-4.1-mini"
+
+
+def usage(prompt_tokens: int, completion_tokens: int) -> SimpleNamespace:
+    return SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+
+
+def test_exports_agree_with_each_other(tmp_path):
+    metrics = ChatMetrics()
+    with call_label("planner"):
+        metrics.record(MODEL, 0.4, usage(1000, 200), agent="ItineraryAgent")
+        metrics.record(MODEL, 0.1, cache_hit=True, agent="ItineraryAgent")
+    metrics.record(MODEL, 2.0, error=True, agent="EvaluationAgent")
+
+    metrics.export(str(tmp_path / "metrics.json"))
+    metrics.export(str(tmp_path / "metrics.csv"))
+    metrics.export(str(tmp_path / "metrics.prom"))
+
+    exported = json.loads((tmp_path / "metrics.json").read_text())
+    assert exported["summary"]["planner"]["calls"] == 2
+    assert len(exported["calls"]) == 3
+    with open(tmp_path / "metrics.csv", newline="") as f:
+        assert len(list(csv.DictReader(f))) == 3
+    prometheus = (tmp_path / "metrics.prom").read_text()
+    planner = '{model="gpt-4.1-mini",agent="ItineraryAgent",label="planner"}'
+    assert f"agentsville_chat_calls_total{planner} 2" in prometheus
+    assert f"agentsville_chat_cache_hits_total{planner} 1" in prometheus
+    assert f"agentsville_chat_prompt_tokens_total{planner} 1000" in prometheus
+    evaluator = '{model="gpt-4.1-mini",agent="EvaluationAgent",label="unlabeled"}'
+    assert f"agentsville_chat_errors_total{evaluator} 1" in prometheus
+
+
+def test_json_export_is_consistent_while_recording(tmp_path):
+    metrics = ChatMetrics()
+
+    def recorder():
+        for _ in range(2000):
+            metrics.record(MODEL, 0.01, usage(10, 5))
+
+    threads = [threading.Thread(target=recorder) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    try:
+        for i in range(10):
+            path = tmp_path / f"metrics-{i}.json"
+            metrics.to_json(str(path))
+            exported = json.loads(path.read_text())
+            calls = len(exported["calls"])
+            assert sum(group["calls"] for group in exported["summary"].values()) == calls
+            assert all(group["latency_seconds"][-1][1] == calls for group in exported["histograms"].values())
+    finally:
+        for thread in threads:
+            thread.join()
@@ -0,0 +1,143 @@
+"""Tests for the rate-limit-aware RequestScheduler in project_lib."""
+
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import project_lib
+from fake_openai import FakeOpenAIClient, ScriptedResponder
+from project_lib import RateLimits, RequestPriority, RequestScheduler, _TokenBucket, do_chat_completion
+
+MODEL = "gpt-4.1-mini"
+
+
+class FakeRateLimitError(Exception):
+    status_code = 429
+
+    def __init__(self, retry_after: str) -> None:
+        super().__init__("rate limited")
+        self.response = SimpleNamespace(status_code=429, headers={"retry-after": retry_after})
+
+
+def usage(prompt_tokens: int, completion_tokens: int) -> SimpleNamespace:
+    return SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+
+
+def test_token_bucket_refills_up_to_capacity():
+    bucket = _TokenBucket(60)
+    bucket.take(60)
+    assert bucket.time_until(1, bucket.updated) == pytest.approx(1.0)
+    assert bucket.time_until(1, bucket.updated + 1.0) == 0.0
+    assert bucket.time_until(1, bucket.updated + 1000.0) == 0.0
+    assert bucket.tokens == 60
+    # A request larger than the bucket only waits for a full bucket
+    bucket.take(60)
+    assert bucket.time_until(600, bucket.updated) == pytest.approx(60.0)
+
+
+def test_run_retries_transient_errors_honouring_retry_after(monkeypatch):
+    delays = []
+    monkeypatch.setattr(project_lib.time, "sleep", delays.append)
+    scheduler = RequestScheduler(base_delay=0.01)
+    attempts = iter([FakeRateLimitError("0.2"), FakeRateLimitError("0.3"), "ok"])
+
+    def send():
+        outcome = next(attempts)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    assert scheduler.run(send, MODEL, 100) == "ok"
+    assert len(delays) == 2
+    assert 0.2 <= delays[0] < 0.21 and 0.3 <= delays[1] < 0.31
+    assert scheduler.stats["retries"] == 2 and scheduler.stats["rate_limited"] == 2
+
+
+def test_run_raises_permanent_errors_and_exhausted_retries(monkeypatch):
+    monkeypatch.setattr(project_lib.time, "sleep", lambda delay: None)
+    scheduler = RequestScheduler(max_retries=2, base_delay=0.01)
+    calls = []
+
+    def permanent():
+        calls.append(1)
+        raise ValueError("bad request")
+
+    with pytest.raises(ValueError):
+        scheduler.run(permanent, MODEL, 100)
+    assert len(calls) == 1
+
+    def transient():
+        calls.append(1)
+        raise ConnectionError("reset")
+
+    with pytest.raises(ConnectionError):
+        scheduler.run(transient, MODEL, 100)
+    assert len(calls) == 1 + 3
+
+
+def test_reconcile_corrects_the_token_bucket():
+    scheduler = RequestScheduler(limits={MODEL: RateLimits(1000, 60_000)})
+    scheduler.acquire(MODEL, 5000)
+    tokens = scheduler._model_buckets(MODEL)[1]
+    assert tokens.tokens == pytest.approx(55_000, abs=10)
+    scheduler.reconcile(MODEL, 5000, usage(300, 200))
+    assert tokens.tokens == pytest.approx(59_500, abs=10)
+    # Without usage, a local count is used
+    scheduler.reconcile(MODEL, 1000, None, tokens=400)
+    assert tokens.tokens == pytest.approx(60_100, abs=10)
+
+
+def test_streamed_completions_are_reconciled():
+    scheduler = RequestScheduler(limits={MODEL: RateLimits(1000, 60_000)}, completion_tokens_estimate=5000)
+    client = FakeOpenAIClient(responder=ScriptedResponder(["A short answer."]))
+    messages = [{"role": "user", "content": "Hi"}]
+    content = do_chat_completion(messages, model=MODEL, client=client, stream=True, scheduler=scheduler)
+    assert content == "A short answer."
+    # The 5000-token completion estimate was given back
+    assert scheduler._model_buckets(MODEL)[1].tokens > 59_900
+
+
+def test_waiters_are_admitted_by_priority_without_polling():
+    scheduler = RequestScheduler()
+    scheduler._paused_until[MODEL] = time.monotonic() + 0.5
+    checks = []
+    try_acquire = scheduler._try_acquire
+
+    def counting_try_acquire(*args):
+        checks.append(1)
+        return try_acquire(*args)
+
+    scheduler._try_acquire = counting_try_acquire
+    admitted = []
+
+    def request(priority, name):
+        scheduler.acquire(MODEL, 1, priority)
+        admitted.append(name)
+
+    threads = [threading.Thread(target=request, args=(RequestPriority.BACKGROUND, f"eval_{i}")) for i in range(8)]
+    threads.append(threading.Thread(target=request, args=(RequestPriority.INTERACTIVE, "user")))
+    for thread in threads:
+        thread.start()
+        time.sleep(0.01)
+    for thread in threads:
+        thread.join()
+
+    assert admitted[0] == "user"
+    assert admitted[1:] == [f"eval_{i}" for i in range(8)]
+    # Polling every 50 ms takes about 80 checks during the pause
+    assert len(checks) < 50
+
+
+def test_async_waiters_are_woken_on_release():
+    scheduler = RequestScheduler()
+
+    async def main():
+        scheduler._paused_until[MODEL] = time.monotonic() + 0.2
+        await asyncio.gather(*(scheduler.aacquire(MODEL, 1) for _ in range(5)))
+
+    asyncio.run(main())
+    assert scheduler.stats["requests"] == 5
+    assert scheduler._async_waiters == []
@@ -0,0 +1,52 @@
+"""Tests for the transcript sinks in project_lib."""
+
+import json
+import logging
+import threading
+
+from project_lib import BackgroundSink, BufferedFileSink, JsonlSink, TranscriptSink
+
+
+def write_concurrently(sink: TranscriptSink, threads: int = 8, messages: int = 200) -> None:
+    def worker(agent):
+        for i in range(messages):
+            sink.write(agent, "assistant", f"{agent} message {i} " + "x" * 300, "Assistant")
+
+    workers = [threading.Thread(target=worker, args=(f"agent-{t}",)) for t in range(threads)]
+    for worker_thread in workers:
+        worker_thread.start()
+    for worker_thread in workers:
+        worker_thread.join()
+    sink.close()
+
+
+def test_jsonl_sink_keeps_concurrent_lines_whole(tmp_path):
+    path = tmp_path / "transcript.jsonl"
+    write_concurrently(JsonlSink(str(path), buffer_size=1024))
+    records = [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines()]
+    assert len(records) == 8 * 200
+    for t in range(8):
+        contents = [r["content"] for r in records if r["agent"] == f"agent-{t}"]
+        assert [content.split()[2] for content in contents] == [str(i) for i in range(200)]
+
+
+def test_buffered_file_sink_keeps_concurrent_boxes_whole(tmp_path):
+    path = tmp_path / "transcript.txt"
+    write_concurrently(BufferedFileSink(str(path), buffer_size=1024), messages=50)
+    text = path.read_text(encoding="utf-8")
+    assert text.count("Assistant") == 8 * 50
+    assert all(f"agent-{t} message 49" in text for t in range(8))
+
+
+class FailingSink(TranscriptSink):
+    def write(self, agent, role, content, title):
+        raise OSError("disk full")
+
+
+def test_background_sink_logs_write_failures(caplog):
+    sink = BackgroundSink(FailingSink())
+    with caplog.at_level(logging.ERROR, logger="project_lib"):
+        sink.write("agent", "user", "Hi", "User")
+        sink.close()
+    assert "Failed to write a transcript message" in caplog.text
+    assert "disk full" in caplog.text
@@ -0,0 +1,179 @@
+"""Regression tests for the exact itinerary solver in project_lib."""
+
+import datetime
+import itertools
+import json
+import logging
+
+import pytest
+
+import project_lib
+from fake_openai import FakeOpenAIClient, ScriptedResponder
+from project_lib import (
+    InMemoryDataSource,
+    Interest,
+    WeatherVerdictStore,
+    annotate_plan_reasons,
+    solve_itinerary,
+    use_data_source,
+)
+
+DATES = ["2025-06-10", "2025-06-11", "2025-06-12"]
+INTERESTS = [interest.value for interest in Interest]
+
+
+def make_dense_calendar(events_per_day: int, dates: list = DATES) -> list:
+    """Build back-to-back 30-minute events from 08:00 on each date, cycling through the interests."""
+    events = []
+    for date in dates:
+        start = datetime.datetime.fromisoformat(f"{date}T08:00")
+        for slot in range(events_per_day):
+            begin = start + datetime.timedelta(minutes=30 * (slot % 28))
+            events.append({
+                "activity_id": f"dense-{date}-{slot}",
+                "name": f"Dense Event {slot}",
+                "start_time": begin.strftime("%Y-%m-%d %H:%M"),
+                "end_time": (begin + datetime.timedelta(minutes=30)).strftime("%Y-%m-%d %H:%M"),
+                "location": "AgentsVille",
+                "description": "An indoor event.",
+                "price": 5 + slot % 11,
+                "related_interests": [INTERESTS[slot % len(INTERESTS)]],
+            })
+    return events
+
+
+def serve_calendar(monkeypatch, events: list, dates: list = DATES) -> None:
+    """Serve a calendar from the mocked APIs, restoring the previous stores after the test."""
+    for name in ("ACTIVITY_STORE", "WEATHER_STORE", "WEATHER_VERDICTS"):
+        monkeypatch.setattr(project_lib, name, getattr(project_lib, name))
+    use_data_source(InMemoryDataSource(
+        events,
+        [{"date": date, "city": "AgentsVille", "temperature": 25, "temperature_unit": "celsius",
+          "condition": "clear", "description": "Clear."} for date in dates],
+    ))
+
+
+@pytest.fixture
+def dense_calendar(monkeypatch):
+    serve_calendar(monkeypatch, make_dense_calendar(events_per_day=60))
+
+
+@pytest.fixture
+def front_sizes(monkeypatch):
+    """Record how many options each Pareto front is built from, the solver's unit of work."""
+    sizes = []
+    pareto_front = project_lib._pareto_front
+
+    def counting_pareto_front(options, *args, **kwargs):
+        options = list(options)
+        sizes.append(len(options))
+        return pareto_front(options, *args, **kwargs)
+
+    monkeypatch.setattr(project_lib, "_pareto_front", counting_pareto_front)
+    return sizes
+
+
+def vacation_info(travelers: list, dates: list = DATES, budget: int = 1000) -> dict:
+    return {
+        "travelers": travelers,
+        "destination": "AgentsVille",
+        "date_of_arrival": dates[0],
+        "date_of_departure": dates[-1],
+        "budget": budget,
+    }
+
+
+def test_solves_dense_days_without_enumerating_subsets(dense_calendar, front_sizes):
+    info = vacation_info([
+        {"name": "Yuri", "interests": ["tennis", "cooking"]},
+        {"name": "Hiro", "interests": ["reading", "music"]},
+    ])
+    plan = solve_itinerary(info, max_activities_per_day=6, verdicts=WeatherVerdictStore())
+    # 60 activities a day have over 50 million sets of six; the fronts stay small
+    assert sum(front_sizes) < 50_000
+    assert max(front_sizes) < 2_000
+
+    assert [day["date"] for day in plan["itinerary_days"]] == DATES
+    for day in plan["itinerary_days"]:
+        activities = [rec["activity"] for rec in day["activity_recommendations"]]
+        assert 1 <= len(activities) <= 6
+        assert all(a["end_time"] <= b["start_time"] for a, b in zip(activities, activities[1:]))
+    covered = {
+        interest
+        for day in plan["itinerary_days"]
+        for rec in day["activity_recommendations"]
+        for interest in rec["activity"]["related_interests"]
+    }
+    assert covered & {"tennis", "cooking"} and covered & {"reading", "music"}
+
+
+def test_solves_large_groups_without_tracking_coverage(dense_calendar, front_sizes):
+    info = vacation_info([
+        {"name": f"Traveler {i}", "interests": [INTERESTS[i % len(INTERESTS)], INTERESTS[(i * 5 + 1) % len(INTERESTS)]]}
+        for i in range(40)
+    ])
+    plan = solve_itinerary(info, verdicts=WeatherVerdictStore())
+    assert plan["total_cost"] <= 1000
+    # Without coverage tracking, the fronts are keyed on the activity count alone
+    assert max(front_sizes) < 200
+
+
+def test_matches_brute_force_on_a_small_day(monkeypatch):
+    dates = DATES[:1]
+    serve_calendar(monkeypatch, make_dense_calendar(events_per_day=10, dates=dates), dates)
+    travelers = [
+        {"name": "Yuri", "interests": [INTERESTS[0], INTERESTS[3]]},
+        {"name": "Hiro", "interests": [INTERESTS[7]]},
+        {"name": "Ana", "interests": [INTERESTS[1]]},
+    ]
+    info = vacation_info(travelers, dates, budget=25)
+    plan = solve_itinerary(info, max_activities_per_day=3, verdicts=WeatherVerdictStore())
+
+    def score(activities):
+        interests = [set(activity["related_interests"]) for activity in activities]
+        covered = sum(any(set(t["interests"]) & shared for shared in interests) for t in travelers)
+        hits = sum(len(set(t["interests"]) & shared) > 0 for t in travelers for shared in interests)
+        return covered, hits, -sum(activity["price"] for activity in activities)
+
+    events = make_dense_calendar(events_per_day=10, dates=dates)
+    best = max(
+        score(subset)
+        for count in range(1, 4)
+        for subset in itertools.combinations(events, count)
+        if sum(event["price"] for event in subset) <= 25
+        and all(a["end_time"] <= b["start_time"] for a, b in zip(subset, subset[1:]))
+    )
+    assert score([rec["activity"] for rec in plan["itinerary_days"][0]["activity_recommendations"]]) == best
+
+
+def test_rejects_invalid_activity_counts():
+    with pytest.raises(ValueError):
+        solve_itinerary(vacation_info([]), min_activities_per_day=3, max_activities_per_day=2)
+
+
+def test_annotate_plan_reasons_uses_the_model_reasons(dense_calendar):
+    info = vacation_info([{"name": "Yuri", "interests": ["tennis"]}])
+    plan = solve_itinerary(info, verdicts=WeatherVerdictStore())
+    first = plan["itinerary_days"][0]["activity_recommendations"][0]
+    response = json.dumps({"activities": [
+        {"activity_id": first["activity"]["activity_id"], "reasons_for_recommendation": ["Yuri loves it."]}
+    ]})
+    client = FakeOpenAIClient(responder=ScriptedResponder([response]))
+
+    annotated = annotate_plan_reasons(plan, info, client, "gpt-4.1-mini")
+    assert annotated["itinerary_days"][0]["activity_recommendations"][0]["reasons_for_recommendation"] == [
+        "Yuri loves it."
+    ]
+    assert annotated["itinerary_days"][1:] == plan["itinerary_days"][1:]
+    assert first["reasons_for_recommendation"] != ["Yuri loves it."]
+
+
+def test_annotate_plan_reasons_logs_unparseable_responses(dense_calendar, caplog):
+    info = vacation_info([{"name": "Yuri", "interests": ["tennis"]}])
+    plan = solve_itinerary(info, verdicts=WeatherVerdictStore())
+    client = FakeOpenAIClient(responder=ScriptedResponder(["not json"]))
+
+    with caplog.at_level(logging.WARNING, logger="project_lib"):
+        annotated = annotate_plan_reasons(plan, info, client, "gpt-4.1-mini")
+    assert annotated == plan
+    assert "Could not parse the model's recommendation reasons" in caplog.text
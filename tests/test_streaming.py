@@ -0,0 +1,88 @@
+"""Tests for streamed chat completions and incremental ACTION parsing in project_lib."""
+
+import json
+
+import pytest
+
+from fake_openai import FakeOpenAIClient, FaultInjection, ScriptedResponder
+from project_lib import ChatAgent, ChatCompletionCache, ChatMetrics, NullSink, ReActActionParser, do_chat_completion
+
+MODEL = "gpt-4.1-mini"
+ACTION = {"tool_name": "calculator_tool", "arguments": {"input_expression": "{1 + 2}"}}
+RESPONSE = f"THOUGHT: Add the costs.\nACTION: {json.dumps(ACTION)}\nOBSERVATION: pending"
+
+
+def chunks(text: str, size: int) -> list:
+    return [text[i : i + size] for i in range(0, len(text), size)]
+
+
+@pytest.mark.parametrize("size", [1, 3, 7, len(RESPONSE)])
+def test_parser_finds_the_action_in_any_chunking(size):
+    parser = ReActActionParser()
+    results = [parser.feed(chunk) for chunk in chunks(RESPONSE, size)]
+    assert [result for result in results if result is not None] == [ACTION]
+    assert parser.is_complete
+    assert parser.action_string == json.dumps(ACTION)
+
+
+def test_parser_keeps_invalid_json_for_repair():
+    parser = ReActActionParser()
+    for chunk in chunks('ACTION: {"tool_name": calc}\n', 4):
+        assert parser.feed(chunk) is None
+    assert parser.is_complete and parser.action is None
+    assert parser.action_string == '{"tool_name": calc}'
+
+    parser.reset()
+    assert parser.feed(f"ACTION: {json.dumps(ACTION)}") == ACTION
+
+
+def test_parser_waits_for_the_marker_split_across_chunks():
+    parser = ReActActionParser()
+    assert parser.feed("THOUGHT: ok\nACT") is None
+    assert parser.feed('ION: {"tool_name": "final_answer_tool", "arguments": {}}') == {
+        "tool_name": "final_answer_tool",
+        "arguments": {},
+    }
+
+
+def agent(client, **kwargs) -> ChatAgent:
+    return ChatAgent(name="streamer", client=client, model=MODEL, transcript=NullSink(), **kwargs)
+
+
+def test_stream_chat_uses_the_cache_shared_with_chat():
+    client = FakeOpenAIClient(responder=ScriptedResponder(["streamed answer", "second answer"]))
+    cache, metrics = ChatCompletionCache(), ChatMetrics()
+    first = agent(client, cache=cache, metrics=metrics)
+    assert "".join(first.stream_chat("Hi")) == "streamed answer"
+
+    deltas = []
+    second = agent(client, cache=cache, metrics=metrics)
+    assert second.chat("Hi") == "streamed answer"
+    assert list(agent(client, cache=cache, metrics=metrics).stream_chat("Hi", on_delta=deltas.append)) == [
+        "streamed answer"
+    ]
+    assert deltas == ["streamed answer"]
+    assert [(call.agent, call.cache_hit) for call in metrics.records] == [
+        ("streamer", False), ("streamer", True), ("streamer", True)
+    ]
+
+
+def test_stream_chat_records_failures():
+    client = FakeOpenAIClient(faults=FaultInjection(server_error_rate=1.0))
+    metrics = ChatMetrics()
+    streamer = agent(client, metrics=metrics)
+    with pytest.raises(RuntimeError):
+        list(streamer.stream_chat("Hi"))
+    assert [(call.agent, call.error) for call in metrics.records] == [("streamer", True)]
+    assert streamer.messages[-1]["role"] == "user"
+
+
+def test_on_delta_errors_propagate_unchanged():
+    client = FakeOpenAIClient(responder=ScriptedResponder(["a b c"]))
+
+    def on_delta(delta):
+        raise KeyError(delta)
+
+    messages = [{"role": "user", "content": "Hi"}]
+    with pytest.raises(KeyError):
+        do_chat_completion(messages, model=MODEL, client=client, stream=True, on_delta=on_delta)
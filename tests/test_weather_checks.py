@@ -0,0 +1,108 @@
+"""Tests that every weather-compatibility check mode in project_lib reaches the same verdicts."""
+
+import json
+import re
+
+import pytest
+
+from fake_openai import FakeOpenAIClient
+from project_lib import (
+    ACTIVITY_CALENDAR,
+    ChatCompletionCache,
+    CompatibilityCheckMode,
+    WeatherVerdictStore,
+    check_activities_weather_compatibility,
+    format_incompatible_activities_message,
+)
+
+MODEL = "gpt-4.1-mini"
+SYSTEM_PROMPT = "Answer IS_COMPATIBLE or IS_INCOMPATIBLE."
+CONDITIONS = {"2025-06-10": "rainy", "2025-06-11": "clear", "2025-06-12": "thunderstorm"}
+# An event whose description gives the rules nothing to go on
+MYSTERY_EVENT = {
+    **ACTIVITY_CALENDAR[0],
+    "activity_id": "event-2025-06-10-mystery",
+    "name": "Mystery Gathering",
+    "description": "Bring a friend.",
+}
+
+
+def travel_plan() -> dict:
+    return {
+        "itinerary_days": [
+            {
+                "date": date,
+                "weather": {"condition": condition},
+                "activity_recommendations": [
+                    {"activity": event, "reasons_for_recommendation": []}
+                    for event in [*ACTIVITY_CALENDAR, MYSTERY_EVENT]
+                    if event["start_time"].startswith(date)
+                ],
+            }
+            for date, condition in CONDITIONS.items()
+        ]
+    }
+
+
+def judge(prompt: str) -> bool:
+    """Decide one pair the way a model might: outdoor activities only suit clear weather."""
+    condition = re.search(r"Weather Condition: (\w+)", prompt).group(1)
+    return condition == "clear" or "outdoor" not in prompt.lower() or "indoor" in prompt.lower()
+
+
+def responder(model, messages, kwargs) -> str:
+    prompt = messages[-1]["content"]
+    if kwargs.get("response_format"):
+        pairs = re.split(r"Pair (\d+):\n", prompt)[1:]
+        return json.dumps({"verdicts": [
+            {"pair": int(index), "is_compatible": judge(text), "reasoning": "Judged."}
+            for index, text in zip(pairs[::2], pairs[1::2])
+        ]})
+    return "THOUGHT: Judged.\nFINAL ANSWER: " + ("IS_COMPATIBLE" if judge(prompt) else "IS_INCOMPATIBLE")
+
+
+def client() -> FakeOpenAIClient:
+    return FakeOpenAIClient(responder=responder)
+
+
+def decisions(verdicts) -> list:
+    return [(v.date, v.activity_id, v.weather_condition, v.is_compatible) for v in verdicts]
+
+
+def test_concurrent_and_batched_modes_match_sequential():
+    sequential = check_activities_weather_compatibility(travel_plan(), client(), MODEL, SYSTEM_PROMPT)
+    assert not all(verdict.is_compatible for verdict in sequential)
+    assert all(verdict.is_compatible for verdict in sequential if verdict.weather_condition == "clear")
+
+    for mode in [CompatibilityCheckMode.CONCURRENT, CompatibilityCheckMode.BATCHED]:
+        fake = client()
+        verdicts = check_activities_weather_compatibility(
+            travel_plan(), fake, MODEL, SYSTEM_PROMPT, mode=mode, max_workers=4
+        )
+        assert decisions(verdicts) == decisions(sequential)
+        assert format_incompatible_activities_message(verdicts) == format_incompatible_activities_message(sequential)
+        assert fake.backend.stats["requests"] == (1 if mode == CompatibilityCheckMode.BATCHED else len(sequential))
+
+
+@pytest.mark.parametrize("mode", list(CompatibilityCheckMode))
+def test_verdict_store_skips_rule_decided_and_known_pairs(mode):
+    expected = decisions(check_activities_weather_compatibility(travel_plan(), client(), MODEL, SYSTEM_PROMPT))
+    verdicts, cache = WeatherVerdictStore(), ChatCompletionCache()
+
+    fake = client()
+    first = check_activities_weather_compatibility(
+        travel_plan(), fake, MODEL, SYSTEM_PROMPT, mode=mode, cache=cache, verdicts=verdicts
+    )
+    # Only the activity of unknown setting in bad weather needs the model
+    assert fake.backend.stats["requests"] == 1
+    assert [v.activity_id for v in first if not v.reasoning.startswith("rule:")] == [MYSTERY_EVENT["activity_id"]]
+    assert all(v.reasoning.startswith("rule:") for v in first if v.weather_condition == "clear")
+
+    fake = client()
+    second = check_activities_weather_compatibility(
+        travel_plan(), fake, MODEL, SYSTEM_PROMPT, mode=mode, cache=cache, verdicts=verdicts
+    )
+    assert fake.backend.stats["requests"] == 0
+    assert decisions(second) == decisions(first)
+    # The rules agree with the model wherever they decide
+    assert decisions(first) == expected